@@ -1,37 +1,359 @@
 import json
 import yfinance as yf
-from flask import Flask, render_template, jsonify, request, current_app, session, redirect, url_for
+from flask import Flask, render_template, jsonify, request, current_app, session, redirect, url_for, Response, stream_with_context, g
 from datetime import datetime, date, timedelta, time
 import os
+import tempfile
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+import numpy as np
 import re # (新) 匯入 re
-from time import time as timestamp
+import hashlib
+import uuid
+import cProfile
+import pstats
+from time import time as timestamp, perf_counter
 import sqlite3 # (新) 匯入 sqlite
-from threading import Thread # (新) 匯入 Thread
-from collections import deque
+from threading import Thread, Lock, Event, local # (新) 匯入 Thread
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
+from itertools import islice
+from functools import wraps
+from contextlib import contextmanager
+from bisect import bisect_left
+import queue
+import time as time_module
 import logging
 from openai import OpenAI
 
 
+# --- (新) 多 worker 共用狀態 (SQLite) ---
+# 以 serve.py 啟動多個 worker 時會設定 TW_STOCK_SHARED_STATE_DB，報價快取、匯率表、回補狀態、
+# 除錯訊息、歷史資料版本與投資組合回應版本都改存在這個 SQLite 檔案，不論哪個 worker 處理請求都看到同一份狀態。
+# 未設定時 (python app.py 單一行程) 所有狀態留在行程內，行為與原本相同。
+SHARED_STATE_DB_ENV = 'TW_STOCK_SHARED_STATE_DB'
+WORKER_COUNT_ENV = 'TW_STOCK_WORKERS'
+MAX_STREAMS_ENV = 'TW_STOCK_MAX_STREAMS'
+SHARED_STATE_QUERY_CHUNK = 500  # 單一 IN (...) 查詢的參數上限
+SHARED_STATE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS shared_kv (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS shared_quotes (
+        ticker TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        fetched_at REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS shared_debug_messages (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS shared_portfolio_versions (
+        portfolio TEXT NOT NULL,
+        version TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        seen_at REAL NOT NULL,
+        PRIMARY KEY (portfolio, version)
+    )
+    """
+]
+
+def get_worker_count():
+    """serve.py 啟動的 worker 數 (單一行程時為 1)"""
+    try:
+        return max(1, int(os.environ.get(WORKER_COUNT_ENV, 1)))
+    except ValueError:
+        return 1
+
+class SharedStateStore:
+    """
+    (新) 跨行程共用的狀態儲存區 (WAL 模式的 SQLite，每個執行緒各自一條 autocommit 連線)。
+    db_path 為 None 時 enabled 為 False，呼叫端改用行程內的狀態。
+    """
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self._local = local()
+
+    @property
+    def enabled(self):
+        return bool(self.db_path)
+
+    def configure(self, db_path):
+        self.db_path = db_path
+
+    def _conn(self):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get(self.db_path)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in SHARED_STATE_SCHEMA:
+                conn.execute(statement)
+            connections[self.db_path] = conn
+        return conn
+
+    def get(self, key, default=None):
+        row = self._conn().execute("SELECT value FROM shared_kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO shared_kv (key, value, updated_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), timestamp())
+        )
+
+    def update(self, key, **fields):
+        """在同一個寫入交易內讀出 dict、合併 fields 再寫回"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM shared_kv WHERE key = ?", (key,)).fetchone()
+            value = dict(json.loads(row[0]) if row else {}, **fields)
+            conn.execute(
+                "INSERT OR REPLACE INTO shared_kv (key, value, updated_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), timestamp())
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def increment(self, key):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM shared_kv WHERE key = ?", (key,)).fetchone()
+            value = (json.loads(row[0]) if row else 0) + 1
+            conn.execute(
+                "INSERT OR REPLACE INTO shared_kv (key, value, updated_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), timestamp())
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def load_quotes(self, tickers, min_fetched_at):
+        """回傳 {ticker: (data, fetched_at)}，只包含 min_fetched_at 之後抓取的報價"""
+        result = {}
+        conn = self._conn()
+        for start in range(0, len(tickers), SHARED_STATE_QUERY_CHUNK):
+            chunk = tickers[start:start + SHARED_STATE_QUERY_CHUNK]
+            rows = conn.execute(
+                f"SELECT ticker, data, fetched_at FROM shared_quotes "
+                f"WHERE fetched_at >= ? AND ticker IN ({','.join('?' * len(chunk))})",
+                [min_fetched_at, *chunk]
+            ).fetchall()
+            for ticker, data, fetched_at in rows:
+                result[ticker] = (json.loads(data), fetched_at)
+        return result
+
+    def store_quotes(self, quotes, fetched_at):
+        if not quotes:
+            return
+        self._conn().executemany(
+            "INSERT OR REPLACE INTO shared_quotes (ticker, data, fetched_at) VALUES (?, ?, ?)",
+            [(ticker, json.dumps(data, ensure_ascii=False), fetched_at) for ticker, data in quotes.items()]
+        )
+
+    def remember_portfolio_version(self, portfolio, version, payload, keep):
+        """(新) 記住某個投資組合的回應版本 (給 since_version delta 用)，每個投資組合只保留最近 keep 個"""
+        conn = self._conn()
+        now = timestamp()
+        updated = conn.execute(
+            "UPDATE shared_portfolio_versions SET seen_at = ? WHERE portfolio = ? AND version = ?",
+            (now, portfolio, version)
+        ).rowcount
+        if updated:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO shared_portfolio_versions (portfolio, version, payload, seen_at) VALUES (?, ?, ?, ?)",
+                (portfolio, version, json.dumps(payload, ensure_ascii=False), now)
+            )
+            conn.execute(
+                "DELETE FROM shared_portfolio_versions WHERE portfolio = ? AND version NOT IN ("
+                "SELECT version FROM shared_portfolio_versions WHERE portfolio = ? ORDER BY seen_at DESC LIMIT ?)",
+                (portfolio, portfolio, keep)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def load_portfolio_version(self, portfolio, version):
+        row = self._conn().execute(
+            "SELECT payload FROM shared_portfolio_versions WHERE portfolio = ? AND version = ?", (portfolio, version)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def append_messages(self, texts, maxlen):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT INTO shared_debug_messages (text) VALUES (?)", [(text,) for text in texts])
+            last_seq = conn.execute("SELECT MAX(seq) FROM shared_debug_messages").fetchone()[0]
+            conn.execute("DELETE FROM shared_debug_messages WHERE seq <= ?", (last_seq - maxlen,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def messages_since(self, seq=0):
+        """與 LogRingBuffer.since 相同的回傳格式"""
+        conn = self._conn()
+        first_seq, last_seq = conn.execute("SELECT MIN(seq), MAX(seq) FROM shared_debug_messages").fetchone()
+        if last_seq is None:
+            return [], seq, False
+        if seq > last_seq:
+            seq = 0
+        entries = conn.execute(
+            "SELECT seq, text FROM shared_debug_messages WHERE seq > ? ORDER BY seq", (seq,)
+        ).fetchall()
+        return entries, last_seq, seq + 1 < first_seq
+
+SHARED_STATE = SharedStateStore(os.environ.get(SHARED_STATE_DB_ENV))
+
+# (修改) 回補任務狀態：單一行程時存在 BACKFILL_STATUS，多 worker 時存在 SHARED_STATE
 BACKFILL_STATUS = {
     "running": False,
     "message": "尚未開始"
 }
+BACKFILL_STATUS_LOCK = Lock()
+
+def read_backfill_status():
+    if SHARED_STATE.enabled:
+        return SHARED_STATE.get('backfill_status', BACKFILL_STATUS)
+    with BACKFILL_STATUS_LOCK:
+        return dict(BACKFILL_STATUS)
+
+def write_backfill_status(**status):
+    """整個取代回補狀態"""
+    if SHARED_STATE.enabled:
+        SHARED_STATE.set('backfill_status', status)
+        return
+    with BACKFILL_STATUS_LOCK:
+        BACKFILL_STATUS.clear()
+        BACKFILL_STATUS.update(status)
+
+def update_backfill_status(**fields):
+    """只更新部分欄位 (例如進度訊息)"""
+    if SHARED_STATE.enabled:
+        SHARED_STATE.update('backfill_status', **fields)
+        return
+    with BACKFILL_STATUS_LOCK:
+        BACKFILL_STATUS.update(fields)
+
+# --- (新) 低負擔的除錯訊息管線 ---
+# print / logging 只在呼叫端把原始資料丟進佇列，格式化與寫入環形緩衝區都在背景執行緒完成
+DEBUG_BUFFER_SIZE = 2000            # 環形緩衝區保留的訊息數
+DEBUG_LOG_LEVEL = logging.INFO      # 低於此等級的 log (例如 urllib3/yfinance 的 DEBUG) 直接丟棄
+
+class LogRingBuffer:
+    """
+    (新) 帶流水號的環形緩衝區，讓 /api/debug_messages?since=<seq> 只取新的訊息
+    """
+    def __init__(self, maxlen):
+        self._lock = Lock()
+        self._entries = deque(maxlen=maxlen)  # (seq, text)
+        self.last_seq = 0
+
+    def append(self, text):
+        with self._lock:
+            self.last_seq += 1
+            self._entries.append((self.last_seq, text))
+
+    def extend(self, texts):
+        with self._lock:
+            for text in texts:
+                self.last_seq += 1
+                self._entries.append((self.last_seq, text))
+
+    def since(self, seq=0):
+        """回傳 (流水號 > seq 的訊息, 最新流水號, 是否有訊息已被覆蓋)"""
+        with self._lock:
+            if not self._entries:
+                return [], self.last_seq, False
+            if seq > self.last_seq:
+                # 客戶端的流水號比伺服器還新 (例如伺服器重啟)，從頭開始給
+                seq = 0
+            first_seq = self._entries[0][0]
+            start = max(0, seq - first_seq + 1)
+            entries = list(islice(self._entries, start, None))
+            return entries, self.last_seq, seq + 1 < first_seq
+
+class LogPipeline:
+    """
+    (新) 背景執行緒消化 print 與 logging 的訊息並格式化後寫入 DEBUG_MESSAGES
+    (修改) 一次取出佇列中所有訊息批次寫入；多 worker 時寫入 SHARED_STATE
+    """
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self._queue = queue.SimpleQueue()
+        self._formatter = logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s')
+        self._thread = Thread(target=self._run, name='log-pipeline', daemon=True)
+        self._thread.start()
+
+    def put_print(self, message):
+        self._queue.put((timestamp(), message))
+
+    def put_record(self, record):
+        self._queue.put(record)
+
+    def _format(self, item):
+        if isinstance(item, logging.LogRecord):
+            return self._formatter.format(item)
+        created, message = item
+        return f"[{datetime.fromtimestamp(created).strftime('%Y-%m-%d %H:%M:%S')}] {message}"
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            try:
+                while True:
+                    items.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            texts = []
+            for item in items:
+                try:
+                    texts.append(self._format(item))
+                except Exception:
+                    pass
+            try:
+                if SHARED_STATE.enabled:
+                    SHARED_STATE.append_messages(texts, DEBUG_BUFFER_SIZE)
+                else:
+                    self.buffer.extend(texts)
+            except Exception:
+                pass
 
 # Initialize debug message storage
-DEBUG_MESSAGES = deque(maxlen=100)  # Store up to 100 debug messages
+DEBUG_MESSAGES = LogRingBuffer(maxlen=DEBUG_BUFFER_SIZE)
+LOG_PIPELINE = LogPipeline(DEBUG_MESSAGES)
 
 # Custom print function to capture debug messages
 original_print = print
 def debug_print(*args, **kwargs):
-    # Capture the message
-    message = ' '.join(str(arg) for arg in args)
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    debug_entry = f"[{timestamp}] {message}"
-    
-    # Add to debug message buffer
-    DEBUG_MESSAGES.append(debug_entry)
+    # Capture the message (時間戳與格式化交給背景執行緒)
+    LOG_PIPELINE.put_print(' '.join(str(arg) for arg in args))
     
     # Call original print function
     original_print(*args, **kwargs)
@@ -43,155 +365,1658 @@ builtins.print = debug_print
 # Custom logging handler to capture log messages
 class DebugMessageHandler(logging.Handler):
     def emit(self, record):
-        log_entry = self.format(record)
-        DEBUG_MESSAGES.append(log_entry)
+        # (修改) 不在呼叫端格式化，直接把 record 交給背景執行緒
+        LOG_PIPELINE.put_record(record)
 
 # Set up logging to use our custom handler
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-debug_handler = DebugMessageHandler()
-debug_handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s'))
+logger.setLevel(DEBUG_LOG_LEVEL)
+debug_handler = DebugMessageHandler(level=DEBUG_LOG_LEVEL)
 logger.addHandler(debug_handler)
 
 app = Flask(__name__)
 app.secret_key = 'super_secret_tech_key' # Replace with a strong random key in production
 app.permanent_session_lifetime = timedelta(days=7)
 
+# --- (新) 效能指標 (Prometheus 格式) 與每個請求的 Server-Timing ---
+# 每個階段 (stage) / 來源 (provider) 各自累計呼叫次數、錯誤次數與延遲直方圖，由 /api/metrics 輸出；
+# 同一個請求內的耗時另外記在執行緒的收集器，回應時轉成 Server-Timing header (瀏覽器 devtools 可直接看到)
+METRICS_PREFIX = "tw_stock"
+METRICS_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DB_STATEMENT_KINDS = {"select", "insert", "update", "delete", "with", "pragma"}
+
+class StageMetrics:
+    """
+    (新) 依 (stage, provider) 累計的計數器與延遲直方圖。
+    bucket 只記錄落在該區間的次數，輸出時再累加成 Prometheus 的累積 bucket。
+    """
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = Lock()
+        self._series = {}  # (stage, provider) -> {"count", "errors", "sum", "buckets"}
+
+    def observe(self, stage, provider, seconds, ok=True):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get((stage, provider))
+            if series is None:
+                series = self._series[(stage, provider)] = {
+                    "count": 0, "errors": 0, "sum": 0.0, "buckets": [0] * len(self.buckets)
+                }
+            series["count"] += 1
+            series["sum"] += seconds
+            if not ok:
+                series["errors"] += 1
+            if index < len(self.buckets):
+                series["buckets"][index] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {key: dict(series, buckets=list(series["buckets"])) for key, series in self._series.items()}
+
+    def render(self):
+        """Prometheus text exposition format"""
+        series = sorted(self.snapshot().items())
+        name = f"{METRICS_PREFIX}_stage"
+        lines = [
+            f"# HELP {name}_requests_total Calls per stage and provider.",
+            f"# TYPE {name}_requests_total counter"
+        ]
+        lines += [f"{name}_requests_total{{{_metric_labels(key)}}} {data['count']}" for key, data in series]
+        lines += [
+            f"# HELP {name}_errors_total Failed calls per stage and provider.",
+            f"# TYPE {name}_errors_total counter"
+        ]
+        lines += [f"{name}_errors_total{{{_metric_labels(key)}}} {data['errors']}" for key, data in series]
+        lines += [
+            f"# HELP {name}_duration_seconds Latency per stage and provider.",
+            f"# TYPE {name}_duration_seconds histogram"
+        ]
+        for key, data in series:
+            labels = _metric_labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, data["buckets"]):
+                cumulative += count
+                lines.append(f'{name}_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_duration_seconds_bucket{{{labels},le="+Inf"}} {data["count"]}')
+            lines.append(f"{name}_duration_seconds_sum{{{labels}}} {data['sum']:.6f}")
+            lines.append(f"{name}_duration_seconds_count{{{labels}}} {data['count']}")
+        return '\n'.join(lines) + '\n'
+
+def _metric_labels(key):
+    stage, provider = key
+    escape = lambda value: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'stage="{escape(stage)}",provider="{escape(provider)}"'
+
+METRICS = StageMetrics()
+
+class ServerTiming:
+    """(新) 單一請求內各階段的累計耗時 (平行的工作會各自計入，總和可能大於 total)"""
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = OrderedDict()  # 名稱 -> [秒數, 次數]
+
+    def add(self, stage, provider, seconds):
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', f"{stage}-{provider}" if provider else stage)
+        with self._lock:
+            entry = self._entries.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    def header(self, total_seconds):
+        with self._lock:
+            parts = [
+                f"{name};dur={seconds * 1000:.1f}" + (f';desc="{count} calls"' if count > 1 else "")
+                for name, (seconds, count) in self._entries.items()
+            ]
+        parts.append(f"total;dur={total_seconds * 1000:.1f}")
+        return ', '.join(parts)
+
+_timing_local = local()
+
+def current_server_timing():
+    return getattr(_timing_local, 'collector', None)
+
+def record_stage(stage, provider, seconds, ok=True):
+    METRICS.observe(stage, provider, seconds, ok)
+    collector = current_server_timing()
+    if collector is not None:
+        collector.add(stage, provider, seconds)
+
+@contextmanager
+def track_stage(stage, provider=""):
+    """計時一段程式；拋出例外視為錯誤"""
+    started = perf_counter()
+    ok = True
+    try:
+        yield
+    except Exception:
+        ok = False
+        raise
+    finally:
+        record_stage(stage, provider, perf_counter() - started, ok)
+
+def timed_stage(stage, provider=""):
+    """track_stage 的 decorator 版本"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with track_stage(stage, provider):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def with_server_timing(func):
+    """(新) 把目前請求的 Server-Timing 收集器帶進執行緒池的工作"""
+    collector = current_server_timing()
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = current_server_timing()
+        _timing_local.collector = collector
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _timing_local.collector = previous
+    return wrapper
+
+@app.before_request
+def start_request_timing():
+    _timing_local.collector = ServerTiming()
+    _timing_local.started = perf_counter()
+
+@app.after_request
+def finish_request_timing(response):
+    collector = current_server_timing()
+    if collector is None:
+        return response
+    elapsed = perf_counter() - _timing_local.started
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    METRICS.observe("http", f"{request.method} {route}", elapsed, response.status_code < 500)
+    response.headers['Server-Timing'] = collector.header(elapsed)
+    _timing_local.collector = None
+    return response
+
+# --- (新) 管理員專用的單一請求效能剖析 ---
+# 已登入為 admin 時，任何 API 請求加上 ?profile=1 或 header X-Profile: 1，就會在 cProfile 下執行；
+# 結果 (熱點函式、呼叫樹、wall / CPU 時間) 存在有上限的記憶體內儲存區，由 /api/profiles 取回
+PROFILE_ADMIN_USER = 'admin'
+PROFILE_STORE_SIZE = 20           # 最多保留幾份剖析結果
+PROFILE_TOP_FUNCTIONS = 30
+PROFILE_TREE_MAX_DEPTH = 12
+PROFILE_TREE_MIN_SHARE = 0.01     # 呼叫樹只展開佔總時間 1% 以上的節點
+PROFILE_STORE = OrderedDict()     # id -> profile
+PROFILE_STORE_LOCK = Lock()
+# cProfile 在新版 Python 同時只允許一個 profiler，同一時間只剖析一個請求
+PROFILER_LOCK = Lock()
+PYTHON_STDLIB_DIR = os.path.dirname(os.__file__)
+
+def is_admin():
+    return session.get('user') == PROFILE_ADMIN_USER
+
+def profiling_requested():
+    flag = request.args.get('profile') or request.headers.get('X-Profile')
+    return flag not in (None, '', '0', 'false') and request.path.startswith('/api/')
+
+def _profile_func_name(func):
+    filename, line, name = func
+    if filename.startswith(BASE_DIR):
+        filename = os.path.relpath(filename, BASE_DIR)
+    elif 'site-packages' in filename:
+        filename = filename.split('site-packages' + os.sep, 1)[-1]
+    elif filename.startswith(PYTHON_STDLIB_DIR):
+        filename = os.path.relpath(filename, PYTHON_STDLIB_DIR)
+    return f"{filename}:{line}({name})" if line else name
+
+def _build_call_tree(stats, total):
+    """由 pstats 的 callers 反推 callees，從沒有呼叫者的節點往下展開"""
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, (_, calls, _, cumtime) in callers.items():
+            callees.setdefault(caller, []).append((func, calls, cumtime))
+
+    def node(func, calls, cumtime, depth, path):
+        children = []
+        if depth < PROFILE_TREE_MAX_DEPTH:
+            for child, child_calls, child_cumtime in sorted(callees.get(func, []), key=lambda c: -c[2]):
+                if child not in path and child_cumtime >= total * PROFILE_TREE_MIN_SHARE:
+                    children.append(node(child, child_calls, child_cumtime, depth + 1, path | {child}))
+        return {
+            "function": _profile_func_name(func),
+            "calls": calls,
+            "cumtime_ms": round(cumtime * 1000, 3),
+            "children": children
+        }
+
+    roots = [
+        (func, nc, ct) for func, (_, nc, _, ct, callers) in stats.items()
+        if not callers and ct >= total * PROFILE_TREE_MIN_SHARE
+    ]
+    return [node(func, calls, cumtime, 0, {func}) for func, calls, cumtime in sorted(roots, key=lambda r: -r[2])]
+
+def build_profile(profiler, wall_seconds, cpu_seconds, response):
+    stats = pstats.Stats(profiler).stats
+    total = sum(tt for _, _, tt, _, _ in stats.values()) or 1e-9
+    top = sorted(stats.items(), key=lambda item: -item[1][3])[:PROFILE_TOP_FUNCTIONS]
+    return {
+        "id": uuid.uuid4().hex[:12],
+        "method": request.method,
+        "path": request.full_path.rstrip('?'),
+        "status": response.status_code,
+        "created_at": datetime.now().isoformat(timespec='seconds'),
+        "wall_ms": round(wall_seconds * 1000, 3),
+        "cpu_ms": round(cpu_seconds * 1000, 3),  # 本執行緒的 CPU 時間，wall 與 cpu 的差距大多是在等待 I/O 或鎖
+        "profiled_ms": round(total * 1000, 3),
+        "top_functions": [
+            {
+                "function": _profile_func_name(func),
+                "calls": nc,
+                "primitive_calls": cc,
+                "tottime_ms": round(tt * 1000, 3),
+                "cumtime_ms": round(ct * 1000, 3)
+            }
+            for func, (cc, nc, tt, ct, _) in top
+        ],
+        "call_tree": _build_call_tree(stats, total)
+    }
+
+def store_profile(profile):
+    with PROFILE_STORE_LOCK:
+        PROFILE_STORE[profile["id"]] = profile
+        while len(PROFILE_STORE) > PROFILE_STORE_SIZE:
+            PROFILE_STORE.popitem(last=False)
+
+@app.before_request
+def start_request_profile():
+    g.profiler = None
+    if not profiling_requested() or not is_admin():
+        return
+    if not PROFILER_LOCK.acquire(blocking=False):
+        g.profile_busy = True
+        return
+    g.profiler = cProfile.Profile()
+    g.profile_started = (perf_counter(), time_module.thread_time())
+    g.profiler.enable()
+
+@app.after_request
+def finish_request_profile(response):
+    profiler = g.get('profiler')
+    if profiler is None:
+        if g.get('profile_busy'):
+            response.headers['X-Profile'] = 'busy'
+        return response
+    try:
+        profiler.disable()
+        wall_started, cpu_started = g.profile_started
+        profile = build_profile(
+            profiler, perf_counter() - wall_started, time_module.thread_time() - cpu_started, response
+        )
+    finally:
+        g.profiler = None
+        PROFILER_LOCK.release()
+    store_profile(profile)
+    response.headers['X-Profile-Id'] = profile["id"]
+    print(f"[Profile] {profile['method']} {profile['path']} -> {profile['id']} "
+          f"(wall {profile['wall_ms']:.1f} ms, cpu {profile['cpu_ms']:.1f} ms)")
+    return response
+
+@app.teardown_request
+def abort_request_profile(exc):
+    # after_request 沒有執行到 (例如其他 hook 拋出例外) 時，確保 profiler 停止並釋放鎖
+    profiler = g.get('profiler')
+    if profiler is not None:
+        profiler.disable()
+        g.profiler = None
+        PROFILER_LOCK.release()
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # 使用配置中的文件路徑，如果沒有則使用默認路徑
 PORTFOLIO_FILE = os.path.join(BASE_DIR, 'portfolio.json')
 HISTORY_DB = os.path.join(BASE_DIR, 'history.db') # (修改) 從 .json 改為 .db
+# (新) 其他具名投資組合：portfolios/<name>.json 與 portfolios/<name>.db
+PORTFOLIOS_DIR = os.path.join(BASE_DIR, 'portfolios')
+DEFAULT_PORTFOLIO = 'default'
+PORTFOLIO_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+def get_portfolios_dir():
+    """獲取具名投資組合的存放目錄"""
+    return app.config.get('PORTFOLIOS_DIR', PORTFOLIOS_DIR)
+
+def get_portfolio_file(portfolio=DEFAULT_PORTFOLIO):
+    """獲取portfolio文件路徑 (default 沿用 portfolio.json)"""
+    if portfolio == DEFAULT_PORTFOLIO:
+        return app.config.get('PORTFOLIO_FILE', PORTFOLIO_FILE)
+    return os.path.join(get_portfolios_dir(), f"{portfolio}.json")
+
+def get_history_db(portfolio=DEFAULT_PORTFOLIO):
+    """獲取歷史數據庫文件路徑 (default 沿用 history.db，共用的價格庫也放在這裡)"""
+    if portfolio == DEFAULT_PORTFOLIO:
+        return app.config.get('HISTORY_DB', HISTORY_DB)
+    return os.path.join(get_portfolios_dir(), f"{portfolio}.db")
+
+# --- (新) 全域報價快取 (per-ticker TTL + single-flight) ---
+QUOTE_CACHE_TTL_SECONDS = 5
+QUOTE_NEGATIVE_TTL_SECONDS = 2 # (新) 抓取失敗 (N/A，例如被限流跳過) 的結果只保留這麼久，避免每個請求都重打上游
+
+def get_quote_cache_ttl():
+    """獲取報價快取的存活秒數"""
+    return app.config.get('QUOTE_CACHE_TTL', QUOTE_CACHE_TTL_SECONDS)
+
+def get_quote_negative_ttl():
+    """獲取 N/A 報價的快取秒數 (不會超過一般報價的 TTL)"""
+    return app.config.get('QUOTE_NEGATIVE_TTL', QUOTE_NEGATIVE_TTL_SECONDS)
+
+class QuoteCache:
+    """
+    (新) 行程內共用的即時報價快取。
+    - 每個 ticker 各自記錄抓取時間，超過 TTL 才會重新抓取
+    - 同一個 ticker 同時只會有一個 in-flight 抓取，其他呼叫者等待它完成 (single-flight)
+    - (新) 多 worker 時，本行程沒有的報價先查 SHARED_STATE，抓到的新報價也寫回去 (shared_hits)
+    - (新) 抓取失敗 (N/A) 的結果只在本行程保留 negative_ttl 秒 (negative_hits)，不寫入 SHARED_STATE
+    - 記錄 hit / miss 次數，方便調整 TTL
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}   # ticker -> (data, fetched_at)
+        self._inflight = {}  # ticker -> Event
+        self.stats = {"hits": 0, "misses": 0, "waits": 0, "fetches": 0, "shared_hits": 0, "negative_hits": 0}
+
+    def _load_shared(self, tickers, min_fetched_at):
+        if not SHARED_STATE.enabled:
+            return {}
+        try:
+            return SHARED_STATE.load_quotes(tickers, min_fetched_at)
+        except Exception as e:
+            print(f"[Quote Cache] Shared state read failed: {e}")
+            return {}
+
+    def _store_shared(self, quotes, fetched_at):
+        if not SHARED_STATE.enabled or not quotes:
+            return
+        try:
+            SHARED_STATE.store_quotes(quotes, fetched_at)
+        except Exception as e:
+            print(f"[Quote Cache] Shared state write failed: {e}")
+
+    def get_many(self, tickers, fetch_func, ttl, negative_ttl=0):
+        result = {}
+        to_fetch = []
+        to_wait = {}
+        now = timestamp()
+        negative_ttl = min(negative_ttl, ttl)
+        with self._lock:
+            for ticker in tickers:
+                entry = self._entries.get(ticker)
+                negative = entry is not None and entry[0].get('source') == 'N/A'
+                if entry and now - entry[1] < (negative_ttl if negative else ttl):
+                    result[ticker] = dict(entry[0])
+                    self.stats["negative_hits" if negative else "hits"] += 1
+                elif ticker in self._inflight:
+                    # 其他請求正在抓這支股票，等它完成即可
+                    to_wait[ticker] = self._inflight[ticker]
+                    self.stats["waits"] += 1
+                else:
+                    to_fetch.append(ticker)
+                    self._inflight[ticker] = Event()
+                    self.stats["misses"] += 1
+
+        if to_fetch:
+            fetched = {}
+            shared = {}
+            try:
+                # (新) 多 worker 時先看其他 worker 是否已經抓過
+                shared = self._load_shared(to_fetch, now - ttl)
+                missing = [ticker for ticker in to_fetch if ticker not in shared]
+                if missing:
+                    with self._lock:
+                        self.stats["fetches"] += 1
+                    fetched = fetch_func(missing)
+            finally:
+                fetched_at = timestamp()
+                cacheable = {}
+                with self._lock:
+                    for ticker in to_fetch:
+                        if ticker in shared:
+                            data, shared_at = shared[ticker]
+                            self._entries[ticker] = (dict(data), shared_at)
+                            self.stats["shared_hits"] += 1
+                        else:
+                            data = fetched.get(ticker)
+                            if data and data.get('source') != 'N/A':
+                                self._entries[ticker] = (dict(data), fetched_at)
+                                cacheable[ticker] = data
+                            elif data and negative_ttl > 0:
+                                # (修改) 抓取失敗 (N/A) 的結果只短暫留在本行程，過了 negative_ttl 就重試
+                                self._entries[ticker] = (dict(data), fetched_at)
+                            else:
+                                self._entries.pop(ticker, None)
+                        self._inflight.pop(ticker).set()
+                self._store_shared(cacheable, fetched_at)
+            for ticker in to_fetch:
+                if ticker in shared:
+                    result[ticker] = dict(shared[ticker][0])
+                elif ticker in fetched:
+                    result[ticker] = dict(fetched[ticker])
+
+        for ticker, event in to_wait.items():
+            event.wait()
+            with self._lock:
+                entry = self._entries.get(ticker)
+            if entry:
+                result[ticker] = dict(entry[0])
+
+        return result
+
+    def snapshot_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"] + stats["waits"] + stats["negative_hits"]
+        stats["hit_rate"] = (stats["hits"] + stats["waits"]) / lookups if lookups else 0
+        stats["ttl_seconds"] = get_quote_cache_ttl()
+        stats["negative_ttl_seconds"] = get_quote_negative_ttl()
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+QUOTE_CACHE = QuoteCache()
+
+@timed_stage("quotes")
+def get_current_prices(tickers):
+    """
+    (新) 帶快取的即時價格入口。
+    所有端點 (/api/portfolio、/api/ask_ai、save_daily_snapshot) 共用同一份快取，
+    TTL 內的重複請求不會再打 MIS/Sina/yfinance。
+    """
+    if not tickers:
+        return {}
+
+    stock_data = QUOTE_CACHE.get_many(tickers, _fetch_current_prices, get_quote_cache_ttl(), get_quote_negative_ttl())
+
+    for ticker in tickers:
+        if ticker not in stock_data:
+            stock_data[ticker] = {"price": 0, "previous_close": 0, "source": "N/A"}
+
+    return stock_data
+
+def _fetch_current_prices(tickers):
+    """
+    (已修改) 三路混合：平行獲取即時價格
+    - .TW 股票: 優先使用 get_mis_tw_prices
+    - .SS/.SZ 股票: 優先使用 get_sina_current_prices
+    - 其他股票 (及備援): 使用 get_yfinance_current_prices
+    (新) 三組同時在 PROVIDER_POOL 上抓取，各組失敗時立即在同一個工作中改用 yfinance 備援，
+    總延遲取決於最慢的單一來源，而不是三者相加。
+    """
+    if not tickers:
+        return {}
+    
+    print(f"\n[Hybrid Prices] Fetching: {' '.join(tickers)}")
+    
+    # 1. 分離 Tickers
+    tw_tickers = [t for t in tickers if t.endswith('.TW') or t.endswith('.TWO')] # (修改)
+    china_tickers = [t for t in tickers if t.endswith('.SS') or t.endswith('.SZ')]
+    yfinance_tickers = [t for t in tickers if 
+                        not t.endswith('.TW') and 
+                        not t.endswith('.TWO') and
+                        not t.endswith('.SS') and 
+                        not t.endswith('.SZ')]
+    
+    # 2. 平行送出三組抓取工作
+    futures = []
+    if tw_tickers:
+        futures.append(PROVIDER_POOL.submit(with_server_timing(_fetch_group_with_fallback), tw_tickers, get_mis_tw_prices, 'MIS'))
+    if china_tickers:
+        print(f"[Hybrid Prices] Fetching {len(china_tickers)} China stocks via Sina...")
+        futures.append(PROVIDER_POOL.submit(with_server_timing(_fetch_group_with_fallback), china_tickers, get_sina_current_prices, 'Sina'))
+    if yfinance_tickers:
+        print(f"[Hybrid Prices] Fetching {len(yfinance_tickers)} stocks via yfinance...")
+        futures.append(PROVIDER_POOL.submit(with_server_timing(_fetch_group_with_fallback), yfinance_tickers, None, None))
+
+    all_stock_data = {}
+    for future in futures:
+        try:
+            all_stock_data.update(future.result())
+        except Exception as e:
+            print(f"[Hybrid Prices] Provider group failed: {e}")
+        
+    # 3. 最終檢查 (不變)
+    for ticker in tickers:
+        if ticker not in all_stock_data:
+            print(f"Warning: No price data found for {ticker} from any source.")
+            # (新) 標記來源為 N/A
+            all_stock_data[ticker] = {"price": 0, "previous_close": 0, "source": "N/A"}
+
+    return all_stock_data
+
+# (新) 報價來源共用的有界執行緒池
+PROVIDER_POOL_WORKERS = 6
+PROVIDER_POOL = ThreadPoolExecutor(max_workers=PROVIDER_POOL_WORKERS, thread_name_prefix='quote-provider')
+
+def _fetch_group_with_fallback(tickers, primary_func, source):
+    """
+    (新) 抓取單一組股票：先用主要來源，失敗的股票立刻改用 yfinance。
+    primary_func 為 None 時直接使用 yfinance。
+    """
+    stock_data = {}
+    fallback_tickers = list(tickers)
+
+    if primary_func is not None:
+        # (新) 透過斷路器呼叫；斷路器開啟時直接跳到 yfinance，不再等待逾時
+        primary_data = call_quote_provider(source, primary_func, tickers)
+        # (新) 注入來源標籤
+        for ticker, data in primary_data.items():
+            data['source'] = source
+        stock_data.update(primary_data)
+
+        fallback_tickers = [t for t in tickers if t not in primary_data]
+        if fallback_tickers:
+            print(f"[Hybrid Prices] {source} failed for: {fallback_tickers}. Falling back to yfinance.")
+
+    if fallback_tickers:
+        yfinance_data = call_quote_provider('yfinance', get_yfinance_current_prices, fallback_tickers)
+        for ticker, data in yfinance_data.items():
+            data['source'] = 'yfinance'
+        stock_data.update(yfinance_data)
+
+    return stock_data
+
+# --- (新) 報價來源的斷路器與健康度 ---
+CIRCUIT_FAILURE_THRESHOLD = 3       # 連續失敗幾次後開啟斷路器
+CIRCUIT_COOLDOWN_SECONDS = 30       # 開啟後多久進入 half-open 試探
+HEALTH_WINDOW_SIZE = 200            # 計算錯誤率與延遲百分位數的最近呼叫數
+
+class CircuitBreaker:
+    """
+    (新) closed -> (連續失敗) -> open -> (冷卻結束) -> half-open -> (試探成功) -> closed
+    half-open 時只放行一個試探請求，其他請求直接跳過這個來源。
+    同時記錄最近呼叫的延遲與成功與否，供 /api/provider_health 使用。
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._calls = deque(maxlen=HEALTH_WINDOW_SIZE)  # (latency, ok)
+        self.total_calls = 0
+        self.total_skipped = 0
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if timestamp() - self.opened_at < CIRCUIT_COOLDOWN_SECONDS:
+                    self.total_skipped += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN:
+                if self._trial_in_flight:
+                    self.total_skipped += 1
+                    return False
+                self._trial_in_flight = True
+            return True
+
+    def cancel(self):
+        """(新) 放行的請求沒有真的打到上游 (例如被本地限流擋下)：不計成敗，只歸還 half-open 的試探名額"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record(self, ok, latency):
+        with self._lock:
+            self._calls.append((latency, ok))
+            self.total_calls += 1
+            if ok:
+                if self.state != self.CLOSED:
+                    print(f"[Circuit] {self.name} recovered. Closing breaker.")
+                self.state = self.CLOSED
+                self.consecutive_failures = 0
+                self._trial_in_flight = False
+                return
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+                if self.state != self.OPEN:
+                    print(f"[Circuit] {self.name} failed {self.consecutive_failures} time(s). Opening breaker for {CIRCUIT_COOLDOWN_SECONDS}s.")
+                self.state = self.OPEN
+                self.opened_at = timestamp()
+                self._trial_in_flight = False
+
+    def health(self):
+        with self._lock:
+            calls = list(self._calls)
+            state = self.state
+            if state == self.OPEN and timestamp() - self.opened_at >= CIRCUIT_COOLDOWN_SECONDS:
+                state = self.HALF_OPEN
+            result = {
+                "state": state,
+                "consecutive_failures": self.consecutive_failures,
+                "total_calls": self.total_calls,
+                "total_skipped": self.total_skipped,
+                "opened_at": datetime.fromtimestamp(self.opened_at).strftime('%Y-%m-%d %H:%M:%S') if self.opened_at else None
+            }
+        latencies = np.array([latency for latency, _ in calls], dtype=float) * 1000
+        errors = sum(1 for _, ok in calls if not ok)
+        result["window_calls"] = len(calls)
+        result["error_rate"] = errors / len(calls) if calls else 0
+        if len(latencies):
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist()
+            result["latency_ms"] = {"p50": round(p50, 1), "p95": round(p95, 1), "p99": round(p99, 1)}
+        else:
+            result["latency_ms"] = {"p50": None, "p95": None, "p99": None}
+        return result
+
+CIRCUIT_BREAKERS = {name: CircuitBreaker(name) for name in ("MIS", "Sina", "yfinance", "FX")}
+
+def call_quote_provider(source, func, tickers):
+    """
+    (新) 經由斷路器呼叫報價來源。
+    斷路器開啟時回傳空 dict (呼叫端會改用下一個來源)；
+    回傳空結果或全部價格為 0 視為失敗。
+    (修改) 本地限流 (RateLimitExceeded) 不是來源故障：同樣回傳空 dict 改用下一個來源，但不計入斷路器
+    """
+    breaker = CIRCUIT_BREAKERS[source]
+    if not breaker.allow_request():
+        print(f"[Circuit] {source} breaker is open. Skipping {len(tickers)} tickers.")
+        return {}
+    started = timestamp()
+    try:
+        result = func(tickers)
+    except RateLimitExceeded as e:
+        breaker.cancel()
+        print(f"[Circuit] {source} skipped: {e}")
+        return {}
+    except Exception as e:
+        print(f"[Circuit] {source} raised: {e}")
+        result = {}
+    ok = any(data.get('price', 0) for data in result.values())
+    elapsed = timestamp() - started
+    breaker.record(ok, elapsed)
+    record_stage("provider", source, elapsed, ok)
+    return result
+
+# --- (新) 每個上游來源的 token-bucket 限流 ---
+# (每秒補充的 token 數, 桶子容量)。回補、快照與即時輪詢共用同一個額度。
+RATE_LIMITS = {
+    "mis": (0.6, 3),     # MIS 約每 5 秒 3 次
+    "sina": (2.0, 5),
+    "yahoo": (2.0, 5),
+    "fx": (0.2, 2)
+}
+RATE_LIMIT_LIVE_TIMEOUT_SECONDS = 2  # 即時報價最多等待的秒數，等不到就改用備援來源
+
+class RateLimitExceeded(Exception):
+    """在 timeout 內拿不到 token 時拋出，呼叫端視為該來源失敗"""
+    pass
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = timestamp()
+        self._lock = Lock()
+
+    def _reserve(self, now):
+        """預約一個 token，回傳需要等待的秒數 (token 可以預借成負數，依序排隊)"""
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def _cancel(self):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+    def acquire(self, timeout=None):
+        wait = self._reserve(timestamp())
+        if timeout is not None and wait > timeout:
+            self._cancel()
+            return None
+        if wait > 0:
+            time_module.sleep(wait)
+        return wait
+
+class RateLimiter:
+    """
+    (新) 行程內共用的限流服務。每個抓取函式在打上游前都要 acquire 對應來源的 token。
+    """
+    def __init__(self, limits):
+        self._lock = Lock()
+        self._buckets = {}
+        self._stats = {}
+        for provider, (rate, capacity) in limits.items():
+            self.configure(provider, rate, capacity)
+
+    def configure(self, provider, rate, capacity):
+        with self._lock:
+            self._buckets[provider] = TokenBucket(rate, capacity)
+            self._stats.setdefault(provider, {"acquired": 0, "rejected": 0, "waited_seconds": 0.0})
+
+    def acquire(self, provider, timeout=None):
+        bucket = self._buckets.get(provider)
+        if bucket is None:
+            return
+        waited = bucket.acquire(timeout)
+        with self._lock:
+            stats = self._stats[provider]
+            if waited is None:
+                stats["rejected"] += 1
+            else:
+                stats["acquired"] += 1
+                stats["waited_seconds"] += waited
+        if waited is None:
+            raise RateLimitExceeded(f"{provider} rate limit exceeded")
+
+    def stats(self):
+        with self._lock:
+            return {
+                provider: dict(
+                    self._stats[provider],
+                    rate_per_second=bucket.rate,
+                    burst=bucket.capacity
+                )
+                for provider, bucket in self._buckets.items()
+            }
+
+def split_rate_limits(limits, workers):
+    """(新) 多 worker 時平分每個上游的額度，所有 worker 加起來的請求量與單一行程相同"""
+    return {
+        provider: (rate / workers, max(1, capacity // workers))
+        for provider, (rate, capacity) in limits.items()
+    }
+
+RATE_LIMITER = RateLimiter(split_rate_limits(RATE_LIMITS, get_worker_count()))
+
+# --- (新) 共用 HTTP 連線層 (per-host 連線池 + keep-alive) ---
+HTTP_CONNECT_TIMEOUT_SECONDS = 3.05
+HTTP_READ_TIMEOUT_SECONDS = 5
+HTTP_MAX_RETRIES = 1
+HTTP_POOL_MAXSIZE = 10
+# 上游端點 (app.config['UPSTREAM_URLS'] 可個別覆寫，例如壓力測試時指向本地替身伺服器)
+UPSTREAM_URLS = {
+    "mis": "http://mis.twse.com.tw/stock/api/getStockInfo.jsp",
+    "sina": "http://hq.sinajs.cn/list=",
+    "fx": "https://open.er-api.com/v6/latest/TWD"
+}
+
+def get_upstream_url(provider):
+    return app.config.get('UPSTREAM_URLS', {}).get(provider, UPSTREAM_URLS[provider])
+
+class HttpClient:
+    """
+    (新) 所有上游來源 (MIS、Sina、匯率) 共用的 HTTP 用戶端。
+    - 每個來源一個 requests.Session，底層 urllib3 連線池會保持 keep-alive
+    - 統一的逾時與重試策略 (只重試連線錯誤與 502/503/504)
+    - 透過連線池統計可以確認連線是否有被重複使用
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._sessions = {}
+        self._request_counts = {}
+
+    def _build_session(self):
+        session = requests.Session()
+        retry = Retry(
+            total=HTTP_MAX_RETRIES,
+            read=0,
+            backoff_factor=0.2,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def session(self, provider):
+        with self._lock:
+            session = self._sessions.get(provider)
+            if session is None:
+                session = self._build_session()
+                self._sessions[provider] = session
+                self._request_counts[provider] = 0
+            self._request_counts[provider] += 1
+            return session
+
+    def get(self, provider, url, timeout=None, rate_limit_timeout=RATE_LIMIT_LIVE_TIMEOUT_SECONDS, **kwargs):
+        if timeout is None:
+            timeout = (HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS)
+        # (新) 先向限流服務取得 token
+        RATE_LIMITER.acquire(provider, timeout=rate_limit_timeout)
+        return self.session(provider).get(url, timeout=timeout, **kwargs)
+
+    def stats(self):
+        """回傳每個來源的請求數、新建連線數與重複使用次數"""
+        result = {}
+        with self._lock:
+            sessions = dict(self._sessions)
+            request_counts = dict(self._request_counts)
+        for provider, session in sessions.items():
+            pools = []
+            adapter = session.get_adapter('https://')
+            pool_container = adapter.poolmanager.pools
+            for key in list(pool_container.keys()):
+                pool = pool_container.get(key)
+                if pool is None:
+                    continue
+                pools.append({
+                    "host": pool.host,
+                    "port": pool.port,
+                    "requests": pool.num_requests,
+                    "connections_opened": pool.num_connections,
+                    "connections_reused": max(0, pool.num_requests - pool.num_connections)
+                })
+            result[provider] = {
+                "requests": request_counts.get(provider, 0),
+                "connections_opened": sum(p["connections_opened"] for p in pools),
+                "connections_reused": sum(p["connections_reused"] for p in pools),
+                "pools": pools
+            }
+        return result
+
+HTTP_CLIENT = HttpClient()
+
+# --- (修改) 多幣別匯率服務 (stale-while-revalidate) ---
+FX_TTL_SECONDS = 60
+FX_REFRESH_AHEAD_SECONDS = 45  # 超過這個年齡就在背景預先更新，請求端不等待
+# 尚未取得任何匯率表時使用的備用值 (1 單位外幣 = ? 台幣)
+FX_FALLBACK_TO_TWD = {"TWD": 1.0, "CNY": 4.4, "USD": 32.0, "HKD": 4.1, "JPY": 0.21}
+FX_PERSIST_WAIT_SECONDS = 15  # 寫入歷史資料前，最多等待匯率表更新的秒數
+
+class FxRatesUnavailable(Exception):
+    """拿不到比 FX_TTL_SECONDS 新的匯率表，不能用來寫入歷史資料"""
+
+class FxRateService:
+    """
+    (新) 一次抓取完整匯率表 (以 TWD 為基準)，所有幣別對都從記憶體換算。
+    - 匯率表年齡超過 FX_REFRESH_AHEAD_SECONDS 時，由背景執行緒更新 (同時間最多一個)
+    - 更新期間與更新失敗時繼續提供舊值 (stale-while-revalidate)，估值請求永遠不會等待匯率 API
+    - 啟動後尚未取得匯率表前，使用 FX_FALLBACK_TO_TWD
+    - (修改) 以上只適用即時請求；寫入 daily_history 的路徑改用 rates_for_persistence()，
+      一定拿到新的匯率表，否則拋出 FxRatesUnavailable
+    - (新) 多 worker 時匯率表也寫入 SHARED_STATE，其他 worker 更新前先沿用這份
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._to_twd = dict(FX_FALLBACK_TO_TWD)
+        self._fetched_at = 0
+        self._refreshing = False
+        self._last_error = None
+
+    def _maybe_refresh(self):
+        with self._lock:
+            if self._refreshing or timestamp() - self._fetched_at < FX_REFRESH_AHEAD_SECONDS:
+                return
+            self._refreshing = True
+        Thread(target=self._refresh, daemon=True).start()
+
+    def _adopt_shared(self):
+        """(新) 多 worker 時，其他 worker 剛抓過的匯率表直接沿用，不再打 API"""
+        if not SHARED_STATE.enabled:
+            return False
+        try:
+            shared = SHARED_STATE.get('fx_rates')
+        except Exception as e:
+            print(f"[FX] Shared state read failed: {e}")
+            return False
+        if not shared or timestamp() - shared["fetched_at"] >= FX_REFRESH_AHEAD_SECONDS:
+            return False
+        with self._lock:
+            self._to_twd = shared["to_twd"]
+            self._fetched_at = shared["fetched_at"]
+            self._last_error = None
+        return True
+
+    def _publish_shared(self, to_twd, fetched_at):
+        if not SHARED_STATE.enabled:
+            return
+        try:
+            SHARED_STATE.set('fx_rates', {"to_twd": to_twd, "fetched_at": fetched_at})
+        except Exception as e:
+            print(f"[FX] Shared state write failed: {e}")
+
+    def _refresh(self):
+        breaker = CIRCUIT_BREAKERS["FX"]
+        try:
+            if self._adopt_shared():
+                return
+            if not breaker.allow_request():
+                return
+            started = timestamp()
+            try:
+                print("Fetching new exchange rate table...")
+                response = HTTP_CLIENT.get('fx', get_upstream_url('fx'))
+                response.raise_for_status()
+                rates = response.json()['rates']
+                # API 回傳的是 1 TWD = ? 外幣，轉成 1 外幣 = ? TWD
+                to_twd = {currency: 1.0 / rate for currency, rate in rates.items() if rate}
+                to_twd["TWD"] = 1.0
+                breaker.record(True, timestamp() - started)
+                record_stage("provider", "FX", timestamp() - started)
+            except RateLimitExceeded as e:
+                # (新) 本地限流不是上游故障，不計入斷路器
+                breaker.cancel()
+                self._last_error = str(e)
+                print(f"Exchange rate refresh skipped: {e}")
+                return
+            except Exception as e:
+                breaker.record(False, timestamp() - started)
+                record_stage("provider", "FX", timestamp() - started, ok=False)
+                self._last_error = str(e)
+                print(f"Error fetching exchange rate table: {e}")
+                return
+            fetched_at = timestamp()
+            with self._lock:
+                self._to_twd = to_twd
+                self._fetched_at = fetched_at
+                self._last_error = None
+            self._publish_shared(to_twd, fetched_at)
+            print(f"New exchange rate table: {len(to_twd)} currencies, CNY={to_twd.get('CNY')}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def refresh_now(self):
+        """同步更新一次 (給排程器或手動觸發用)；已有更新在進行時回傳 False"""
+        with self._lock:
+            if self._refreshing:
+                return False
+            self._refreshing = True
+        self._refresh()
+        return True
+
+    def rates_for_persistence(self, max_age=FX_TTL_SECONDS, timeout=FX_PERSIST_WAIT_SECONDS):
+        """
+        (新) 寫入歷史資料用的匯率表：必須比 max_age 新。
+        太舊 (或仍是備用匯率) 時同步更新一次，正在背景更新就等它完成；
+        仍然拿不到就拋出 FxRatesUnavailable，呼叫端不可寫入。
+        """
+        deadline = timestamp() + timeout
+        refreshed = False
+        while True:
+            with self._lock:
+                if self._fetched_at and timestamp() - self._fetched_at < max_age:
+                    return self._to_twd
+                refreshing = self._refreshing
+                last_error = self._last_error
+            if refreshed or timestamp() >= deadline:
+                raise FxRatesUnavailable(f"No exchange rate table fresher than {max_age}s ({last_error or 'refresh skipped'})")
+            if refreshing:
+                time_module.sleep(0.1)
+                continue
+            refreshed = self.refresh_now()
+
+    @timed_stage("fx")
+    def rates_to_twd(self):
+        """回傳 {幣別: 1 單位 = ? TWD} 的完整表 (不會阻塞)"""
+        self._maybe_refresh()
+        with self._lock:
+            return self._to_twd
+
+    def get_rate(self, from_currency, to_currency="TWD"):
+        table = self.rates_to_twd()
+        from_rate = table.get(from_currency, FX_FALLBACK_TO_TWD.get(from_currency))
+        to_rate = table.get(to_currency, FX_FALLBACK_TO_TWD.get(to_currency))
+        if not from_rate or not to_rate:
+            raise KeyError(f"Unknown currency pair {from_currency}/{to_currency}")
+        return from_rate / to_rate
+
+    def status(self):
+        with self._lock:
+            age = timestamp() - self._fetched_at if self._fetched_at else None
+            return {
+                "source": "live" if self._fetched_at else "fallback",
+                "age_seconds": round(age, 1) if age is not None else None,
+                "stale": age is None or age >= FX_TTL_SECONDS,
+                "refreshing": self._refreshing,
+                "last_error": self._last_error,
+                "currencies": len(self._to_twd),
+                "rates_to_twd": {currency: self._to_twd[currency] for currency in FX_FALLBACK_TO_TWD if currency in self._to_twd}
+            }
+
+FX_SERVICE = FxRateService()
+
+def get_cny_to_twd_rate():
+    # (修改) 改由匯率服務的記憶體表提供，不再同步呼叫 API
+    return FX_SERVICE.get_rate("CNY", "TWD")
+
+# --- (新) 記憶體內的投資組合 (mtime 失效 + 原子寫入) ---
+# (新) 讀取 umask 必須先設定它，因此只在匯入時 (單執行緒) 讀一次
+CURRENT_UMASK = os.umask(0)
+os.umask(CURRENT_UMASK)
+
+class PortfolioStore:
+    """
+    (新) portfolio.json 的記憶體快取。
+    - 只有在檔案的 (mtime, size, inode) 改變時才重新讀取與解析
+    - 寫入時先寫暫存檔再 os.replace，讀取端不會看到寫到一半的檔案
+    - 預先建立 ticker 集合與 ticker -> 列索引，新增/更新/刪除不需線性搜尋
+    - 讀取回傳的是複本，呼叫端可以自由修改
+    每個具名投資組合各有一個實例 (見 get_portfolio_store)。
+    """
+    def __init__(self, name=DEFAULT_PORTFOLIO):
+        self.name = name
+        self._lock = Lock()
+        self._path = None
+        self._signature = None
+        self._stocks = []
+        self._index = {}
+        self._tickers = []
+
+    def _file_signature(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _set_stocks(self, stocks):
+        self._stocks = stocks
+        self._index = {stock['ticker']: i for i, stock in enumerate(stocks)}
+        self._tickers = list(self._index)
+
+    def _refresh(self):
+        """(需持有 self._lock) 檔案有變動時重新載入"""
+        path = get_portfolio_file(self.name)
+        signature = self._file_signature(path)
+        if path == self._path and signature == self._signature:
+            return
+        if signature is None:
+            stocks = []
+        else:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    stocks = json.load(f)
+            except Exception as e:
+                # 檔案被手動編輯到一半等情況：保留上一份可用的資料
+                print(f"Error loading portfolio: {e}")
+                if path == self._path:
+                    return
+                stocks = []
+        self._path = path
+        self._signature = signature
+        self._set_stocks(stocks)
+
+    @staticmethod
+    def _target_mode(path):
+        """(新) 取代後應有的權限：沿用既有檔案，新檔則依 umask (mkstemp 固定建立 0600)"""
+        try:
+            return os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            return 0o666 & ~CURRENT_UMASK
+
+    def _write(self, stocks):
+        """(需持有 self._lock) 原子寫入並更新記憶體內容"""
+        path = get_portfolio_file(self.name)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.portfolio-', suffix='.json.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(stocks, f, indent=2, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, self._target_mode(path))
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._path = path
+        self._signature = self._file_signature(path)
+        self._set_stocks(stocks)
+
+    def load(self):
+        with self._lock:
+            self._refresh()
+            return [dict(stock) for stock in self._stocks]
+
+    def snapshot(self):
+        """回傳 (持股複本, 不重複的 ticker 清單)，兩者來自同一個版本"""
+        with self._lock:
+            self._refresh()
+            return [dict(stock) for stock in self._stocks], list(self._tickers)
+
+    def get(self, ticker):
+        with self._lock:
+            self._refresh()
+            i = self._index.get(ticker)
+            return dict(self._stocks[i]) if i is not None else None
+
+    def save(self, stocks):
+        with self._lock:
+            self._write([dict(stock) for stock in stocks])
+
+    def add(self, stock):
+        """新增一筆持股，ticker 已存在時回傳 False"""
+        with self._lock:
+            self._refresh()
+            if stock['ticker'] in self._index:
+                return False
+            self._write(self._stocks + [dict(stock)])
+            return True
+
+    def update(self, ticker, changes):
+        """更新一筆持股，回傳更新後的複本；找不到時回傳 None"""
+        with self._lock:
+            self._refresh()
+            i = self._index.get(ticker)
+            if i is None:
+                return None
+            stocks = list(self._stocks)
+            stocks[i] = dict(stocks[i], **changes)
+            self._write(stocks)
+            return dict(stocks[i])
+
+    def delete(self, ticker):
+        """刪除一筆持股，找不到時回傳 False"""
+        with self._lock:
+            self._refresh()
+            i = self._index.get(ticker)
+            if i is None:
+                return False
+            self._write(self._stocks[:i] + self._stocks[i + 1:])
+            return True
+
+# (新) 多個具名投資組合
+class PortfolioNotFound(KeyError):
+    pass
+
+PORTFOLIO_STORES = {}
+PORTFOLIO_STORES_LOCK = Lock()
+
+def get_portfolio_store(portfolio=DEFAULT_PORTFOLIO):
+    with PORTFOLIO_STORES_LOCK:
+        store = PORTFOLIO_STORES.get(portfolio)
+        if store is None:
+            store = PORTFOLIO_STORES[portfolio] = PortfolioStore(portfolio)
+        return store
+
+# (新) 投資組合名稱清單快取：{目錄: (目錄 mtime, 名稱清單)}
+# 目錄的 mtime 在新增/刪除檔案時才會改變 (含其他 worker 或手動操作)，
+# 每次請求只需一次 os.stat，不必 os.listdir
+PORTFOLIO_NAMES_CACHE = {}
+PORTFOLIO_NAMES_LOCK = Lock()
+
+def invalidate_portfolio_names():
+    with PORTFOLIO_NAMES_LOCK:
+        PORTFOLIO_NAMES_CACHE.clear()
+
+def list_portfolios():
+    """回傳所有投資組合名稱 (default 永遠在第一個)"""
+    directory = get_portfolios_dir()
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except FileNotFoundError:
+        return [DEFAULT_PORTFOLIO]
+    with PORTFOLIO_NAMES_LOCK:
+        cached = PORTFOLIO_NAMES_CACHE.get(directory)
+    if cached and cached[0] == mtime:
+        return list(cached[1])
+
+    names = []
+    try:
+        for filename in os.listdir(directory):
+            name, ext = os.path.splitext(filename)
+            if ext == '.json' and name != DEFAULT_PORTFOLIO and PORTFOLIO_NAME_PATTERN.match(name):
+                names.append(name)
+    except FileNotFoundError:
+        pass
+    result = [DEFAULT_PORTFOLIO] + sorted(names)
+    with PORTFOLIO_NAMES_LOCK:
+        PORTFOLIO_NAMES_CACHE[directory] = (mtime, result)
+    return list(result)
+
+def create_portfolio(name):
+    """建立空的具名投資組合，名稱不合法或已存在時拋出 ValueError"""
+    if not PORTFOLIO_NAME_PATTERN.match(name or ''):
+        raise ValueError("Invalid portfolio name. Use 1-32 letters, digits, '-' or '_'.")
+    if name in list_portfolios():
+        raise ValueError(f"Portfolio already exists: {name}")
+    get_portfolio_store(name).save([])
+    invalidate_portfolio_names()
+
+def resolve_portfolio_name():
+    """從 query string 或 JSON body 的 'portfolio' 取得目前請求的投資組合名稱"""
+    name = request.args.get('portfolio')
+    if not name:
+        body = request.get_json(silent=True)
+        name = body.get('portfolio') if isinstance(body, dict) else None
+    name = name or DEFAULT_PORTFOLIO
+    if name not in list_portfolios():
+        raise PortfolioNotFound(name)
+    return name
+
+def fetch_quotes_for_portfolios(names):
+    """
+    (新) 取得多個投資組合的持股快照，並以所有 ticker 的聯集只抓一次報價。
+    上游負載只跟不重複的 ticker 數量有關，與投資組合數量無關。
+    回傳 ({name: (持股, tickers)}, 報價)
+    """
+    snapshots = {name: get_portfolio_store(name).snapshot() for name in names}
+    all_tickers = list(dict.fromkeys(ticker for _, tickers in snapshots.values() for ticker in tickers))
+    live_data = get_current_prices(all_tickers) if all_tickers else {}
+    return snapshots, live_data
+
+PORTFOLIO_STORE = get_portfolio_store(DEFAULT_PORTFOLIO)
+
+def load_portfolio():
+    # (修改) 改由記憶體快取提供，檔案未變動時不會重新解析
+    return PORTFOLIO_STORE.load()
+
+def save_portfolio(portfolio):
+    # (修改) 原子寫入到配置中指定的文件路徑
+    try:
+        PORTFOLIO_STORE.save(portfolio)
+    except Exception as e:
+        print(f"Error saving portfolio: {e}")
+
+# --- (新) 向量化估值核心 ---
+CURRENCY_CODES = {"TWD": 0, "CNY": 1}
+OTHER_CURRENCY_CODE = 2
+FX_MISSING_WARNED = set() # (新) 已經提示過查無匯率的幣別，避免每次估值都印一次
+
+class Holdings:
+    """
+    (新) 以 NumPy 陣列保存持股 (股數、成本、幣別代碼)，
+    /api/portfolio、save_daily_snapshot、ask_ai 與回補共用同一份估值邏輯。
+    """
+    def __init__(self, portfolio):
+        self.stocks = portfolio
+        self.tickers = [stock['ticker'] for stock in portfolio]
+        self.currencies = [stock.get("currency", "TWD") for stock in portfolio]
+        self.shares = np.array([float(stock.get('shares', 0)) for stock in portfolio], dtype=float)
+        self.avg_cost = np.array([float(stock.get('avg_cost', 0)) for stock in portfolio], dtype=float)
+        self.currency_code = np.array(
+            [CURRENCY_CODES.get(currency, OTHER_CURRENCY_CODE) for currency in self.currencies],
+            dtype=np.int8
+        )
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def price_vector(self, prices_data, key='price'):
+        """把 {ticker: {'price': ...}} 轉成與持股順序對齊的價格向量"""
+        return np.array([prices_data.get(ticker, {}).get(key, 0) or 0 for ticker in self.tickers], dtype=float)
+
+    def fx_vector(self, fx_rates):
+        """
+        每一列換算成台幣的匯率 (fx_rates 為 {幣別: 1 單位 = ? TWD})。
+        (修改) 查無匯率的幣別不能當成台幣 (1 JPY 不等於 1 TWD)：匯率設為 0，不計入市值與總計，並記錄一次
+        """
+        if not fx_rates:
+            return np.ones(len(self.currencies))
+        missing = sorted(set(self.currencies) - set(fx_rates))
+        if missing:
+            new_missing = [currency for currency in missing if currency not in FX_MISSING_WARNED]
+            if new_missing:
+                FX_MISSING_WARNED.update(new_missing)
+                tickers = [ticker for ticker, currency in zip(self.tickers, self.currencies) if currency in new_missing]
+                print(f"[FX] No exchange rate for {', '.join(new_missing)}. Excluding {tickers} from valuation.")
+        return np.array([fx_rates.get(currency, 0.0) for currency in self.currencies], dtype=float)
+
+@timed_stage("valuation")
+def value_holdings(holdings, price, prev_close=None, fx_rates=None):
+    """
+    (新) 批次計算每一列與總計的估值。
+    price / prev_close 可以是 (n,) 的單一價格向量，
+    也可以是 (m, n) 的價格矩陣 (例如 m 個日期)，總計會沿最後一軸加總。
+    fx_rates 為 FX_SERVICE.rates_to_twd() 的匯率表，所有幣別都換算成台幣；
+    TWD / CNY 以外的持股 (USD、HKD、JPY...) 計入 other_value。
+    """
+    price = np.asarray(price, dtype=float)
+    prev_close = price if prev_close is None else np.asarray(prev_close, dtype=float)
+    shares = holdings.shares
+    fx = holdings.fx_vector(fx_rates)
+
+    market_value_original = price * shares
+    market_value_twd = market_value_original * fx
+    cost_basis_twd = holdings.avg_cost * shares * fx
+    prev_close_value_twd = prev_close * shares * fx
+    pl_twd = market_value_twd - cost_basis_twd
+    today_pl_twd = (price - prev_close) * shares * fx
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change_percent = np.where(prev_close != 0, (price - prev_close) / prev_close * 100, 0.0)
+        pl_percent = np.where(cost_basis_twd != 0, pl_twd / cost_basis_twd * 100, 0.0)
+
+    is_tw = holdings.currency_code == CURRENCY_CODES["TWD"]
+    is_cn = holdings.currency_code == CURRENCY_CODES["CNY"]
+
+    return {
+        "rows": {
+            "price": price,
+            "previous_close": prev_close,
+            "change_percent": change_percent,
+            "market_value_original": market_value_original,
+            "market_value": market_value_twd,
+            "cost_basis": cost_basis_twd,
+            "pl": pl_twd,
+            "today_pl": today_pl_twd,
+            "pl_percent": pl_percent,
+            "fx": fx
+        },
+        "totals": {
+            "market_value": market_value_twd.sum(axis=-1),
+            "cost_basis": cost_basis_twd.sum(axis=-1),
+            "today_pl": today_pl_twd.sum(axis=-1),
+            "prev_close_value": prev_close_value_twd.sum(axis=-1),
+            "tw_value": np.where(is_tw, market_value_twd, 0.0).sum(axis=-1),
+            "cn_value": np.where(is_cn, market_value_twd, 0.0).sum(axis=-1),
+            "other_value": np.where(is_tw | is_cn, 0.0, market_value_twd).sum(axis=-1)
+        }
+    }
+
+# --- (修改) 移除 load_history 和 save_history ---
+
+# (新) 資料表結構 (init_db.py 之外，App 啟動後第一次連線也會自動補建)
+DB_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS daily_history (
+        date TEXT PRIMARY KEY,
+        total REAL NOT NULL,
+        tw_value REAL,
+        cn_value REAL
+    )
+    ''',
+    # (新) 每支股票的每日 OHLCV，作為本地價格庫
+    '''
+    CREATE TABLE IF NOT EXISTS price_history (
+        ticker TEXT NOT NULL,
+        date TEXT NOT NULL,
+        open REAL,
+        high REAL,
+        low REAL,
+        close REAL,
+        volume INTEGER,
+        PRIMARY KEY (ticker, date)
+    )
+    ''',
+    # (新) 記錄每支股票已同步的日期區間 (休市日沒有資料列，只靠資料列無法判斷缺口)
+    '''
+    CREATE TABLE IF NOT EXISTS price_sync_log (
+        ticker TEXT PRIMARY KEY,
+        synced_start TEXT NOT NULL,
+        synced_end TEXT NOT NULL
+    )
+    ''',
+    # (新) 月/年彙總 (period: 'YYYY-MM' 或 'YYYY')，由寫入與刪除 daily_history 時同步維護
+    '''
+    CREATE TABLE IF NOT EXISTS history_aggregates (
+        period TEXT PRIMARY KEY,
+        period_type TEXT NOT NULL,
+        first_date TEXT NOT NULL,
+        first_total REAL NOT NULL,
+        last_date TEXT NOT NULL,
+        last_total REAL NOT NULL,
+        min_total REAL NOT NULL,
+        max_total REAL NOT NULL,
+        days INTEGER NOT NULL
+    )
+    ''',
+    # (新) 股票基本資料快取 (名稱、交易所、幣別、產業)，由背景執行緒從 yfinance 補齊
+    '''
+    CREATE TABLE IF NOT EXISTS ticker_metadata (
+        ticker TEXT PRIMARY KEY,
+        name TEXT,
+        exchange TEXT,
+        currency TEXT,
+        sector TEXT,
+        updated_at TEXT NOT NULL
+    )
+    '''
+]
+_schema_ready = set()
+_schema_lock = Lock()
+
+def ensure_db_schema(conn, db_path):
+    if db_path in _schema_ready:
+        return
+    with _schema_lock:
+        if db_path in _schema_ready:
+            return
+        for statement in DB_SCHEMA:
+            conn.execute(statement)
+        # (新) 既有的資料庫第一次升級時，補建月/年彙總
+        has_aggregates = conn.execute("SELECT 1 FROM history_aggregates LIMIT 1").fetchone()
+        has_history = conn.execute("SELECT 1 FROM daily_history LIMIT 1").fetchone()
+        if has_history and not has_aggregates:
+            rebuild_history_aggregates(conn)
+        conn.commit()
+        _schema_ready.add(db_path)
+
+# --- (新) 歷史資料版本計數器 ---
+# 每次 daily_history 寫入/刪除並 commit 之後遞增，供衍生資料 (例如 AI context) 判斷快取是否過期
+HISTORY_DATA_VERSIONS = {}  # 資料庫路徑 -> 版本
+HISTORY_DATA_VERSIONS_LOCK = Lock()
+
+# (修改) 多 worker 時版本存在 SHARED_STATE，任何 worker 寫入後其他 worker 的快取也會失效
+def bump_history_version(portfolio=DEFAULT_PORTFOLIO):
+    db_path = get_history_db(portfolio)
+    if SHARED_STATE.enabled:
+        SHARED_STATE.increment(f"history_version:{db_path}")
+        return
+    with HISTORY_DATA_VERSIONS_LOCK:
+        HISTORY_DATA_VERSIONS[db_path] = HISTORY_DATA_VERSIONS.get(db_path, 0) + 1
+
+def get_history_version(portfolio=DEFAULT_PORTFOLIO):
+    db_path = get_history_db(portfolio)
+    if SHARED_STATE.enabled:
+        return SHARED_STATE.get(f"history_version:{db_path}", 0)
+    with HISTORY_DATA_VERSIONS_LOCK:
+        return HISTORY_DATA_VERSIONS.get(db_path, 0)
+
+# --- (新) 月/年彙總維護 ---
+def _month_bounds(month):
+    """'2025-10' -> ('2025-10-01', '2025-11-01')"""
+    year, mon = int(month[:4]), int(month[5:7])
+    next_year, next_mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return f"{year:04d}-{mon:02d}-01", f"{next_year:04d}-{next_mon:02d}-01"
+
+def refresh_history_aggregates(conn, date_strs):
+    """
+    (新) 重新計算受影響日期所屬的月份與年份彙總。
+    月份彙總直接以日期範圍 (走主鍵索引) 查詢 daily_history，
+    年份彙總再由該年的月份彙總 (最多 12 列) 合併而成。
+    呼叫端負責 commit。
+    """
+    months = sorted(set(d[:7] for d in date_strs))
+    for month in months:
+        start, end = _month_bounds(month)
+        stats = conn.execute(
+            "SELECT COUNT(*), MIN(total), MAX(total) FROM daily_history WHERE date >= ? AND date < ?",
+            (start, end)
+        ).fetchone()
+        if stats[0] == 0:
+            conn.execute("DELETE FROM history_aggregates WHERE period = ?", (month,))
+            continue
+        first = conn.execute(
+            "SELECT date, total FROM daily_history WHERE date >= ? AND date < ? ORDER BY date ASC LIMIT 1",
+            (start, end)
+        ).fetchone()
+        last = conn.execute(
+            "SELECT date, total FROM daily_history WHERE date >= ? AND date < ? ORDER BY date DESC LIMIT 1",
+            (start, end)
+        ).fetchone()
+        conn.execute(
+            "INSERT OR REPLACE INTO history_aggregates "
+            "(period, period_type, first_date, first_total, last_date, last_total, min_total, max_total, days) "
+            "VALUES (?, 'month', ?, ?, ?, ?, ?, ?, ?)",
+            (month, first[0], first[1], last[0], last[1], stats[1], stats[2], stats[0])
+        )
+
+    for year in sorted(set(m[:4] for m in months)):
+        month_rows = conn.execute(
+            "SELECT first_date, first_total, last_date, last_total, min_total, max_total, days "
+            "FROM history_aggregates WHERE period_type = 'month' AND period >= ? AND period <= ? ORDER BY period ASC",
+            (f"{year}-01", f"{year}-12")
+        ).fetchall()
+        if not month_rows:
+            conn.execute("DELETE FROM history_aggregates WHERE period = ?", (year,))
+            continue
+        conn.execute(
+            "INSERT OR REPLACE INTO history_aggregates "
+            "(period, period_type, first_date, first_total, last_date, last_total, min_total, max_total, days) "
+            "VALUES (?, 'year', ?, ?, ?, ?, ?, ?, ?)",
+            (
+                year,
+                month_rows[0][0], month_rows[0][1],
+                month_rows[-1][2], month_rows[-1][3],
+                min(row[4] for row in month_rows),
+                max(row[5] for row in month_rows),
+                sum(row[6] for row in month_rows)
+            )
+        )
+
+def rebuild_history_aggregates(conn):
+    """(新) 從 daily_history 全部重建月/年彙總"""
+    conn.execute("DELETE FROM history_aggregates")
+    months = [row[0] for row in conn.execute("SELECT DISTINCT substr(date, 1, 7) FROM daily_history")]
+    refresh_history_aggregates(conn, months)
+
+# --- (新) SQLite 連線管理 (每個資料庫一個連線池 + WAL) ---
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",        # 讀取端不會被回補的寫入端擋住
+    "PRAGMA synchronous=NORMAL",      # WAL 模式下 NORMAL 已足夠安全
+    "PRAGMA cache_size=-16000",       # 約 16MB page cache
+    "PRAGMA mmap_size=268435456",     # 256MB memory-mapped I/O
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000"        # 寫入衝突時最多等待 5 秒
+]
+SQLITE_CACHED_STATEMENTS = 256
+SQLITE_POOL_SIZE = 8 # 每個資料庫最多保留的閒置連線數
+
+DB_POOLS = {} # db_path -> 閒置連線的 queue
+DB_POOLS_LOCK = Lock()
+DB_POOL_STATS = {"opened": 0, "reused": 0, "discarded": 0}
+DB_POOL_STATS_LOCK = Lock()
+
+def _count_db_pool(stat):
+    with DB_POOL_STATS_LOCK:
+        DB_POOL_STATS[stat] += 1
+
+def _get_db_pool(db_path):
+    with DB_POOLS_LOCK:
+        pool = DB_POOLS.get(db_path)
+        if pool is None:
+            pool = DB_POOLS[db_path] = queue.LifoQueue(maxsize=app.config.get('SQLITE_POOL_SIZE', SQLITE_POOL_SIZE))
+        return pool
+
+class PooledConnection:
+    """
+    (新) 從連線池借出的 sqlite3 連線。
+    呼叫端沿用原本的 get_db_conn() ... conn.close() 寫法，
+    close() 會回滾未提交的交易並把連線還給連線池 (池已滿時才真正關閉)，之後不可再使用。
+    """
+    def __init__(self, conn, pool):
+        self._conn = conn
+        self._pool = pool
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._conn, name)
+
+    # (新) 查詢一律經過 TimedCursor，耗時計入 db 指標
+    def cursor(self):
+        return TimedCursor(self._conn.cursor())
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            conn.close()
+            _count_db_pool("discarded")
+
+def _statement_kind(sql):
+    words = sql.split(None, 1)
+    kind = words[0].lower() if words else ""
+    return kind if kind in DB_STATEMENT_KINDS else "other"
 
-def get_portfolio_file():
-    """獲取portfolio文件路徑"""
-    return app.config.get('PORTFOLIO_FILE', PORTFOLIO_FILE)
+class TimedCursor:
+    """(新) 包裝 sqlite3 cursor：execute 依語句種類 (select/insert/...) 計時，fetch 另外計時"""
+    def __init__(self, cursor):
+        self._cursor = cursor
 
-def get_history_db():
-    """獲取歷史數據庫文件路徑"""
-    return app.config.get('HISTORY_DB', HISTORY_DB)
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
 
-def get_current_prices(tickers):
-    """
-    (已修改) 三路混合：獲取即時價格
-    - .TW 股票: 優先使用 get_mis_tw_prices
-    - .SS/.SZ 股票: 優先使用 get_sina_current_prices
-    - 其他股票 (及備援): 使用 get_yfinance_current_prices
-    """
-    if not tickers:
-        return {}
-    
-    print(f"\n[Hybrid Prices] Fetching: {' '.join(tickers)}")
-    
-    # 1. 分離 Tickers
-    tw_tickers = [t for t in tickers if t.endswith('.TW') or t.endswith('.TWO')] # (修改)
-    china_tickers = [t for t in tickers if t.endswith('.SS') or t.endswith('.SZ')]
-    yfinance_tickers = [t for t in tickers if 
-                        not t.endswith('.TW') and 
-                        not t.endswith('.TWO') and
-                        not t.endswith('.SS') and 
-                        not t.endswith('.SZ')]
-    
-    all_stock_data = {}
-    
-    # 2. 抓取 .TW 股票 (使用 MIS API)
-    if tw_tickers:
-        mis_data = get_mis_tw_prices(tw_tickers)
-        # (新) 注入來源標籤
-        for ticker, data in mis_data.items():
-            data['source'] = 'MIS'
-        all_stock_data.update(mis_data)
-        
-        failed_tw_tickers = [t for t in tw_tickers if t not in mis_data]
-        if failed_tw_tickers:
-            print(f"[Hybrid Prices] MIS API failed for: {failed_tw_tickers}. Adding to yfinance fallback.")
-            yfinance_tickers.extend(failed_tw_tickers) 
+    def __iter__(self):
+        return iter(self._cursor)
 
-    # 3. 抓取陸股 (使用 Sina)
-    if china_tickers:
-        print(f"[Hybrid Prices] Fetching {len(china_tickers)} China stocks via Sina...")
-        sina_data = get_sina_current_prices(china_tickers)
-        # (新) 注入來源標籤
-        for ticker, data in sina_data.items():
-            data['source'] = 'Sina'
-        all_stock_data.update(sina_data)
-        
-        failed_sina_tickers = [t for t in china_tickers if t not in sina_data]
-        if failed_sina_tickers:
-            print(f"[Hybrid Prices] Sina failed for: {failed_sina_tickers}. Adding to yfinance fallback.")
-            yfinance_tickers.extend(failed_sina_tickers) 
+    def execute(self, sql, parameters=()):
+        with track_stage("db", _statement_kind(sql)):
+            self._cursor.execute(sql, parameters)
+        return self
 
-    # 4. 抓取其他股票 (及抓取失敗的) (使用 yfinance)
-    if yfinance_tickers:
-        print(f"[Hybrid Prices] Fetching {len(yfinance_tickers)} stocks via yfinance...")
-        yfinance_data = get_yfinance_current_prices(yfinance_tickers)
-        # (新) 注入來源標籤
-        for ticker, data in yfinance_data.items():
-            data['source'] = 'yfinance'
-        all_stock_data.update(yfinance_data)
-        
-    # 5. 最終檢查 (不變)
-    for ticker in tickers:
-        if ticker not in all_stock_data:
-            print(f"Warning: No price data found for {ticker} from any source.")
-            # (新) 標記來源為 N/A
-            all_stock_data[ticker] = {"price": 0, "previous_close": 0, "source": "N/A"}
+    def executemany(self, sql, seq_of_parameters):
+        with track_stage("db", _statement_kind(sql)):
+            self._cursor.executemany(sql, seq_of_parameters)
+        return self
 
-    return all_stock_data
+    def fetchone(self):
+        with track_stage("db", "fetch"):
+            return self._cursor.fetchone()
 
-# --- (匯率、load/save portfolio 函式... 保持不變) ---
-cny_rate_cache = {"rate": None, "timestamp": 0}
-CACHE_DURATION_SECONDS = 60 
+    def fetchmany(self, size=None):
+        with track_stage("db", "fetch"):
+            return self._cursor.fetchmany(size if size is not None else self._cursor.arraysize)
 
-def get_cny_to_twd_rate():
-    global cny_rate_cache
-    now = timestamp()
-    # 檢查快取是否有效
-    if cny_rate_cache["rate"] and (now - cny_rate_cache["timestamp"] < CACHE_DURATION_SECONDS):
-        return cny_rate_cache["rate"]
-    try:
-        print("Fetching new CNY to TWD exchange rate...")
-        response = requests.get('https://open.er-api.com/v6/latest/CNY')
-        response.raise_for_status() 
-        rate = response.json()['rates']['TWD']
-        cny_rate_cache["rate"] = rate
-        cny_rate_cache["timestamp"] = now
-        print(f"New CNY Rate: {rate}")
-        return rate
-    except Exception as e:
-        print(f"Error fetching exchange rate: {e}")
-        # [修改點 2] 將備用值從 4.6 改為 4.4 (更接近現價，以免 API 失敗時數字跳動太大)
-        return cny_rate_cache["rate"] if cny_rate_cache["rate"] else 4.4
+    def fetchall(self):
+        with track_stage("db", "fetch"):
+            return self._cursor.fetchall()
 
-def load_portfolio():
-    # (修改) 從配置中獲取文件路徑
+def _open_sqlite_conn(db_path):
+    # 連線會在不同執行緒間借還 (同一時間只有一個使用者)，因此關閉 check_same_thread
+    conn = sqlite3.connect(db_path, cached_statements=SQLITE_CACHED_STATEMENTS, check_same_thread=False)
     try:
-        with open(get_portfolio_file(), 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
+        conn.row_factory = sqlite3.Row # (讓回傳結果可以用欄位名稱存取)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        ensure_db_schema(conn, db_path)
+    except Exception:
+        conn.close()
+        raise
+    return conn
 
-def save_portfolio(portfolio):
-    # (修改) 儲存到配置中指定的文件路徑
+# (修改) DB 連線輔助函式：優先從該資料庫的連線池借出閒置連線，沒有才開新連線
+def get_db_conn(portfolio=DEFAULT_PORTFOLIO):
+    db_path = get_history_db(portfolio)
+    pool = _get_db_pool(db_path)
     try:
-        with open(get_portfolio_file(), 'w', encoding='utf-8') as f:
-            json.dump(portfolio, f, indent=2, ensure_ascii=False)
-    except Exception as e:
-        print(f"Error saving portfolio: {e}")
-
-# --- (修改) 移除 load_history 和 save_history ---
-
-# (新) DB 連線輔助函式
-def get_db_conn():
-    conn = sqlite3.connect(get_history_db())
-    conn.row_factory = sqlite3.Row # (讓回傳結果可以用欄位名稱存取)
-    return conn
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_sqlite_conn(db_path)
+        _count_db_pool("opened")
+    else:
+        _count_db_pool("reused")
+    return PooledConnection(conn, pool)
 
-def get_previous_day_data(target_date):
+def get_previous_day_data(target_date, portfolio=DEFAULT_PORTFOLIO):
     """
     獲取指定日期前一天的資料
     """
     try:
-        conn = get_db_conn()
+        conn = get_db_conn(portfolio)
         cursor = conn.cursor()
         
         # 查找早於目標日期的最後一筆資料
@@ -221,7 +2046,7 @@ def get_mis_tw_prices(tickers):
     if not tickers:
         return {}
 
-    base_url = "http://mis.twse.com.tw/stock/api/getStockInfo.jsp"
+    base_url = get_upstream_url('mis')
     
     query_parts = []
     # (新) 建立一個 '查詢代碼' (e.g., '00679B') 到 '原始YF Ticker' (e.g., '00679B.TWO') 的映射
@@ -264,7 +2089,7 @@ def get_mis_tw_prices(tickers):
     stock_data = {}
     try:
         print(f"[MIS API] Fetching {len(tickers)} TW/TWO stocks...")
-        res = requests.get(base_url, params=params, timeout=5)
+        res = HTTP_CLIENT.get('mis', base_url, params=params)
         res.raise_for_status()
         data = res.json()
 
@@ -362,6 +2187,8 @@ def get_mis_tw_prices(tickers):
         print(f"[MIS API] Success. Found {len(stock_data)} stocks.")
         return stock_data
 
+    except RateLimitExceeded:
+        raise # (新) 交給 call_quote_provider 處理，不算來源失敗
     except Exception as e:
         print(f"[MIS API] Request failed: {e}. Will fall back to yfinance.")
         return {}
@@ -402,12 +2229,12 @@ def get_sina_current_prices(tickers):
         return {}
 
     # 2. 建立批次 API 請求
-    api_url = f"http://hq.sinajs.cn/list={','.join(sina_symbols)}"
+    api_url = f"{get_upstream_url('sina')}{','.join(sina_symbols)}"
     headers = {'Referer': 'http://finance.sina.com.cn/'}
     print(f"[Sina] Fetching: {api_url}")
 
     try:
-        res = requests.get(api_url, headers=headers, timeout=5)
+        res = HTTP_CLIENT.get('sina', api_url, headers=headers)
         res.raise_for_status()
         raw_text = res.text
         
@@ -446,6 +2273,8 @@ def get_sina_current_prices(tickers):
                         "price": float(prev_close),
                         "previous_close": float(prev_close)
                     }
+    except RateLimitExceeded:
+        raise # (新) 交給 call_quote_provider 處理，不算來源失敗
     except Exception as e:
         print(f"Error [Sina] processing request: {e}")
         # 發生錯誤時回傳空 dict，主控函式會改用 yfinance 備援
@@ -469,6 +2298,8 @@ def get_yfinance_current_prices(tickers):
 
             # --- 步驟 1: 優先獲取 "昨日收盤價" (來源: history) ---
             # 這是最可靠的昨收來源
+            # (修改) 每次呼叫 Yahoo 前各取一個限流額度 (history 與 fast_info 各一次)
+            RATE_LIMITER.acquire('yahoo', timeout=RATE_LIMIT_LIVE_TIMEOUT_SECONDS)
             try:
                 hist = ticker_obj.history(period='5d')
                 if not hist.empty:
@@ -484,6 +2315,7 @@ def get_yfinance_current_prices(tickers):
 
             # --- 步驟 2: 優先獲取 "目前市價" (來源: fast_info) ---
             # 這是最快的即時價來源
+            RATE_LIMITER.acquire('yahoo', timeout=RATE_LIMIT_LIVE_TIMEOUT_SECONDS)
             try:
                 info = ticker_obj.fast_info
                 price = info.get('last_price', info.get('regularMarketPrice'))
@@ -519,6 +2351,15 @@ def get_yfinance_current_prices(tickers):
                 "price": float(price), 
                 "previous_close": float(prev_close)
             }
+
+        except RateLimitExceeded as e:
+            # (修改) 額度用完：不要當成價格 0 存起來，剩下的股票也不再等待，讓呼叫端照缺資料處理 (N/A)。
+            # 一支都沒抓到時往外拋，call_quote_provider 不會把它算成 yfinance 失敗
+            if not stock_data:
+                raise
+            skipped = [t for t in tickers if t not in stock_data]
+            print(f"[yfinance] {e}. Skipping: {skipped}")
+            break
         
         except Exception as e:
             print(f"Error [yfinance price] processing {ticker_str}: {e}")
@@ -528,62 +2369,218 @@ def get_yfinance_current_prices(tickers):
                 
     return stock_data
 
+# --- (新) 本地每日價格庫 (price_history) ---
+PRICE_SYNC_LOCK = Lock()
+PRICE_SYNC_SETTLE_DAYS = 3  # 最近幾天的收盤價可能還會被 Yahoo 修正，不標記為已同步
+
+def _load_price_sync_log(conn, tickers):
+    """回傳 {ticker: (synced_start, synced_end)}"""
+    placeholders = ','.join('?' * len(tickers))
+    return {
+        row['ticker']: (
+            datetime.strptime(row['synced_start'], '%Y-%m-%d').date(),
+            datetime.strptime(row['synced_end'], '%Y-%m-%d').date()
+        )
+        for row in conn.execute(
+            f"SELECT ticker, synced_start, synced_end FROM price_sync_log WHERE ticker IN ({placeholders})",
+            list(tickers)
+        )
+    }
+
+def _split_download_by_ticker(hist_data, tickers):
+    """
+    (新) 把 yf.download 的結果拆成 {ticker: DataFrame(OHLCV)}，
+    同時處理單一股票與多股票 (MultiIndex) 兩種回傳結構
+    """
+    frames = {}
+    if hist_data is None or hist_data.empty:
+        return frames
+    if isinstance(hist_data.columns, pd.MultiIndex):
+        available = set(hist_data.columns.get_level_values(0))
+        for ticker in tickers:
+            if ticker in available:
+                frames[ticker] = hist_data[ticker]
+    elif len(tickers) == 1:
+        frames[tickers[0]] = hist_data
+    return frames
+
+def _store_price_rows(conn, ticker, frame):
+    rows = []
+    for index_value, open_, high, low, close, volume in zip(
+            frame.index, frame.get('Open', pd.Series(np.nan, index=frame.index)),
+            frame.get('High', pd.Series(np.nan, index=frame.index)),
+            frame.get('Low', pd.Series(np.nan, index=frame.index)),
+            frame['Close'],
+            frame.get('Volume', pd.Series(np.nan, index=frame.index))):
+        if pd.isna(close) or close <= 0:
+            continue
+        rows.append((
+            ticker, pd.Timestamp(index_value).strftime('%Y-%m-%d'),
+            None if pd.isna(open_) else float(open_),
+            None if pd.isna(high) else float(high),
+            None if pd.isna(low) else float(low),
+            float(close),
+            None if pd.isna(volume) else int(volume)
+        ))
+    conn.executemany(
+        "INSERT OR REPLACE INTO price_history (ticker, date, open, high, low, close, volume) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    return len(rows)
+
+@timed_stage("provider", "yfinance_history")
+def sync_price_history(tickers, start_date, end_date):
+    """
+    (新) 增量同步：只向 Yahoo 下載每支股票在 price_history 中還沒有的日期區間。
+    - 已同步區間記錄在 price_sync_log，休市日不會被重複下載
+    - 最近 PRICE_SYNC_SETTLE_DAYS 天的價格可能還會修正，永遠不會被標記為已同步
+    - 只有真的下載到資料的股票才會延伸已同步區間 (yfinance 失敗時通常回傳空的 DataFrame 而不是拋出例外)
+    - 缺口相同的股票合併為一次 yf.download
+    (修改) 下載在 PRICE_SYNC_LOCK 之外進行，鎖只保護寫入價格與更新 price_sync_log
+    """
+    if not tickers or start_date > end_date:
+        return 0
+
+    last_final_date = datetime.now().date() - timedelta(days=PRICE_SYNC_SETTLE_DAYS)
+
+    conn = get_db_conn()
+    try:
+        synced = _load_price_sync_log(conn, tickers)
+    finally:
+        conn.close()
+
+    # 找出每支股票缺少的區間，並依區間分組
+    gaps = {}
+    for ticker in tickers:
+        if ticker in synced:
+            synced_start, synced_end = synced[ticker]
+            ticker_gaps = []
+            if start_date < synced_start:
+                ticker_gaps.append((start_date, synced_start - timedelta(days=1)))
+            if end_date > synced_end:
+                # 從已同步區間的尾端接續，讓已同步區間保持連續
+                ticker_gaps.append((synced_end + timedelta(days=1), end_date))
+        else:
+            ticker_gaps = [(start_date, end_date)]
+        for gap in ticker_gaps:
+            gaps.setdefault(gap, []).append(ticker)
+
+    stored = 0
+    for (gap_start, gap_end), gap_tickers in gaps.items():
+        print(f"[Price Store] Syncing {gap_start} ~ {gap_end} for: {' '.join(gap_tickers)}")
+        try:
+            RATE_LIMITER.acquire('yahoo')
+            hist_data = yf.download(
+                ' '.join(gap_tickers),
+                start=gap_start,
+                end=gap_end + timedelta(days=1),
+                interval="1d",
+                group_by='ticker',
+                progress=False # 關閉下載進度條
+            )
+        except Exception as e:
+            print(f"[Price Store] yf.download FAILED: {e}")
+            continue
+
+        frames = _split_download_by_ticker(hist_data, gap_tickers)
+        with PRICE_SYNC_LOCK:
+            conn = get_db_conn()
+            try:
+                # 下載期間其他執行緒可能已經更新過，重新讀取後再合併
+                current = _load_price_sync_log(conn, gap_tickers)
+                empty_tickers = []
+                for ticker in gap_tickers:
+                    rows = 0
+                    if ticker in frames and 'Close' in frames[ticker]:
+                        rows = _store_price_rows(conn, ticker, frames[ticker])
+                    if not rows:
+                        empty_tickers.append(ticker)
+                        continue
+                    stored += rows
+
+                    # 更新已同步區間 (不包含最近還會變動的幾天)
+                    old_start, old_end = current.get(ticker, (gap_start, gap_start - timedelta(days=1)))
+                    new_start = min(old_start, gap_start)
+                    new_end = max(old_end, min(gap_end, last_final_date))
+                    if new_end >= new_start:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO price_sync_log (ticker, synced_start, synced_end) VALUES (?, ?, ?)",
+                            (ticker, new_start.strftime('%Y-%m-%d'), new_end.strftime('%Y-%m-%d'))
+                        )
+                conn.commit()
+            finally:
+                conn.close()
+        if empty_tickers:
+            print(f"[Price Store] No rows for {' '.join(empty_tickers)} ({gap_start} ~ {gap_end}). Will retry next time.")
+
+    if gaps:
+        print(f"[Price Store] Stored {stored} rows.")
+    return stored
+
+def load_close_matrix(tickers, start_date, end_date):
+    """
+    (新) 從 price_history 讀取收盤價，回傳 DataFrame (index = date, columns = tickers)
+    """
+    if not tickers:
+        return pd.DataFrame()
+    placeholders = ','.join('?' * len(tickers))
+    conn = get_db_conn()
+    try:
+        rows = conn.execute(
+            f"SELECT ticker, date, close FROM price_history WHERE ticker IN ({placeholders}) AND date >= ? AND date <= ?",
+            list(tickers) + [start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')]
+        ).fetchall()
+    finally:
+        conn.close()
+
+    if not rows:
+        return pd.DataFrame(columns=tickers, dtype=float)
+    frame = pd.DataFrame([tuple(row) for row in rows], columns=['ticker', 'date', 'close'])
+    matrix = frame.pivot(index='date', columns='ticker', values='close').reindex(columns=tickers)
+    matrix.index = [datetime.strptime(d, '%Y-%m-%d').date() for d in matrix.index]
+    return matrix.sort_index()
+
+def load_price_history(ticker, start_date, end_date):
+    """
+    (新) 從 price_history 讀取單一股票的 OHLCV，回傳依日期排序的 sqlite3.Row 清單
+    """
+    conn = get_db_conn()
+    try:
+        return conn.execute(
+            "SELECT date, open, high, low, close, volume FROM price_history "
+            "WHERE ticker = ? AND date >= ? AND date <= ? ORDER BY date ASC",
+            (ticker, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+        ).fetchall()
+    finally:
+        conn.close()
+
 def get_yfinance_prices_for_date(tickers, target_date):
     """
     (已更名) 這是 yfinance 的版本，作為備用
+    (修改) 先同步本地價格庫，再從 price_history 讀取；當天沒有資料時往前 14 天找最近的交易日
     """
     if not tickers:
         return {}
-    
-    # yfinance 需要一個結束日期，所以我們將目標日期加一天
-    start_date = target_date
-    end_date = target_date + timedelta(days=1)
-    
+
     print(f"[yfinance] Fetching historical prices for {target_date.strftime('%Y-%m-%d')} for tickers: {' '.join(tickers)}")
-    
-    hist_data = yf.download(
-        ' '.join(tickers),
-        start=start_date,
-        end=end_date,
-        interval="1d",
-        group_by='ticker'
-    )
-    
+
+    lookback_start = target_date - timedelta(days=14)
+    sync_price_history(tickers, lookback_start, target_date)
+    matrix = load_close_matrix(tickers, lookback_start, target_date)
+
     stock_data = {}
     for ticker in tickers:
-        try:
-            # 處理單一股票和多股票時 hist_data 的不同結構
-            if len(tickers) == 1:
-                price_series = hist_data['Close']
-            else:
-                price_series = hist_data[ticker]['Close']
-
-            price_found = False
-            if not price_series.empty:
-                # 獲取該日期的收盤價
-                price = price_series.iloc[-1]
-                if not pd.isna(price): 
-                    stock_data[ticker] = {"price": price}
-                    price_found = True
-
-            if not price_found:
-                 # 如果當天沒有資料，嘗試往前找最近的一個交易日
-                temp_end = target_date
-                temp_start = temp_end - timedelta(days=14) # 最多往前找7天
-                temp_hist = yf.download(ticker, start=temp_start, end=temp_end, interval="1d")
-                if not temp_hist.empty:
-                    price = temp_hist['Close'].iloc[-1]
-                    print(f"  -> [yfinance] {ticker} on {target_date.strftime('%Y-%m-%d')} has no data, using last valid price: {price:.2f} on {temp_hist.index[-1].strftime('%Y-%m-%d')}")
-                    stock_data[ticker] = {"price": price}
-                else:
-                    price = 0
-                    print(f"  -> [yfinance] Could not find any recent price for {ticker}")
-                    stock_data[ticker] = {"price": 0}
-
-        except Exception as e:
-            print(f"[yfinance] Error processing historical data for {ticker}: {e}")
+        series = matrix[ticker].dropna() if ticker in matrix else pd.Series(dtype=float)
+        if series.empty:
+            print(f"  -> [yfinance] Could not find any recent price for {ticker}")
             stock_data[ticker] = {"price": 0}
-            
+            continue
+        price_date = series.index[-1]
+        price = float(series.iloc[-1])
+        if price_date != target_date:
+            print(f"  -> [yfinance] {ticker} on {target_date.strftime('%Y-%m-%d')} has no data, using last valid price: {price:.2f} on {price_date.strftime('%Y-%m-%d')}")
+        stock_data[ticker] = {"price": price}
+
     return stock_data
 
 
@@ -671,7 +2668,7 @@ def get_prices_for_date(tickers, target_date):
     return stock_data
 
 # --- (修改) 儲存邏輯改為 SQL ---
-def update_history_log(snapshot_data, target_date=None):
+def update_history_log(snapshot_data, target_date=None, portfolio=DEFAULT_PORTFOLIO):
     """
     (已修改) 
     儲存 snapshot 物件到 history.db
@@ -684,7 +2681,7 @@ def update_history_log(snapshot_data, target_date=None):
               VALUES (?, ?, ?, ?) '''
               
     try:
-        conn = get_db_conn()
+        conn = get_db_conn(portfolio)
         cursor = conn.cursor()
         cursor.execute(sql, (
             date_str,
@@ -692,59 +2689,76 @@ def update_history_log(snapshot_data, target_date=None):
             snapshot_data['tw_value'],
             snapshot_data['cn_value']
         ))
+        refresh_history_aggregates(conn, [date_str])
+        conn.commit()
+        conn.close()
+        bump_history_version(portfolio)
+        print(f"Saving history snapshot for {date_str} ({portfolio}): {snapshot_data}")
+    except Exception as e:
+        print(f"Error saving history to SQLite: {e}")
+
+def update_history_log_bulk(snapshots, portfolio=DEFAULT_PORTFOLIO):
+    """
+    (新) 一次寫入多筆 snapshot (用於範圍回補)
+    snapshots: [(date, {"total": ..., "tw_value": ..., "cn_value": ...}), ...]
+    """
+    if not snapshots:
+        return
+
+    sql = ''' INSERT OR REPLACE INTO daily_history (date, total, tw_value, cn_value)
+              VALUES (?, ?, ?, ?) '''
+
+    try:
+        conn = get_db_conn(portfolio)
+        cursor = conn.cursor()
+        rows = [
+            (
+                target_date.strftime('%Y-%m-%d'),
+                snapshot_data['total'],
+                snapshot_data['tw_value'],
+                snapshot_data['cn_value']
+            )
+            for target_date, snapshot_data in snapshots
+        ]
+        cursor.executemany(sql, rows)
+        refresh_history_aggregates(conn, [row[0] for row in rows])
         conn.commit()
         conn.close()
-        print(f"Saving history snapshot for {date_str}: {snapshot_data}")
+        bump_history_version(portfolio)
+        print(f"Saving {len(snapshots)} history snapshots ({snapshots[0][0]} ~ {snapshots[-1][0]})")
     except Exception as e:
         print(f"Error saving history to SQLite: {e}")
 
+@timed_stage("job", "snapshot")
 def save_daily_snapshot():
     with app.app_context(): 
         # (重要) 建議將排程器時間改為 18:00，以確保 TWSE 資料已發布
         print(f"\n[Scheduler] Running Daily Snapshot Job... ({datetime.now()})")
-        portfolio = load_portfolio() #
-        tickers = list(set(stock['ticker'] for stock in portfolio)) #
-        if not tickers:
-            print("[Scheduler] No portfolio found. Skipping snapshot.")
-            return
-            
-        rate_cny_twd = get_cny_to_twd_rate() #
-        
         # --- *** (這就是您需要修改的地方) *** ---
         # (舊) prices_data = get_prices_for_date(tickers, datetime.now().date()) 
         # (新) 改用即時API。因為快照在15:30執行，即時價=收盤價。
-        prices_data = get_current_prices(tickers) 
+        # (修改) 所有投資組合共用一次報價抓取
+        # (修改) 寫入的市值必須用新的匯率表計算，拿不到就拋出 FxRatesUnavailable，不寫入備用匯率算出的值
+        fx_rates = FX_SERVICE.rates_for_persistence()
+        snapshots, prices_data = fetch_quotes_for_portfolios(list_portfolios())
         # --- *** (修改結束) *** ---
         
-        total_market_value_twd = 0 #
-        total_tw_value = 0 #
-        total_cn_value = 0 #
-        for stock in portfolio:
-            # ... (此函式的其餘部分 完全保持不變) ...
-            ticker = stock['ticker']
-            shares = float(stock.get('shares', 0))
-            currency = stock.get("currency", "TWD") 
+        for name, (portfolio, tickers) in snapshots.items():
+            if not tickers:
+                print(f"[Scheduler] No portfolio found for '{name}'. Skipping snapshot.")
+                continue
             
-            # 這裡的 .get('price', 0) 保持不變，因為 get_current_prices 的回傳結構是相容的
-            current_price_original = prices_data.get(ticker, {}).get('price', 0) #
+            holdings = Holdings(portfolio)
+            valuation = value_holdings(holdings, holdings.price_vector(prices_data), fx_rates=fx_rates)
+            totals = valuation["totals"]
             
-            market_value_original = current_price_original * shares
-            market_value_twd = market_value_original
-            if currency == "CNY":
-                market_value_twd *= rate_cny_twd
-            total_market_value_twd += market_value_twd
-            if currency == "TWD":
-                total_tw_value += market_value_twd
-            elif currency == "CNY":
-                total_cn_value += market_value_twd
-        
-        snapshot_data = {
-            "total": round(total_market_value_twd, 4),
-            "tw_value": round(total_tw_value, 4),
-            "cn_value": round(total_cn_value, 4)
-        }
-        
-        update_history_log(snapshot_data, datetime.now().date())
+            snapshot_data = {
+                "total": round(float(totals["market_value"]), 4),
+                "tw_value": round(float(totals["tw_value"]), 4),
+                "cn_value": round(float(totals["cn_value"]), 4)
+            }
+            
+            update_history_log(snapshot_data, datetime.now().date(), portfolio=name)
         print("[Scheduler] Snapshot job finished.")
 
 @app.route('/')
@@ -772,106 +2786,263 @@ def logout():
     session.pop('user', None)
     return redirect(url_for('login'))
 
-@app.route('/api/ask_ai', methods=['POST'])
-def ask_ai():
+# --- (新) AI 投資助理：可設定的模型端點、並行建立 context、串流回應 ---
+AI_BASE_URL = "http://192.168.1.50:7001/v1"
+AI_API_KEY = "12345678"
+AI_MODEL = "Qwen3-Coder"
+AI_WARMUP_IDLE_SECONDS = 5  # 模型連線閒置超過這個秒數就視為已關閉，下一次請求前先暖機
+AI_CONTEXT_POOL_WORKERS = 6
+AI_HISTORY_DAILY_DAYS = 31        # 最近這段期間保留每日資料，更早的資料每週只留最後一個交易日
+AI_HISTORY_LOOKBACK_DAYS = 365
+AI_CHANGE_BASE_MAX_GAP_DAYS = 10  # 漲跌幅的基準日最多可比區間起點早幾天 (涵蓋週末與春節等連假)，再早就不計算
+AI_HISTORY_CONTEXT_CACHE_MAX = 16
+AI_HISTORY_CONTEXT_CACHE = OrderedDict()  # (資料庫路徑, 歷史資料版本, 今天) -> context 字串
+AI_HISTORY_CONTEXT_CACHE_LOCK = Lock()
+AI_CONTEXT_POOL = ThreadPoolExecutor(max_workers=AI_CONTEXT_POOL_WORKERS, thread_name_prefix='ai-context')
+AI_CLIENTS = {}  # (base_url, api_key) -> OpenAI client (重複使用底層的 keep-alive 連線)
+AI_CLIENTS_LOCK = Lock()
+AI_LAST_USED = {"at": 0}
+
+def get_ai_settings():
+    """獲取模型端點設定 (app.config 的 AI_BASE_URL / AI_API_KEY / AI_MODEL 可覆寫，例如指向本地替身伺服器)"""
+    return (
+        app.config.get('AI_BASE_URL', AI_BASE_URL),
+        app.config.get('AI_API_KEY', AI_API_KEY),
+        app.config.get('AI_MODEL', AI_MODEL)
+    )
+
+def get_ai_client():
+    base_url, api_key, _ = get_ai_settings()
+    with AI_CLIENTS_LOCK:
+        client = AI_CLIENTS.get((base_url, api_key))
+        if client is None:
+            client = AI_CLIENTS[(base_url, api_key)] = OpenAI(base_url=base_url, api_key=api_key)
+        return client
+
+def _warm_up_ai_connection(client):
+    """先建立到模型伺服器的連線 (與建立 context 同時進行)，之後的 completion 請求直接重用"""
+    if timestamp() - AI_LAST_USED["at"] < AI_WARMUP_IDLE_SECONDS:
+        return
+    try:
+        client.models.list()
+    except Exception as e:
+        print(f"[AI] Connection warm-up failed: {e}")
+
+def compact_json(data):
+    """不縮排、不加空白的 JSON (prompt 越短，送出與模型處理越快)"""
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+def build_ai_portfolio_context(portfolio_name=DEFAULT_PORTFOLIO):
     """
-    接收前端問題，並呼叫 OpenAI 相容 API (使用 v1.0.0+ 語法)
-    已升級：加入 (1) 即時股價 + (2) 最近 30 天歷史資料
+    (修改) 載入 "即時" 持股資訊，回傳精簡的 JSON 字串：
+    每支持股只留必要欄位，金額四捨五入，匯率集中列在 fx_to_twd。
     """
-    data = request.json
-    user_question = data.get('question')
+    portfolio, tickers = get_portfolio_store(portfolio_name).snapshot()
+    if not portfolio:
+        return "[]"
 
-    if not user_question:
-        return jsonify({"error": "沒有收到問題"}), 400
+    live_data = get_current_prices(tickers) 
+    fx_rates = FX_SERVICE.rates_to_twd()
+    
+    holdings = Holdings(portfolio)
+    rows = value_holdings(holdings, holdings.price_vector(live_data), fx_rates=fx_rates)["rows"]
+    
+    holdings_data = [
+        {
+            "ticker": stock['ticker'], "name": stock.get('name'), "currency": currency,
+            "shares": shares, "avg_cost": avg_cost, "price": current_price,
+            "market_value_twd": round(market_value), "pl_pct": round(pl_percent, 2)
+        }
+        for stock, currency, shares, avg_cost, current_price, market_value, pl_percent in zip(
+            portfolio, holdings.currencies, holdings.shares.tolist(), holdings.avg_cost.tolist(),
+            rows["price"].tolist(), rows["market_value"].tolist(), rows["pl_percent"].tolist()
+        )
+    ]
+    foreign_currencies = sorted(set(holdings.currencies) - {"TWD"})
+    return compact_json({
+        # 查無匯率的幣別填 null (這些持股的 market_value_twd 為 0，沒有計入)
+        "fx_to_twd": {
+            currency: round(fx_rates[currency], 4) if currency in fx_rates else None
+            for currency in foreign_currencies
+        },
+        "holdings": holdings_data
+    })
 
-    try:
-        # 1. 載入 "即時" 持股資訊 (同上次)
-        portfolio = load_portfolio()
-        portfolio_str = "[]" # 預設為空
-        
-        if portfolio:
-            tickers = list(set(stock['ticker'] for stock in portfolio))
-            live_data = get_current_prices(tickers) 
-            rate_cny_twd = get_cny_to_twd_rate()    
-            
-            for stock in portfolio:
-                ticker = stock['ticker']
-                shares = float(stock.get('shares', 0))
-                avg_cost = float(stock.get('avg_cost', 0))
-                currency = stock.get("currency", "TWD")
-                ticker_data = live_data.get(ticker, {})
-                current_price = ticker_data.get('price', 0)
-                market_value = current_price * shares
-                cost_basis = avg_cost * shares
-                pl_amount = market_value - cost_basis
-                pl_percent = (pl_amount / cost_basis * 100) if cost_basis != 0 else 0
-                
-                stock['current_price'] = current_price
-                stock['estimated_market_value_orig'] = round(market_value, 2)
-                stock['estimated_pl_percent'] = f"{round(pl_percent, 2)}%"
-                
-                if currency == 'CNY':
-                    stock['note'] = f"此為人民幣計價，目前匯率約 {rate_cny_twd}"
-            
-            portfolio_str = json.dumps(portfolio, indent=2, ensure_ascii=False)
+def downsample_history(history, daily_days=AI_HISTORY_DAILY_DAYS):
+    """
+    (新) 最近 daily_days 天保留每日資料，更早的資料每週只保留最後一個交易日。
+    history 為以日期為索引、依日期排序的 DataFrame。
+    """
+    if history.empty:
+        return history, history
+    cutoff = history.index[-1] - pd.Timedelta(days=daily_days)
+    daily = history[history.index > cutoff]
+    older = history[history.index <= cutoff]
+    weekly = older.groupby(older.index.to_period('W')).tail(1)
+    return daily, weekly
 
-        # 2. (新) 載入 "歷史" 資料 (最近 30 天)
-        historical_str = "[]" # 預設為空
-        try:
-            conn = get_db_conn() # 呼叫您現有的 DB 連線函式
-            cursor = conn.cursor()
-            # (新) 查詢 DB，抓取最近 30 筆資料
-            cursor.execute("SELECT date, total, tw_value, cn_value FROM daily_history ORDER BY date DESC LIMIT 365")
-            rows = cursor.fetchall()
-            conn.close()
-            
-            if rows:
-                historical_data = [{"date": row['date'], "total": row['total'], "tw_value": row['tw_value'], "cn_value": row['cn_value']} for row in rows]
-                # 倒轉，讓日期從舊到新，方便 AI 分析趨勢
-                historical_data.reverse() 
-                historical_str = json.dumps(historical_data, indent=2, ensure_ascii=False)
+def summarize_history(history):
+    """(新) 預先計算 AI 需要的統計數字，模型不必自己從原始資料推算"""
+    totals = history["total"]
+    last_date = history.index[-1]
+    latest_total = float(totals.iloc[-1])
 
-        except Exception as e:
-            debug_print(f"[AI Error] 查詢 history.db 失敗: {e}")
-            # 即使 DB 查詢失敗，我們依然繼續，只是不傳送歷史資料
-            pass 
-
-        # 3. (新) 設定 AI 的 Prompt (包含歷史資料)
-        system_prompt = (
-            "你是一個專業的金融投資組合助理。\n"
-            "你會收到兩份 JSON 資料：\n"
-            "1. `current_portfolio`: 目前持股的即時股價與損益。\n"
-            "2. `historical_summary`: 最近 365 天的每日資產總結 (日期從舊到新)。\n"
-            "請根據這兩份資料，用你的財經知識和趨勢分析能力來回答。\n"
-            "請使用繁體中文回答。"
+    def change_since(start):
+        # 資料稀疏時，區間起點之前最近的一筆可能早已超出區間，這時不計算漲跌幅
+        base = totals[(totals.index <= start) & (totals.index >= start - pd.Timedelta(days=AI_CHANGE_BASE_MAX_GAP_DAYS))]
+        if base.empty or base.iloc[-1] == 0:
+            return None
+        return round((latest_total / float(base.iloc[-1]) - 1) * 100, 2)
+
+    drawdown = totals / totals.cummax() - 1
+    daily_returns = totals.pct_change().replace([np.inf, -np.inf], np.nan).dropna()
+    latest = history.iloc[-1].fillna(0) # tw_value / cn_value 可能是 NULL (NaN)
+    return {
+        "first_date": history.index[0].strftime('%Y-%m-%d'),
+        "last_date": last_date.strftime('%Y-%m-%d'),
+        "trading_days": int(len(history)),
+        "latest_total": round(latest_total),
+        "latest_tw_value": round(float(latest["tw_value"])),
+        "latest_cn_value": round(float(latest["cn_value"])),
+        "change_pct": {
+            "1w": change_since(last_date - pd.Timedelta(days=7)),
+            "1m": change_since(last_date - pd.Timedelta(days=30)),
+            "3m": change_since(last_date - pd.Timedelta(days=91)),
+            "ytd": change_since(pd.Timestamp(last_date.year - 1, 12, 31)),
+            "1y": change_since(last_date - pd.Timedelta(days=365))
+        },
+        "high": {"date": totals.idxmax().strftime('%Y-%m-%d'), "total": round(float(totals.max()))},
+        "low": {"date": totals.idxmin().strftime('%Y-%m-%d'), "total": round(float(totals.min()))},
+        "max_drawdown_pct": round(float(drawdown.min()) * 100, 2),
+        "daily_volatility_pct": round(float(daily_returns.std()) * 100, 2) if len(daily_returns) > 1 else None
+    }
+
+def _format_history_rows(frame):
+    frame = frame.fillna({"tw_value": 0, "cn_value": 0}) # NULL 讀進來是 NaN，NaN 為真值，不能用 `or 0`
+    return [
+        [row_date.strftime('%Y-%m-%d'), round(total), round(tw_value), round(cn_value)]
+        for row_date, total, tw_value, cn_value in zip(
+            frame.index, frame["total"].tolist(), frame["tw_value"].tolist(), frame["cn_value"].tolist()
         )
-        
-        user_prompt = f"""
+    ]
+
+def build_ai_history_context(portfolio_name=DEFAULT_PORTFOLIO):
+    """
+    (修改) 載入 "歷史" 資料 (最近 365 天)，回傳精簡的 JSON 字串：
+    統計摘要 + 最近一個月的每日資料 + 更早的每週資料。
+    結果以 (資料庫, 歷史資料版本, 今天) 快取，歷史資料沒有寫入時重複提問直接重用。
+    DB 查詢失敗時回傳空陣列。
+    """
+    cache_key = (get_history_db(portfolio_name), get_history_version(portfolio_name), datetime.now().date())
+    with AI_HISTORY_CONTEXT_CACHE_LOCK:
+        cached = AI_HISTORY_CONTEXT_CACHE.get(cache_key)
+        if cached is not None:
+            AI_HISTORY_CONTEXT_CACHE.move_to_end(cache_key)
+            return cached
+
+    try:
+        start_str = (datetime.now() - timedelta(days=AI_HISTORY_LOOKBACK_DAYS)).strftime('%Y-%m-%d')
+        conn = get_db_conn(portfolio_name) # 呼叫您現有的 DB 連線函式
+        rows = conn.execute(
+            "SELECT date, total, tw_value, cn_value FROM daily_history WHERE date >= ? ORDER BY date ASC",
+            (start_str,)
+        ).fetchall()
+        conn.close()
+    except Exception as e:
+        debug_print(f"[AI Error] 查詢 history.db 失敗: {e}")
+        # 即使 DB 查詢失敗，我們依然繼續，只是不傳送歷史資料
+        return "[]"
+
+    if not rows:
+        context = "[]"
+    else:
+        history = pd.DataFrame(
+            [tuple(row) for row in rows], columns=["date", "total", "tw_value", "cn_value"]
+        )
+        history.index = pd.to_datetime(history.pop("date"))
+        daily, weekly = downsample_history(history)
+        context = compact_json({
+            "summary": summarize_history(history),
+            "columns": ["date", "total", "tw_value", "cn_value"],
+            "weekly": _format_history_rows(weekly),
+            "daily": _format_history_rows(daily)
+        })
+
+    with AI_HISTORY_CONTEXT_CACHE_LOCK:
+        AI_HISTORY_CONTEXT_CACHE[cache_key] = context
+        while len(AI_HISTORY_CONTEXT_CACHE) > AI_HISTORY_CONTEXT_CACHE_MAX:
+            AI_HISTORY_CONTEXT_CACHE.popitem(last=False)
+    return context
+
+def build_ai_messages(user_question, portfolio_str, historical_str):
+    """設定 AI 的 Prompt (包含持股與歷史資料)"""
+    system_prompt = (
+        "你是一個專業的金融投資組合助理。\n"
+        "你會收到兩份 JSON 資料 (金額皆為新台幣)：\n"
+        "1. `current_portfolio`: 目前持股的即時股價與損益 (fx_to_twd 為外幣對台幣匯率)。\n"
+        "2. `historical_summary`: 最近 365 天的資產歷史，summary 為預先計算的統計 (漲跌幅、最高/最低、最大回撤、日波動率)，"
+        "daily 為最近一個月的每日資料，weekly 為更早期間每週最後一個交易日的資料，每列欄位依 columns 排列。\n"
+        "請根據這兩份資料，用你的財經知識和趨勢分析能力來回答。\n"
+        "請使用繁體中文回答。"
+    )
+    
+    user_prompt = f"""
         以下是我目前的持股與即時股價 (current_portfolio):
         {portfolio_str}
         
-        以下是我最近 30 天的歷史資產總結 (historical_summary):
+        以下是我最近一年的歷史資產總結 (historical_summary):
         {historical_str}
         
         我的問題是:
         {user_question}
         """
 
-        # 4. 設定 OpenAI Client (請確認您的設定)
-        client = OpenAI(
-            base_url="http://192.168.1.50:7001/v1",
-            api_key="12345678" 
-        )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def _call_in_app_context(func, *args):
+    with app.app_context():
+        return func(*args)
+
+def prepare_ai_request(user_question, portfolio_name=DEFAULT_PORTFOLIO):
+    """
+    (新) 同時進行三件事：建立持股 context、建立歷史 context、暖機模型連線。
+    回傳 (client, messages)。
+    """
+    client = get_ai_client()
+    portfolio_future = AI_CONTEXT_POOL.submit(_call_in_app_context, build_ai_portfolio_context, portfolio_name)
+    history_future = AI_CONTEXT_POOL.submit(_call_in_app_context, build_ai_history_context, portfolio_name)
+    AI_CONTEXT_POOL.submit(_warm_up_ai_connection, client)
+    messages = build_ai_messages(user_question, portfolio_future.result(), history_future.result())
+    return client, messages
+
+@app.route('/api/ask_ai', methods=['POST'])
+def ask_ai():
+    """
+    接收前端問題，並呼叫 OpenAI 相容 API (使用 v1.0.0+ 語法)
+    已升級：加入 (1) 即時股價 + (2) 最近 30 天歷史資料
+    (修改) 持股與歷史 context 並行建立；需要逐字顯示時請改用 /api/ask_ai/stream
+    """
+    data = request.json
+    user_question = data.get('question')
+
+    if not user_question:
+        return jsonify({"error": "沒有收到問題"}), 400
 
-        # 5. 呼叫 API
+    portfolio_name = resolve_portfolio_name()
+
+    try:
+        client, messages = prepare_ai_request(user_question, portfolio_name)
+
+        # 呼叫 API
         response = client.chat.completions.create(
-            model="Qwen3-Coder", 
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
+            model=get_ai_settings()[2], 
+            messages=messages,
             temperature=0.7,
         )
+        AI_LAST_USED["at"] = timestamp()
 
         ai_response = response.choices[0].message.content
         return jsonify({"response": ai_response})
@@ -880,72 +3051,180 @@ def ask_ai():
         debug_print(f"[AI Error] 呼叫 AI API 時發生錯誤: {e}") 
         return jsonify({"error": f"AI 服務連線失敗: {e}"}), 500
 
+def format_sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/ask_ai/stream', methods=['POST'])
+def ask_ai_stream():
+    """
+    (新) /api/ask_ai 的串流版本 (Server-Sent Events)：
+    - event: token  data: {"content": "..."}  模型每產生一段文字就送出
+    - event: done   data: {}                  回答結束
+    - event: error  data: {"error": "..."}    發生錯誤
+    """
+    data = request.get_json(silent=True) or {}
+    user_question = data.get('question')
+
+    if not user_question:
+        return jsonify({"error": "沒有收到問題"}), 400
+
+    portfolio_name = resolve_portfolio_name()
+    # (新) 超過串流上限時回 503，前端改呼叫非串流的 /api/ask_ai
+    if not STREAM_SLOTS.try_acquire():
+        return jsonify({"error": STREAMS_FULL_MESSAGE}), 503
+
+    def generate():
+        # 先送出註解行，讓瀏覽器立刻收到回應標頭
+        yield ": connected\n\n"
+        try:
+            client, messages = prepare_ai_request(user_question, portfolio_name)
+            stream = client.chat.completions.create(
+                model=get_ai_settings()[2],
+                messages=messages,
+                temperature=0.7,
+                stream=True,
+            )
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    yield format_sse_event("token", {"content": content})
+            yield format_sse_event("done", {})
+        except Exception as e:
+            debug_print(f"[AI Error] 呼叫 AI API 時發生錯誤: {e}")
+            yield format_sse_event("error", {"error": f"AI 服務連線失敗: {e}"})
+        finally:
+            AI_LAST_USED["at"] = timestamp()
+
+    return stream_response(stream_with_context(generate()))
+
 # --- (修改) 讀取邏輯改為 SQL ---
 @app.route('/api/portfolio', methods=['GET'])
 def get_portfolio():
-    portfolio = load_portfolio()
-    tickers = list(set(stock['ticker'] for stock in portfolio))
+    """
+    (修改) 回應附帶內容版本 ETag，內容未變時回傳 304 Not Modified。
+    - since_version (選填): 客戶端上一次拿到的版本，若伺服器仍記得該版本，
+      只回傳變動過的股票與總計 (delta)
+    - portfolio (選填): 投資組合名稱，預設 default
+    """
+    portfolio_name = resolve_portfolio_name()
+    payload = build_portfolio_payload(portfolio_name)
+    body = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    version = compute_content_version(body)
+    remember_portfolio_version(portfolio_name, version, payload)
+
+    since_version = request.args.get('since_version')
+    if since_version:
+        base_payload = get_portfolio_version(portfolio_name, since_version)
+        if base_payload is not None:
+            return jsonify(build_portfolio_delta(base_payload, payload, since_version, version))
+
+    return make_versioned_response(body, version)
+
+# --- (新) 內容版本 (ETag) 與 delta 回應 ---
+PORTFOLIO_VERSIONS_MAX = 32  # 每個投資組合記住的版本數
+PORTFOLIO_VERSIONS = OrderedDict()  # (投資組合名稱, version) -> payload (單一行程時使用)
+PORTFOLIO_VERSIONS_LOCK = Lock()
+
+def compute_content_version(body):
+    """以回應內容的雜湊作為版本號"""
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()[:20]
+
+def make_versioned_response(body, version):
+    """
+    (新) 建立帶 ETag 的 JSON 回應；If-None-Match 相符時自動轉為 304。
+    Cache-Control: no-cache 讓瀏覽器每次都帶 If-None-Match 回來驗證。
+    """
+    response = Response(body, mimetype='application/json')
+    response.set_etag(version)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def remember_portfolio_version(portfolio, version, payload):
+    """
+    (修改) 版本以 (投資組合, version) 為 key；多 worker 時存在 SHARED_STATE，
+    since_version 請求不論落在哪個 worker 都能算 delta
+    """
+    if SHARED_STATE.enabled:
+        try:
+            SHARED_STATE.remember_portfolio_version(portfolio, version, payload, PORTFOLIO_VERSIONS_MAX)
+        except Exception as e:
+            print(f"[Portfolio] Shared state write failed: {e}")
+        return
+    key = (portfolio, version)
+    with PORTFOLIO_VERSIONS_LOCK:
+        PORTFOLIO_VERSIONS[key] = payload
+        PORTFOLIO_VERSIONS.move_to_end(key)
+        # 每個投資組合各自只保留最近 PORTFOLIO_VERSIONS_MAX 個版本
+        keys = [k for k in PORTFOLIO_VERSIONS if k[0] == portfolio]
+        for old_key in keys[:-PORTFOLIO_VERSIONS_MAX]:
+            del PORTFOLIO_VERSIONS[old_key]
+
+def get_portfolio_version(portfolio, version):
+    """回傳先前記住的 payload，找不到時回傳 None (呼叫端改回完整回應)"""
+    if SHARED_STATE.enabled:
+        try:
+            return SHARED_STATE.load_portfolio_version(portfolio, version)
+        except Exception as e:
+            print(f"[Portfolio] Shared state read failed: {e}")
+            return None
+    with PORTFOLIO_VERSIONS_LOCK:
+        return PORTFOLIO_VERSIONS.get((portfolio, version))
+
+def build_portfolio_delta(base_payload, payload, base_version, version):
+    """
+    (新) 計算兩個版本之間的差異：只包含有變動的股票列與總計欄位
+    """
+    base_stocks = {stock['ticker']: stock for stock in base_payload["stocks"]}
+    current_tickers = set(stock['ticker'] for stock in payload["stocks"])
+    base_totals = base_payload["totals"]
+    totals = payload["totals"]
+    return {
+        "delta": True,
+        "base_version": base_version,
+        "version": version,
+        "stocks": [stock for stock in payload["stocks"] if base_stocks.get(stock['ticker']) != stock],
+        "removed": [ticker for ticker in base_stocks if ticker not in current_tickers],
+        "totals": {key: value for key, value in totals.items() if base_totals.get(key) != value},
+        "removed_totals": [key for key in base_totals if key not in totals]
+    }
+
+def build_portfolio_payload(portfolio_name=DEFAULT_PORTFOLIO):
+    """
+    (新) 計算 /api/portfolio 的完整回應內容 (stocks + totals)。
+    輪詢端點與 SSE 推播共用這個函式。
+    """
+    return build_portfolio_payloads([portfolio_name])[portfolio_name]
+
+def build_portfolio_payloads(portfolio_names):
+    """(新) 以同一份報價 (所有 ticker 的聯集只抓一次) 計算多個投資組合的回應內容"""
+    snapshots, live_data = fetch_quotes_for_portfolios(portfolio_names)
+    fx_rates = FX_SERVICE.rates_to_twd()
+    return {
+        name: _value_portfolio_payload(name, portfolio, tickers, live_data, fx_rates)
+        for name, (portfolio, tickers) in snapshots.items()
+    }
+
+def _value_portfolio_payload(portfolio_name, portfolio, tickers, live_data, fx_rates):
     if not tickers:
-        return jsonify({"stocks": [], "totals": {}})
-    rate_cny_twd = get_cny_to_twd_rate()
-    live_data = get_current_prices(tickers) 
-    
-    # (檢查名稱快取 - 邏輯不變)
-    need_to_save_portfolio = False
-
-    # (計算總覽 - 邏輯不變)
-    total_market_value_twd = 0
-    total_cost_basis_twd = 0
-    total_today_pl_twd = 0
-    total_prev_close_value_twd = 0 # (新) 增加一個變數來計算昨日收盤總市值
-    total_tw_value = 0
-    total_cn_value = 0
-    processed_stocks = []
-    for stock in portfolio:
-        ticker = stock['ticker']
-        shares = float(stock.get('shares', 0))
-        avg_cost = float(stock.get('avg_cost', 0))
-        currency = stock.get("currency", "TWD") 
-        stock_name = stock.get("name") 
-        ticker_data = live_data.get(ticker, {})
-        current_price_original = ticker_data.get('price', 0)
-        prev_close_original = ticker_data.get('previous_close', 0)
-        data_source = ticker_data.get('source', 'N/A') # <--- (新) 在這裡加入
-        
-        # (新) 計算昨日收盤市值 (原始貨幣)
-        prev_close_market_value_original = prev_close_original * shares
-        
-        cost_basis_original = avg_cost * shares
-        market_value_original = current_price_original * shares
-        cost_basis_twd = cost_basis_original
-        market_value_twd = market_value_original
-        
-        # (新) 計算昨日收盤市值 (台幣)
-        prev_close_market_value_twd = prev_close_market_value_original
+        return {"stocks": [], "totals": {}}
+    rate_cny_twd = fx_rates.get("CNY")
+    
+    # (修改) 使用向量化估值核心一次算完所有列與總計
+    holdings = Holdings(portfolio)
+    valuation = value_holdings(
+        holdings,
+        holdings.price_vector(live_data, 'price'),
+        holdings.price_vector(live_data, 'previous_close'),
+        fx_rates
+    )
+    rows = valuation["rows"]
+    totals = valuation["totals"]
 
-        if currency == "CNY":
-            cost_basis_twd *= rate_cny_twd
-            market_value_twd *= rate_cny_twd
-            prev_close_market_value_twd *= rate_cny_twd # (新) 同樣要乘上匯率
-            
-        pl_twd = market_value_twd - cost_basis_twd
-        today_pl_original = (current_price_original - prev_close_original) * shares
-        today_pl_twd = today_pl_original
-        if currency == "CNY":
-            today_pl_twd *= rate_cny_twd
-        total_market_value_twd += market_value_twd
-        total_cost_basis_twd += cost_basis_twd
-        total_today_pl_twd += today_pl_twd
-        total_prev_close_value_twd += prev_close_market_value_twd # (新) 累加昨日收盤總市值
-        if currency == "TWD":
-            total_tw_value += market_value_twd
-        elif currency == "CNY":
-            total_cn_value += market_value_twd
-        # 計算漲幅百分比
-        change_percent = ((current_price_original - prev_close_original) / prev_close_original) * 100 if prev_close_original != 0 else 0
-        
-        processed_stocks.append({
-            "ticker": ticker, "name": stock_name, "currency": currency,
+    processed_stocks = [
+        {
+            "ticker": stock['ticker'], "name": stock.get("name"), "currency": currency,
             "shares": shares, "avg_cost": avg_cost,
             "current_price": current_price_original,
             "previous_close": prev_close_original,
@@ -953,9 +3232,25 @@ def get_portfolio():
             "market_value": market_value_twd,
             "pl": pl_twd,
             "today_pl": today_pl_twd,
-            "pl_percent": (pl_twd / cost_basis_twd) * 100 if cost_basis_twd != 0 else 0,
-            "data_source": data_source # <--- (新) 在這裡加入
-        })
+            "pl_percent": pl_percent,
+            "data_source": live_data.get(stock['ticker'], {}).get('source', 'N/A')
+        }
+        for stock, currency, shares, avg_cost, current_price_original, prev_close_original,
+            change_percent, market_value_twd, pl_twd, today_pl_twd, pl_percent in zip(
+            portfolio, holdings.currencies, holdings.shares.tolist(), holdings.avg_cost.tolist(),
+            rows["price"].tolist(), rows["previous_close"].tolist(), rows["change_percent"].tolist(),
+            rows["market_value"].tolist(), rows["pl"].tolist(), rows["today_pl"].tolist(),
+            rows["pl_percent"].tolist()
+        )
+    ]
+
+    total_market_value_twd = float(totals["market_value"])
+    total_cost_basis_twd = float(totals["cost_basis"])
+    total_today_pl_twd = float(totals["today_pl"])
+    total_prev_close_value_twd = float(totals["prev_close_value"])
+    total_tw_value = float(totals["tw_value"])
+    total_cn_value = float(totals["cn_value"])
+    total_other_value = float(totals["other_value"])
     total_pl_twd = total_market_value_twd - total_cost_basis_twd
     total_pl_percent = (total_pl_twd / total_cost_basis_twd) * 100 if total_cost_basis_twd != 0 else 0
     
@@ -964,7 +3259,7 @@ def get_portfolio():
     today_str = datetime.now().strftime('%Y-%m-%d')
     last_close_value = 0
     try:
-        conn = get_db_conn()
+        conn = get_db_conn(portfolio_name)
         cursor = conn.cursor()
         # (SQL 查詢：抓取早於 "今天" 的最後一筆 "total")
         cursor.execute("SELECT total FROM daily_history WHERE date < ? ORDER BY date DESC LIMIT 1", (today_str,))
@@ -980,7 +3275,7 @@ def get_portfolio():
     daily_diff = total_market_value_twd - total_prev_close_value_twd
     daily_diff_percent = (daily_diff / total_prev_close_value_twd) * 100 if total_prev_close_value_twd != 0 else 0
     
-    return jsonify({
+    return {
         "stocks": processed_stocks,
         "totals": {
             "market_value": total_market_value_twd,
@@ -993,14 +3288,177 @@ def get_portfolio():
             "last_close_value": last_close_value,
             "tw_value": total_tw_value,
             "cn_value": total_cn_value,
+            "other_value": total_other_value,
             "cny_rate": rate_cny_twd
         }
+    }
+
+# --- (新) SSE 推播：單一背景輪詢器 ---
+PORTFOLIO_STREAM_INTERVAL_SECONDS = 5
+STREAM_KEEPALIVE_SECONDS = 15
+MAX_STREAMS = 4 # (新) 每個行程同時開著的 SSE 連線上限 (含 /api/ask_ai/stream)，超過時回 503
+STREAMS_FULL_MESSAGE = "Too many open streams on this server. Please retry later or use polling."
+
+def get_portfolio_stream_interval():
+    """獲取 SSE 背景輪詢器的更新間隔秒數"""
+    return app.config.get('PORTFOLIO_STREAM_INTERVAL', PORTFOLIO_STREAM_INTERVAL_SECONDS)
+
+def get_max_streams():
+    """SSE 連線上限 (serve.py 會依 --threads 設定 TW_STOCK_MAX_STREAMS)"""
+    try:
+        return max(0, int(app.config.get('MAX_STREAMS', os.environ.get(MAX_STREAMS_ENV, MAX_STREAMS))))
+    except ValueError:
+        return MAX_STREAMS
+
+class StreamSlots:
+    """
+    (新) 限制同時開著的 SSE 連線數。
+    每條串流會佔住 server 的一條執行緒直到連線結束，不設上限時幾個分頁就能佔滿 waitress 的執行緒池，
+    讓 /api/portfolio 等一般請求全部排隊。超過上限時回 503，前端改用輪詢。
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self.active = 0
+        self.rejected = 0
+
+    def try_acquire(self):
+        with self._lock:
+            if self.active >= get_max_streams():
+                self.rejected += 1
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active = max(0, self.active - 1)
+
+STREAM_SLOTS = StreamSlots()
+
+def stream_response(generate, on_close=None):
+    """
+    包成 SSE 回應；佔用的串流名額在回應關閉時歸還
+    (用 call_on_close 而不是 generator 的 finally，客戶端在第一筆資料前斷線時也會執行)
+    """
+    response = Response(generate, mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
     })
+    response.call_on_close(STREAM_SLOTS.release)
+    if on_close is not None:
+        response.call_on_close(on_close)
+    return response
+
+class PortfolioStreamer:
+    """
+    (新) 由一個背景執行緒定時刷新報價、計算一次估值，再推播給所有已連線的客戶端。
+    - 只有在有訂閱者時才會執行，最後一個訂閱者離開後執行緒自動結束
+    - 每個訂閱者的佇列只保留最新一筆，慢的客戶端不會拖累其他人
+    - (修改) 每一輪對所有有人訂閱的投資組合只抓一次報價 (ticker 聯集)
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._subscribers = {}  # 投資組合名稱 -> 訂閱者佇列集合
+        self._thread = None
+        self.latest_payloads = {}
+        self.stats = {"cycles": 0, "errors": 0}
+
+    def subscribe(self, portfolio=DEFAULT_PORTFOLIO):
+        q = queue.Queue(maxsize=1)
+        with self._lock:
+            self._subscribers.setdefault(portfolio, set()).add(q)
+            if portfolio in self.latest_payloads:
+                q.put_nowait(self.latest_payloads[portfolio])
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, q, portfolio=DEFAULT_PORTFOLIO):
+        with self._lock:
+            subscribers = self._subscribers.get(portfolio)
+            if subscribers is not None:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self._subscribers[portfolio]
+                    self.latest_payloads.pop(portfolio, None)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def _publish(self, portfolio, payload):
+        with self._lock:
+            if portfolio not in self._subscribers:
+                return
+            self.latest_payloads[portfolio] = payload
+            subscribers = list(self._subscribers[portfolio])
+        for q in subscribers:
+            # 丟掉尚未被讀取的舊資料，只保留最新一筆
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                q.put_nowait(payload)
+            except queue.Full:
+                pass
+
+    def _run(self):
+        print("[Stream] Portfolio poller started.")
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    print("[Stream] No subscribers left. Portfolio poller stopped.")
+                    return
+                portfolio_names = list(self._subscribers)
+            started = timestamp()
+            try:
+                with app.app_context():
+                    payloads = build_portfolio_payloads(portfolio_names)
+                for name, payload in payloads.items():
+                    self._publish(name, json.dumps(payload, ensure_ascii=False))
+                self.stats["cycles"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"[Stream] Error refreshing portfolio: {e}")
+            elapsed = timestamp() - started
+            time_module.sleep(max(0.0, get_portfolio_stream_interval() - elapsed))
+
+PORTFOLIO_STREAMER = PortfolioStreamer()
+
+@app.route('/api/portfolio/stream', methods=['GET'])
+def stream_portfolio():
+    """
+    (新) 以 Server-Sent Events 推播投資組合估值。
+    所有連線共用同一個背景輪詢器，伺服器負載不會隨觀看人數增加。
+    """
+    portfolio_name = resolve_portfolio_name()
+    # (新) 超過串流上限時回 503，前端的 EventSource onerror 會改用輪詢
+    if not STREAM_SLOTS.try_acquire():
+        return jsonify({"status": "error", "message": STREAMS_FULL_MESSAGE}), 503
+    q = PORTFOLIO_STREAMER.subscribe(portfolio_name)
+
+    def generate():
+        while True:
+            try:
+                payload = q.get(timeout=STREAM_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                # 定期送出註解行，避免代理伺服器切斷閒置連線
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: portfolio\ndata: {payload}\n\n"
+
+    return stream_response(generate(), on_close=lambda: PORTFOLIO_STREAMER.unsubscribe(q, portfolio_name))
 
 # --- (修改) 讀取邏輯改為 SQL ---
 @app.route('/api/history_summary', methods=['GET'])
 def get_history_summary():
-    
+    """
+    (修改) 本月 (MTD) 與本年 (YTD) 直接由 history_aggregates 的預先彙總列回答。
+    - since (選填, YYYY-MM-DD): 只回傳該日期之後的 daily 資料 (走主鍵索引)
+    """
     daily_data = {}
     month_start_val = 0
     month_end_val = 0
@@ -1008,40 +3466,33 @@ def get_history_summary():
     year_end_val = 0
     
     today_str = datetime.now().strftime('%Y-%m-%d')
-    current_month_prefix = today_str[:7] + '%' # "2025-10%"
-    current_year_prefix = today_str[:4] + '%' # "2025%"
+    since = request.args.get('since')
+    portfolio_name = resolve_portfolio_name()
 
     try:
-        conn = get_db_conn()
+        conn = get_db_conn(portfolio_name)
         cursor = conn.cursor()
 
-        # 1. (新) 取得所有 daily data (用於圖表)
-        cursor.execute("SELECT date, total, tw_value, cn_value FROM daily_history ORDER BY date ASC")
-        rows = cursor.fetchall()
-        for row in rows:
-            daily_data[row['date']] = {
-                "total": row['total'],
-                "tw_value": row['tw_value'],
-                "cn_value": row['cn_value']
-            }
-
-        # 2. (新) 取得本月(MTD)資料
-        cursor.execute("SELECT total FROM daily_history WHERE date LIKE ? ORDER BY date ASC LIMIT 1", (current_month_prefix,))
-        row = cursor.fetchone()
-        if row: month_start_val = row['total']
-        
-        cursor.execute("SELECT total FROM daily_history WHERE date LIKE ? ORDER BY date DESC LIMIT 1", (current_month_prefix,))
-        row = cursor.fetchone()
-        if row: month_end_val = row['total']
+        # 1. 取得 daily data (用於圖表)
+        if since:
+            cursor.execute("SELECT date, total, tw_value, cn_value FROM daily_history WHERE date >= ? ORDER BY date ASC", (since,))
+        else:
+            cursor.execute("SELECT date, total, tw_value, cn_value FROM daily_history ORDER BY date ASC")
+        daily_data = {
+            row_date: {"total": total, "tw_value": tw_value, "cn_value": cn_value}
+            for row_date, total, tw_value, cn_value in cursor.fetchall()
+        }
 
-        # 3. (新) 取得本年(YTD)資料
-        cursor.execute("SELECT total FROM daily_history WHERE date LIKE ? ORDER BY date ASC LIMIT 1", (current_year_prefix,))
-        row = cursor.fetchone()
-        if row: year_start_val = row['total']
-        
-        cursor.execute("SELECT total FROM daily_history WHERE date LIKE ? ORDER BY date DESC LIMIT 1", (current_year_prefix,))
-        row = cursor.fetchone()
-        if row: year_end_val = row['total']
+        # 2. (修改) 本月(MTD)與本年(YTD)資料改由彙總表讀取
+        cursor.execute(
+            "SELECT period, first_total, last_total FROM history_aggregates WHERE period IN (?, ?)",
+            (today_str[:7], today_str[:4])
+        )
+        for row in cursor.fetchall():
+            if row['period'] == today_str[:7]:
+                month_start_val, month_end_val = row['first_total'], row['last_total']
+            else:
+                year_start_val, year_end_val = row['first_total'], row['last_total']
         
         conn.close()
         
@@ -1054,7 +3505,8 @@ def get_history_summary():
     year_diff = year_end_val - year_start_val
     year_diff_percent = (year_diff / year_start_val) * 100 if year_start_val != 0 else 0
 
-    return jsonify({
+    # (修改) 附帶 ETag，歷史資料未變動時回傳 304
+    body = json.dumps({
         "daily": daily_data, # (傳回 v2 物件結構)
         "monthly": {
             "start_value": month_start_val, "end_value": month_end_val,
@@ -1064,7 +3516,129 @@ def get_history_summary():
             "start_value": year_start_val, "end_value": year_end_val,
             "diff": year_diff, "percent": year_diff_percent
         }
-    })
+    }, ensure_ascii=False, sort_keys=True)
+    return make_versioned_response(body, compute_content_version(body))
+
+@app.route('/api/history_aggregates', methods=['GET'])
+def get_history_aggregates():
+    """
+    (新) 獲取預先彙總的月/年資料 (period_type: month / year，預設全部)
+    """
+    period_type = request.args.get('period_type')
+    portfolio_name = resolve_portfolio_name()
+    try:
+        conn = get_db_conn(portfolio_name)
+        if period_type:
+            rows = conn.execute("SELECT * FROM history_aggregates WHERE period_type = ? ORDER BY period ASC", (period_type,)).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM history_aggregates ORDER BY period ASC").fetchall()
+        conn.close()
+        return jsonify({"status": "success", "periods": [dict(row) for row in rows]})
+    except Exception as e:
+        print(f"Error reading history_aggregates from SQLite: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# --- (新) 股票基本資料快取 (SQLite + 背景補齊) ---
+TICKER_METADATA_TTL_DAYS = 30
+TICKER_METADATA_MISSING_RETRY_MINUTES = 60  # 抓不到名稱的 ticker 隔多久可以再試 (避免每次新增都打 Yahoo)
+TICKER_METADATA_QUERY_CHUNK = 500  # 單一 IN (...) 查詢的參數上限
+METADATA_POOL_WORKERS = 2
+METADATA_POOL = ThreadPoolExecutor(max_workers=METADATA_POOL_WORKERS, thread_name_prefix='ticker-metadata')
+METADATA_PENDING = set()
+METADATA_PENDING_LOCK = Lock()
+
+def _load_ticker_metadata_rows(tickers):
+    """從 ticker_metadata 讀取 {ticker: row dict}"""
+    result = {}
+    tickers = list(dict.fromkeys(tickers))
+    conn = get_db_conn()
+    for i in range(0, len(tickers), TICKER_METADATA_QUERY_CHUNK):
+        chunk = tickers[i:i + TICKER_METADATA_QUERY_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        for row in conn.execute(f"SELECT * FROM ticker_metadata WHERE ticker IN ({placeholders})", chunk):
+            result[row['ticker']] = dict(row)
+    conn.close()
+    return result
+
+def _store_ticker_metadata(ticker, metadata):
+    conn = get_db_conn()
+    conn.execute(
+        "INSERT OR REPLACE INTO ticker_metadata (ticker, name, exchange, currency, sector, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (ticker, metadata.get('name'), metadata.get('exchange'), metadata.get('currency'), metadata.get('sector'),
+         datetime.now().isoformat(timespec='seconds'))
+    )
+    conn.commit()
+    conn.close()
+
+def _fetch_ticker_metadata(ticker):
+    """從 yfinance 抓取一支股票的基本資料 (.info 很慢，只在背景執行緒呼叫)"""
+    RATE_LIMITER.acquire('yahoo')
+    info = yf.Ticker(ticker).info or {}
+    return {
+        "name": info.get('shortName') or info.get('longName'),
+        "exchange": info.get('exchange'),
+        "currency": info.get('currency'),
+        "sector": info.get('sector')
+    }
+
+def _fill_placeholder_names(ticker, name):
+    """把暫時以 ticker 當名稱的持股 (新增時未提供名稱) 補上正式名稱"""
+    for portfolio_name in list_portfolios():
+        store = get_portfolio_store(portfolio_name)
+        stock = store.get(ticker)
+        if stock is not None and stock.get('name') in (None, '', ticker):
+            store.update(ticker, {"name": name})
+            print(f"[Metadata] Filled name for {ticker} in '{portfolio_name}': {name}")
+
+def _resolve_ticker_metadata(ticker):
+    try:
+        with app.app_context():
+            metadata = _fetch_ticker_metadata(ticker)
+            _store_ticker_metadata(ticker, metadata)
+            if metadata.get('name'):
+                _fill_placeholder_names(ticker, metadata['name'])
+    except Exception as e:
+        print(f"[Metadata] Could not fetch metadata for {ticker}: {e}")
+    finally:
+        with METADATA_PENDING_LOCK:
+            METADATA_PENDING.discard(ticker)
+
+def prefetch_ticker_metadata(tickers, force=False):
+    """
+    (新) 在背景批次補齊股票基本資料，立即回傳排入佇列的 ticker 清單。
+    預設只抓快取中沒有的 ticker (名稱為 NULL 且超過 TICKER_METADATA_MISSING_RETRY_MINUTES 的也視為沒有)；
+    force=True 時全部重新抓取 (用於更新過期資料)。
+    """
+    tickers = list(dict.fromkeys(tickers))
+    if not force:
+        cached = _load_ticker_metadata_rows(tickers)
+        retry_cutoff = (datetime.now() - timedelta(minutes=TICKER_METADATA_MISSING_RETRY_MINUTES)).isoformat(timespec='seconds')
+        tickers = [
+            ticker for ticker in tickers
+            if ticker not in cached or (not cached[ticker]['name'] and cached[ticker]['updated_at'] < retry_cutoff)
+        ]
+    queued = []
+    with METADATA_PENDING_LOCK:
+        for ticker in tickers:
+            if ticker in METADATA_PENDING:
+                continue
+            METADATA_PENDING.add(ticker)
+            queued.append(ticker)
+    for ticker in queued:
+        METADATA_POOL.submit(_resolve_ticker_metadata, ticker)
+    return queued
+
+def get_ticker_metadata(tickers):
+    """
+    (新) 從本地快取讀取股票基本資料 {ticker: {...}}，不會呼叫 yfinance。
+    超過 TICKER_METADATA_TTL_DAYS 的資料照常回傳，同時排入背景更新。
+    """
+    rows = _load_ticker_metadata_rows(tickers)
+    cutoff = (datetime.now() - timedelta(days=TICKER_METADATA_TTL_DAYS)).isoformat(timespec='seconds')
+    stale = [ticker for ticker, row in rows.items() if row['updated_at'] < cutoff]
+    if stale:
+        prefetch_ticker_metadata(stale, force=True)
+    return rows
 
 # (CRUD 路由 ... 保持不變)
 @app.route('/api/stock', methods=['POST'])
@@ -1072,20 +3646,19 @@ def add_stock():
     data = request.json
     if not data or 'ticker' not in data or 'shares' not in data or 'avg_cost' not in data:
         return jsonify({"status": "error", "message": "Missing data"}), 400
-    portfolio = load_portfolio()
     ticker = data['ticker']
-    existing = next((s for s in portfolio if s['ticker'] == ticker), None)
-    if existing:
+    store = get_portfolio_store(resolve_portfolio_name())
+    if store.get(ticker) is not None:
         return jsonify({"status": "error", "message": "Ticker already exists. Use update instead."}), 409
     stock_name = data.get('name')
+    name_pending = False
+    needs_name = False
     if not stock_name:
-        try:
-            print(f"Fetching metadata for new stock: {ticker}...")
-            ticker_info = yf.Ticker(ticker).info
-            stock_name = ticker_info.get('shortName', ticker_info.get('longName', ticker))
-        except Exception as e:
-            print(f"Could not fetch name for {ticker}: {e}")
+        # (修改) 先查本地快取；沒有的話先以 ticker 當名稱，名稱由背景執行緒補上
+        stock_name = (get_ticker_metadata([ticker]).get(ticker) or {}).get('name')
+        if not stock_name:
             stock_name = ticker
+            needs_name = True
     else:
         print(f"Using user-provided name: {stock_name}")
     new_stock = {
@@ -1095,63 +3668,164 @@ def add_stock():
         "currency": data.get('currency', 'TWD'),
         "name": stock_name
     }
-    portfolio.append(new_stock)
-    save_portfolio(portfolio)
-    return jsonify({"status": "success", "stock": new_stock}), 201
+    if not store.add(new_stock):
+        return jsonify({"status": "error", "message": "Ticker already exists. Use update instead."}), 409
+    if needs_name:
+        # 只有真的排入背景補齊 (或已在補齊中) 時才回報 name_pending
+        queued = prefetch_ticker_metadata([ticker])
+        with METADATA_PENDING_LOCK:
+            name_pending = bool(queued) or ticker in METADATA_PENDING
+        if name_pending:
+            print(f"Queueing metadata fetch for new stock: {ticker}...")
+        else:
+            print(f"No name available for {ticker}; using the ticker as its name.")
+    return jsonify({"status": "success", "stock": new_stock, "name_pending": name_pending}), 201
 
 @app.route('/api/stock/<path:ticker_key>', methods=['PUT'])
 def update_stock(ticker_key):
     data = request.json
     if not data or 'shares' not in data or 'avg_cost' not in data:
         return jsonify({"status": "error", "message": "Missing data"}), 400
-    portfolio = load_portfolio()
-    stock_to_update = next((s for s in portfolio if s['ticker'] == ticker_key), None)
-    if not stock_to_update:
-        return jsonify({"status": "error", "message": "Ticker not found"}), 404
-    stock_to_update['shares'] = float(data['shares'])
-    stock_to_update['avg_cost'] = float(data['avg_cost'])
-    stock_to_update['currency'] = data.get('currency', 'TWD')
+    changes = {
+        'shares': float(data['shares']),
+        'avg_cost': float(data['avg_cost']),
+        'currency': data.get('currency', 'TWD')
+    }
     if 'name' in data:
         stock_name = data['name']
         if not stock_name:
-            stock_to_update['name'] = ticker_key
+            changes['name'] = ticker_key
         else:
-            stock_to_update['name'] = stock_name
-    save_portfolio(portfolio)
+            changes['name'] = stock_name
+    stock_to_update = get_portfolio_store(resolve_portfolio_name()).update(ticker_key, changes)
+    if not stock_to_update:
+        return jsonify({"status": "error", "message": "Ticker not found"}), 404
     return jsonify({"status": "success", "stock": stock_to_update})
 
 @app.route('/api/stock/<path:ticker_key>', methods=['DELETE'])
 def delete_stock(ticker_key):
-    portfolio = load_portfolio()
-    new_portfolio = [s for s in portfolio if s['ticker'] != ticker_key]
-    if len(new_portfolio) == len(portfolio):
+    if not get_portfolio_store(resolve_portfolio_name()).delete(ticker_key):
         return jsonify({"status": "error", "message": "Ticker not found"}), 404
-    save_portfolio(new_portfolio)
     return jsonify({"status": "success"})
 
+# --- (新) 個股歷史快取 ---
+STOCK_HISTORY_PERIOD_DAYS = {
+    "5d": 5, "7d": 7, "30d": 30, "1mo": 31, "3mo": 92, "6mo": 183,
+    "1y": 366, "2y": 731, "5y": 1827
+}
+STOCK_HISTORY_INTRADAY_INTERVALS = {"5m", "15m", "30m", "60m", "1h"}
+STOCK_HISTORY_INTERVALS = {"1d", "1wk", "1mo"} | STOCK_HISTORY_INTRADAY_INTERVALS
+STOCK_HISTORY_CACHE_MAX_ENTRIES = 256
+STOCK_HISTORY_INTRADAY_TTL_SECONDS = 60     # 盤中 (含收盤後緩衝) 的快取秒數
+STOCK_HISTORY_DEFAULT_TTL_SECONDS = 600     # 無法判斷交易時段的股票 (例如美股) 的快取秒數
+MARKET_CLOSE_GRACE = timedelta(minutes=30)  # 收盤後等待 Yahoo 更新最終收盤價的緩衝
+MARKET_SESSIONS = {
+    # (伺服器本地時間，台股與陸股同為 UTC+8)
+    "TW": (time(9, 0), time(13, 30)),
+    "CN": (time(9, 30), time(15, 0))
+}
+
+STOCK_HISTORY_CACHE = OrderedDict()  # (ticker, period, interval) -> (json 字串, 到期時間)
+STOCK_HISTORY_CACHE_LOCK = Lock()
+
+def get_market_of_ticker(ticker):
+    if ticker.endswith('.TW') or ticker.endswith('.TWO'):
+        return "TW"
+    if ticker.endswith('.SS') or ticker.endswith('.SZ'):
+        return "CN"
+    return None
+
+def get_stock_history_expiry(ticker, now=None):
+    """
+    (新) 依交易時段決定快取到期時間：
+    - 交易時段內 (含收盤後緩衝)：短時間到期，讓當日 K 棒持續更新
+    - 收盤後 / 週末：資料已定案，直到下一個交易時段開盤才到期
+    """
+    now = now or datetime.now()
+    session = MARKET_SESSIONS.get(get_market_of_ticker(ticker))
+    if session is None:
+        return now + timedelta(seconds=STOCK_HISTORY_DEFAULT_TTL_SECONDS)
+
+    open_time, close_time = session
+    session_open = datetime.combine(now.date(), open_time)
+    session_end = datetime.combine(now.date(), close_time) + MARKET_CLOSE_GRACE
+    if now.weekday() < 5 and session_open <= now < session_end:
+        return now + timedelta(seconds=STOCK_HISTORY_INTRADAY_TTL_SECONDS)
+
+    # 找下一個交易日的開盤時間
+    next_open = session_open if (now.weekday() < 5 and now < session_open) else session_open + timedelta(days=1)
+    while next_open.weekday() >= 5:
+        next_open += timedelta(days=1)
+    return next_open
+
+def _build_stock_history_body(ticker, period, interval):
+    """
+    (新) 產生個股歷史的 JSON 字串 (以欄為單位序列化，不逐列迭代 DataFrame)。
+    日線優先使用本地價格庫；週線、月線、分線與 'max' 區間直接向 yfinance 查詢。
+    """
+    if interval == "1d" and period != "max":
+        end_date = datetime.now().date()
+        if period == "ytd":
+            start_date = date(end_date.year, 1, 1)
+        else:
+            start_date = end_date - timedelta(days=STOCK_HISTORY_PERIOD_DAYS[period])
+        sync_price_history([ticker], start_date, end_date)
+        rows = load_price_history(ticker, start_date, end_date)
+        dates = [row['date'] for row in rows]
+        closes = np.round(np.array([row['close'] for row in rows], dtype=float), 4).tolist()
+    else:
+        RATE_LIMITER.acquire('yahoo')
+        hist = yf.Ticker(ticker).history(period=period, interval=interval)
+        date_format = '%Y-%m-%d %H:%M' if interval in STOCK_HISTORY_INTRADAY_INTERVALS else '%Y-%m-%d'
+        dates = hist.index.strftime(date_format).tolist() if not hist.empty else []
+        closes = hist['Close'].round(4).tolist() if not hist.empty else []
+
+    if not dates:
+        return None
+
+    return json.dumps({
+        "status": "success",
+        "ticker": ticker,
+        "period": period,
+        "interval": interval,
+        "history": [{"date": d, "close": c} for d, c in zip(dates, closes)]
+    }, ensure_ascii=False)
+
 @app.route('/api/stock_history/<path:ticker>', methods=['GET'])
 def get_stock_history(ticker):
+    """
+    (修改) 獲取個股歷史價格
+    - period: 5d / 7d / 30d (預設) / 1mo / 3mo / 6mo / 1y / 2y / 5y / ytd / max
+    - interval: 1d (預設) / 1wk / 1mo / 5m / 15m / 30m / 60m / 1h
+    回應依 (ticker, period, interval) 快取，到期時間依交易時段決定。
+    """
+    period = request.args.get('period', '30d')
+    interval = request.args.get('interval', '1d')
+    if period not in STOCK_HISTORY_PERIOD_DAYS and period not in ("ytd", "max"):
+        return jsonify({"status": "error", "message": f"Invalid period: {period}"}), 400
+    if interval not in STOCK_HISTORY_INTERVALS:
+        return jsonify({"status": "error", "message": f"Invalid interval: {interval}"}), 400
+
+    cache_key = (ticker, period, interval)
+    now = datetime.now()
+    with STOCK_HISTORY_CACHE_LOCK:
+        cached = STOCK_HISTORY_CACHE.get(cache_key)
+        if cached and cached[1] > now:
+            STOCK_HISTORY_CACHE.move_to_end(cache_key)
+            return Response(cached[0], mimetype='application/json')
+
     try:
-        # 使用yfinance獲取歷史數據 (近30天)
-        ticker_obj = yf.Ticker(ticker)
-        hist = ticker_obj.history(period="30d")
-        
-        if hist.empty:
+        body = _build_stock_history_body(ticker, period, interval)
+        if body is None:
             return jsonify({"status": "error", "message": "No historical data found"}), 404
-            
-        # 轉換為JSON格式
-        history_data = []
-        for index, row in hist.iterrows():
-            history_data.append({
-                "date": index.strftime('%Y-%m-%d'),
-                "close": round(row['Close'], 4)
-            })
-            
-        return jsonify({
-            "status": "success",
-            "ticker": ticker,
-            "history": history_data
-        })
+
+        with STOCK_HISTORY_CACHE_LOCK:
+            STOCK_HISTORY_CACHE[cache_key] = (body, get_stock_history_expiry(ticker, now))
+            STOCK_HISTORY_CACHE.move_to_end(cache_key)
+            while len(STOCK_HISTORY_CACHE) > STOCK_HISTORY_CACHE_MAX_ENTRIES:
+                STOCK_HISTORY_CACHE.popitem(last=False)
+
+        return Response(body, mimetype='application/json')
     except Exception as e:
         print(f"Error fetching stock history: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -1162,71 +3836,109 @@ def get_prices_for_date_yahoo_only(tickers, target_date):
     它會嚴格抓取 'target_date' 當天的收盤價。
     如果 'target_date' 當天無資料（休市），則回傳 0。
     (此版本 *移除* 了 yfinance 往前 14 天查找的備援邏輯)
+    (修改) 改由本地價格庫提供，已同步過的日期不會再連網
     """
     if not tickers:
         return {}
-    
-    # yfinance 抓取需要一個區間
-    start_date = target_date
-    end_date = target_date + timedelta(days=1)
-    
+
     print(f"[Backfill Yahoo Only] Fetching historical prices for {target_date.strftime('%Y-%m-%d')} for tickers: {' '.join(tickers)}")
-    
-    try:
-        hist_data = yf.download(
-            ' '.join(tickers),
-            start=start_date,
-            end=end_date,
-            interval="1d",
-            group_by='ticker',
-            progress=False # 關閉下載進度條
-        )
-    except Exception as e:
-        print(f"[Backfill Yahoo Only] yf.download FAILED: {e}")
-         # 如果 yf.download 本身失敗，為所有股票回傳 0
+
+    price_matrix = get_price_matrix_yahoo_only(tickers, target_date, target_date)
+    if price_matrix.empty:
         return {ticker: {"price": 0} for ticker in tickers}
 
-    stock_data = {}
-    for ticker in tickers:
-        try:
-            price_series = None
-            
-            # 處理 yf.download 在不同情況下的回傳結構
-            if len(tickers) == 1:
-                # 情況1: 只查詢一支股票
-                if hist_data.empty:
-                    price_series = pd.Series(dtype=float) # 建立空的 Series
-                else:
-                    price_series = hist_data['Close']
-            else:
-                # 情況2: 查詢多支股票
-                if ticker not in hist_data or hist_data[ticker].empty:
-                     price_series = pd.Series(dtype=float) # 建立空的 Series
-                else:
-                    price_series = hist_data[ticker]['Close']
-
-            price_found = False
-            if price_series is not None and not price_series.empty:
-                # 獲取該日期的收盤價 (iloc[0] 應該就是 start_date)
-                price = price_series.iloc[0] 
-                if not pd.isna(price) and price > 0: 
-                    stock_data[ticker] = {"price": price}
-                    price_found = True
-
-            if not price_found:
-                 # (*** 關鍵變更 ***)
-                 # 找不到 'target_date' 當天的資料（休市或錯誤）
-                 # 我們*不再*往前查找，直接回傳 0
-                 # print(f"  -> [Backfill Yahoo Only] No data for {ticker} on {target_date.strftime('%Y-%m-%d')}. Returning 0.")
-                 stock_data[ticker] = {"price": 0}
+    day_prices = price_matrix.iloc[0]
+    return {ticker: {"price": float(day_prices[ticker])} for ticker in tickers}
 
-        except Exception as e:
-            print(f"[Backfill Yahoo Only] Error processing {ticker}: {e}")
-            stock_data[ticker] = {"price": 0}
-            
-    return stock_data
+def get_price_matrix_yahoo_only(tickers, start_date, end_date):
+    """
+    (新) 範圍回補用：整段期間 *所有* 股票的收盤價 (本地價格庫缺的部分才會以一次 yf.download 補齊)。
+    回傳 DataFrame (index = start_date ~ end_date 之間的每個平日, columns = tickers)，
+    當天沒有資料 (休市或失敗) 的位置為 0，與 get_prices_for_date_yahoo_only 的嚴格邏輯一致。
+    """
+    business_days = [d.date() for d in pd.bdate_range(start_date, end_date)]
+    empty = pd.DataFrame(0.0, index=business_days, columns=tickers)
+    if not tickers or not business_days:
+        return empty
+
+    # (修改) 先增量同步本地價格庫，再從 price_history 讀取
+    sync_price_history(tickers, start_date, end_date)
+    close_matrix = load_close_matrix(tickers, start_date, end_date)
+
+    price_matrix = close_matrix.reindex(index=business_days, columns=tickers).astype(float)
+    price_matrix = price_matrix.where(price_matrix > 0).fillna(0.0)
+    return price_matrix
+
+def _previous_other_value(previous_day_data):
+    """daily_history 只存 total/tw/cn，其他幣別的市值由 total 反推"""
+    other_value = (previous_day_data.get("total") or 0) - (previous_day_data.get("tw_value") or 0) - (previous_day_data.get("cn_value") or 0)
+    return round(max(other_value, 0.0), 4)
+
+@timed_stage("job", "backfill_range")
+def _run_range_backfill(start_date, end_date, portfolio_name=DEFAULT_PORTFOLIO):
+    """
+    (新) 範圍回補的批次版本：
+    - 一次下載整段期間的價格 (get_price_matrix_yahoo_only)
+    - 以 (日期 x 持股) 價格矩陣一次算出每天的 tw/cn 市值
+    - 休市 (市值為 0) 的市場沿用前一個交易日的市值 (carry-forward)，第一天以 DB 中更早的資料為起點
+    - 所有結果以一次 bulk upsert 寫入
+    """
+    portfolio, tickers = get_portfolio_store(portfolio_name).snapshot()
+    if not tickers:
+        print("[Range Backfill] No portfolio found. Skipping.")
+        return []
+
+    fx_rates = FX_SERVICE.rates_for_persistence()
+
+    update_backfill_status(message=f"正在下載 {start_date} ~ {end_date} 的價格...")
+    price_matrix = get_price_matrix_yahoo_only(tickers, start_date, end_date)
+    dates = list(price_matrix.index)
+    if not dates:
+        print("[Range Backfill] No weekdays in range. Skipping.")
+        return []
+
+    update_backfill_status(message=f"正在計算 {len(dates)} 天的市值...")
+    holdings = Holdings(portfolio)
+    totals = value_holdings(holdings, price_matrix[holdings.tickers].to_numpy(), fx_rates=fx_rates)["totals"]
+    # (修改) 與單日回補相同：目前沒有其他幣別持股時，other_value 固定為 0，不沿用更早資料反推出的值
+    has_other = bool((holdings.currency_code == OTHER_CURRENCY_CODE).any())
+
+    # 市值為 0 (休市或抓取失敗) 的日子視為缺值，往前沿用
+    values = pd.DataFrame({
+        "tw_value": np.round(totals["tw_value"], 4),
+        "cn_value": np.round(totals["cn_value"], 4),
+        "other_value": np.round(totals["other_value"], 4)
+    }, index=dates).replace(0.0, np.nan)
+
+    previous_day_data = get_previous_day_data(start_date, portfolio_name)
+    if previous_day_data:
+        print(f"[Range Backfill] Seeding carry-forward with data from {previous_day_data['date']}")
+        seed = pd.DataFrame({
+            "tw_value": [previous_day_data.get("tw_value") or np.nan],
+            "cn_value": [previous_day_data.get("cn_value") or np.nan],
+            "other_value": [(_previous_other_value(previous_day_data) if has_other else 0) or np.nan]
+        }, index=[None])
+        values = pd.concat([seed, values]).ffill().iloc[1:]
+    else:
+        values = values.ffill()
+    values = values.fillna(0.0)
+    if not has_other:
+        values["other_value"] = 0.0
+    values["total"] = (values["tw_value"] + values["cn_value"] + values["other_value"]).round(4)
 
-def _run_backfill_for_single_date(target_date):
+    snapshots = [
+        (target_date, {"total": total, "tw_value": tw_value, "cn_value": cn_value})
+        for target_date, total, tw_value, cn_value in zip(
+            dates, values["total"].tolist(), values["tw_value"].tolist(), values["cn_value"].tolist()
+        )
+    ]
+
+    update_backfill_status(message=f"正在寫入 {len(snapshots)} 筆資料...")
+    update_history_log_bulk(snapshots, portfolio_name)
+    return snapshots
+
+@timed_stage("job", "backfill_date")
+def _run_backfill_for_single_date(target_date, portfolio_name=DEFAULT_PORTFOLIO):
     """
     (已重寫) 執行單日回補的核心邏輯。
     - 使用 'get_prices_for_date_strict' 嚴格獲取當天價格。
@@ -1234,64 +3946,57 @@ def _run_backfill_for_single_date(target_date):
     """
     print(f"\n[Backfill Logic] Running job for {target_date}...")
     
-    portfolio = load_portfolio()
-    tickers = list(set(stock['ticker'] for stock in portfolio))
+    portfolio, tickers = get_portfolio_store(portfolio_name).snapshot()
     if not tickers:
         print("[Backfill Logic] No portfolio found. Skipping.")
         return {"status": "skipped", "message": "No portfolio found."}, None, None
 
-    rate_cny_twd = get_cny_to_twd_rate()
+    fx_rates = FX_SERVICE.rates_for_persistence()
+    rate_cny_twd = fx_rates.get("CNY")
     
     # (*** 變更點 1: 使用新的嚴格抓取函式 ***)
     # 這個函式只會抓 'target_date' 當天的價格，如果休市或失敗則回傳 0
     prices_data = get_prices_for_date_yahoo_only(tickers, target_date) 
 
-    total_tw_value = 0
-    total_cn_value = 0
-    detailed_info = []
-    
-    for stock in portfolio:
-        ticker = stock['ticker']
-        shares = float(stock.get('shares', 0))
-        currency = stock.get("currency", "TWD")
-        
-        # 'price' 可能是 0 (如果當天休市或抓取失敗)
-        close_price_original = prices_data.get(ticker, {}).get('price', 0) 
-        
-        market_value_original = close_price_original * shares
-        market_value_twd = market_value_original
-        if currency == "CNY":
-            market_value_twd *= rate_cny_twd
-        
-        # (*** 變更點 2: 分開累計市值 ***)
-        # 我們只關心 TWD 和 CNY
-        if currency == "TWD":
-            total_tw_value += market_value_twd
-        elif currency == "CNY":
-            total_cn_value += market_value_twd
-        # (其他貨幣如 USD 暫不計入 tw_value 或 cn_value)
-
-        detailed_info.append({
-            "ticker": ticker, "name": stock.get("name", ticker), "shares": shares,
+    # (*** 變更點 2: 使用向量化估值核心分開累計市值 ***)
+    # 'price' 可能是 0 (如果當天休市或抓取失敗)
+    # (修改) 其他貨幣 (USD、HKD、JPY...) 也換算成台幣，計入 other_value
+    holdings = Holdings(portfolio)
+    valuation = value_holdings(holdings, holdings.price_vector(prices_data), fx_rates=fx_rates)
+    rows = valuation["rows"]
+    total_tw_value = float(valuation["totals"]["tw_value"])
+    total_cn_value = float(valuation["totals"]["cn_value"])
+    total_other_value = float(valuation["totals"]["other_value"])
+    has_other = bool((holdings.currency_code == OTHER_CURRENCY_CODE).any())
+
+    detailed_info = [
+        {
+            "ticker": stock['ticker'], "name": stock.get("name", stock['ticker']), "shares": shares,
             "currency": currency, "close_price_original": round(close_price_original, 4),
             "market_value_original": round(market_value_original, 4),
             "market_value_twd": round(market_value_twd, 4),
-            "rate_used": rate_cny_twd if currency == "CNY" else 1.0
-        })
+            "rate_used": fx
+        }
+        for stock, currency, shares, close_price_original, market_value_original, market_value_twd, fx in zip(
+            portfolio, holdings.currencies, holdings.shares.tolist(), rows["price"].tolist(),
+            rows["market_value_original"].tolist(), rows["market_value"].tolist(), rows["fx"].tolist()
+        )
+    ]
     
     # (*** 變更點 3: 獨立的回填 (Backfill) 邏輯 ***)
     
     # 這是 'target_date' 當天計算出來的 "原始" 市值
     final_tw_value = round(total_tw_value, 4)
     final_cn_value = round(total_cn_value, 4)
+    final_other_value = round(total_other_value, 4)
     
     # 檢查是否需要從 "前一天" 繼承數據
     # 只要任一市場為 0，就觸發檢查
-    if final_tw_value == 0 or final_cn_value == 0:
+    if final_tw_value == 0 or final_cn_value == 0 or (has_other and final_other_value == 0):
         print(f"[Backfill Logic] '{target_date}' TW or CN market value is 0. Fetching previous day data...")
         
         # 撈取 'target_date' 之前的 *最後一筆* 有效資料
-        previous_day_data = get_previous_day_data(target_date) #
+        previous_day_data = get_previous_day_data(target_date, portfolio_name) #
         
         if previous_day_data:
             print(f"[Backfill Logic] Found previous data from {previous_day_data['date']}")
@@ -1311,6 +4016,11 @@ def _run_backfill_for_single_date(target_date):
             else:
                 # (例如陸股開市，但台股休市)
                 print(f"  -> [Backfill] Using 'target_date' CN value: {final_cn_value}")
+
+            # 獨立判斷 (C): 其他幣別市場休市時，沿用前一天由 total 反推的市值
+            if has_other and final_other_value == 0:
+                final_other_value = _previous_other_value(previous_day_data)
+                print(f"  -> [Backfill] Using previous other-currency value: {final_other_value}")
                 
         else:
             # 這是歷史記錄的第一天，找不到更早的資料
@@ -1320,8 +4030,8 @@ def _run_backfill_for_single_date(target_date):
 
     # (*** 變更點 4: 儲存最終結果 ***)
     
-    # 總市值 = (可能被回填的台股) + (可能被回填的陸股)
-    final_total = round(final_tw_value + final_cn_value, 4)
+    # 總市值 = (可能被回填的台股) + (可能被回填的陸股) + (其他幣別)
+    final_total = round(final_tw_value + final_cn_value + final_other_value, 4)
     
     snapshot_data = {
         "total": final_total,
@@ -1330,7 +4040,7 @@ def _run_backfill_for_single_date(target_date):
     }
     
     # 使用 INSERT OR REPLACE 儲存或覆蓋
-    update_history_log(snapshot_data, target_date) #
+    update_history_log(snapshot_data, target_date, portfolio_name) #
     
     print(f"[Backfill Logic] Job for {target_date} finished.")
     
@@ -1353,9 +4063,11 @@ def backfill_history():
     except ValueError:
         return jsonify({"status": "error", "message": "Invalid date format. Use YYYY-MM-DD."}), 400
 
+    portfolio_name = resolve_portfolio_name()
+
     try:
         # (新) 呼叫重構後的函式
-        snapshot_data, detailed_info, rate_cny_twd = _run_backfill_for_single_date(target_date)
+        snapshot_data, detailed_info, rate_cny_twd = _run_backfill_for_single_date(target_date, portfolio_name)
         
         if isinstance(snapshot_data, dict) and snapshot_data.get("status") == "skipped":
             return jsonify(snapshot_data)
@@ -1371,13 +4083,11 @@ def backfill_history():
         print(f"[Manual Backfill] Error for {date_str}: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
-def _execute_range_backfill(app, start_date_str, end_date_str):
+def _execute_range_backfill(app, start_date_str, end_date_str, portfolio_name=DEFAULT_PORTFOLIO):
     """
     (已修改) "範圍回補" 的背景執行緒，
-    (新) 會更新 BACKFILL_STATUS 全域變數
+    (新) 會更新回補狀態 (多 worker 時寫入共用狀態，任何 worker 都能回報進度)
     """
-    global BACKFILL_STATUS
-    
     with app.app_context():
         try:
             start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
@@ -1385,49 +4095,29 @@ def _execute_range_backfill(app, start_date_str, end_date_str):
             
             if start_date > end_date:
                 print("[Range Backfill] Error: Start date is after end date.")
-                BACKFILL_STATUS = {"running": False, "message": "錯誤：開始日期晚於結束日期"}
+                write_backfill_status(running=False, message="錯誤：開始日期晚於結束日期")
                 return
 
             print(f"[Range Backfill] Job started from {start_date_str} to {end_date_str}...")
             
             # (新) 初始化狀態
-            BACKFILL_STATUS = {
-                "running": True,
-                "message": f"任務已啟動..."
-            }
-            
-            current_date = start_date
+            write_backfill_status(
+                running=True,
+                portfolio=portfolio_name,
+                message=f"任務已啟動..."
+            )
             
-            while current_date <= end_date:
-                if not BACKFILL_STATUS["running"]: # (新) 允許外部中斷 (雖然目前沒做中斷按鈕)
-                    print("[Range Backfill] Job aborted.")
-                    break
-                    
-                if current_date.weekday() >= 5:
-                    print(f"[Range Backfill] Skipping {current_date} (Weekend)")
-                else:
-                    msg = f"正在處理 {current_date}..."
-                    print(f"[Range Backfill] {msg}")
-                    BACKFILL_STATUS["message"] = msg
-                    
-                    try:
-                        _run_backfill_for_single_date(current_date)
-                        print(f"[Range Backfill] Successfully processed {current_date}.")
-                    except Exception as e:
-                        print(f"[Range Backfill] ERROR processing {current_date}: {e}")
-                    
-                    print(f"[Range Backfill] Waiting 6.1s to respect MIS API rate limit...")
-                    import time as time_module
-                    time_module.sleep(6.1)
-                
-                current_date += timedelta(days=1)
+            # (修改) 一次下載 + 一次向量化計算 + 一次 bulk upsert，不再逐日呼叫並等待 6.1 秒
+            # (週末會由 get_price_matrix_yahoo_only 直接略過)
+            snapshots = _run_range_backfill(start_date, end_date, portfolio_name)
+            print(f"[Range Backfill] Successfully processed {len(snapshots)} weekdays.")
             
             print("[Range Backfill] Job finished.")
-            BACKFILL_STATUS = {"running": False, "message": f"回補完成"}
+            write_backfill_status(running=False, portfolio=portfolio_name, message=f"回補完成 ({len(snapshots)} 天)")
         
         except Exception as e:
             print(f"[Range Backfill] FATAL ERROR: {e}")
-            BACKFILL_STATUS = {"running": False, "message": f"嚴重錯誤: {e}"}
+            write_backfill_status(running=False, portfolio=portfolio_name, message=f"嚴重錯誤: {e}")
 
 
 @app.route('/api/backfill_status', methods=['GET'])
@@ -1435,8 +4125,7 @@ def get_backfill_status():
     """
     (新) 獲取目前的回補任務狀態
     """
-    global BACKFILL_STATUS
-    return jsonify(BACKFILL_STATUS)
+    return jsonify(read_backfill_status())
 
 @app.route('/api/backfill_range', methods=['POST'])
 def backfill_range():
@@ -1464,12 +4153,15 @@ def backfill_range():
     except ValueError:
         return jsonify({"status": "error", "message": "Invalid date format. Use YYYY-MM-DD."}), 400
 
+    portfolio_name = resolve_portfolio_name()
+
     # (重要) 啟動背景執行緒
     # 我們傳遞 'app._get_current_object()' 來確保執行緒能正確取得 app context
     thread = Thread(target=_execute_range_backfill, args=(
         current_app._get_current_object(), # <-- 修正點 
         start_date_str, 
-        end_date_str
+        end_date_str,
+        portfolio_name
     ))
     thread.daemon = True # 允許主程式退出
     thread.start()
@@ -1498,8 +4190,10 @@ def delete_history():
     except ValueError:
         return jsonify({"status": "error", "message": "Invalid date format. Use YYYY-MM-DD."}), 400
 
+    portfolio_name = resolve_portfolio_name()
+
     try:
-        conn = get_db_conn()
+        conn = get_db_conn(portfolio_name)
         cursor = conn.cursor()
         
         # 檢查資料是否存在
@@ -1512,8 +4206,10 @@ def delete_history():
             
         # 刪除指定日期的資料
         cursor.execute("DELETE FROM daily_history WHERE date = ?", (date_str,))
+        refresh_history_aggregates(conn, [date_str])
         conn.commit()
         conn.close()
+        bump_history_version(portfolio_name)
         
         print(f"[Delete History] Data for {date_str} deleted successfully.")
         return jsonify({"status": "success", "message": f"Data for {date_str} deleted successfully."})
@@ -1536,16 +4232,174 @@ def trigger_snapshot():
         print(f"Error triggering snapshot: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.errorhandler(PortfolioNotFound)
+def handle_portfolio_not_found(e):
+    return jsonify({"status": "error", "message": f"Portfolio not found: {e.args[0]}"}), 404
+
+@app.route('/api/portfolios', methods=['GET'])
+def get_portfolios():
+    """
+    (新) 列出所有投資組合與各自的持股數量
+    """
+    return jsonify({
+        "status": "success",
+        "portfolios": [
+            {"name": name, "holdings": len(get_portfolio_store(name).snapshot()[1])}
+            for name in list_portfolios()
+        ]
+    })
+
+@app.route('/api/portfolios', methods=['POST'])
+def add_portfolio():
+    """
+    (新) 建立新的具名投資組合 (各自有獨立的持股與歷史資料庫)
+    """
+    data = request.get_json(silent=True) or {}
+    name = data.get('name')
+    try:
+        create_portfolio(name)
+    except ValueError as e:
+        status = 409 if name in list_portfolios() else 400
+        return jsonify({"status": "error", "message": str(e)}), status
+    return jsonify({"status": "success", "name": name}), 201
+
+@app.route('/api/ticker_metadata', methods=['GET'])
+def get_ticker_metadata_route():
+    """
+    (新) 從本地快取讀取股票基本資料 (?tickers=2330.TW,AAPL，未指定時為目前投資組合的所有持股)
+    """
+    tickers_param = request.args.get('tickers')
+    if tickers_param:
+        tickers = [ticker.strip() for ticker in tickers_param.split(',') if ticker.strip()]
+    else:
+        tickers = get_portfolio_store(resolve_portfolio_name()).snapshot()[1]
+    metadata = get_ticker_metadata(tickers)
+    with METADATA_PENDING_LOCK:
+        pending = sorted(METADATA_PENDING)
+    return jsonify({
+        "status": "success",
+        "metadata": metadata,
+        "missing": [ticker for ticker in tickers if ticker not in metadata],
+        "pending": pending
+    })
+
+@app.route('/api/ticker_metadata/prefetch', methods=['POST'])
+def prefetch_ticker_metadata_route():
+    """
+    (新) 在背景批次補齊股票基本資料 ({"tickers": [...], "force": false})
+    """
+    data = request.get_json(silent=True) or {}
+    tickers = data.get('tickers')
+    if not isinstance(tickers, list) or not tickers:
+        return jsonify({"status": "error", "message": "Missing tickers"}), 400
+    queued = prefetch_ticker_metadata(tickers, force=bool(data.get('force')))
+    return jsonify({"status": "success", "queued": queued}), 202
+
+@app.route('/api/quote_cache_stats', methods=['GET'])
+def get_quote_cache_stats():
+    """
+    (新) 獲取報價快取的 hit/miss 統計
+    """
+    return jsonify({
+        "status": "success",
+        "stats": QUOTE_CACHE.snapshot_stats()
+    })
+
+@app.route('/api/provider_health', methods=['GET'])
+def get_provider_health():
+    """
+    (新) 獲取每個報價來源的斷路器狀態、錯誤率與延遲百分位數
+    """
+    return jsonify({
+        "status": "success",
+        "providers": {name: breaker.health() for name, breaker in CIRCUIT_BREAKERS.items()}
+    })
+
+@app.route('/api/fx_rates', methods=['GET'])
+def get_fx_rates():
+    """
+    (新) 獲取匯率服務的狀態 (資料年齡、是否正在背景更新) 與常用幣別匯率
+    """
+    return jsonify({
+        "status": "success",
+        "fx": FX_SERVICE.status()
+    })
+
+@app.route('/api/rate_limits', methods=['GET'])
+def get_rate_limits():
+    """
+    (新) 獲取每個上游來源的限流設定與使用統計
+    """
+    return jsonify({
+        "status": "success",
+        "providers": RATE_LIMITER.stats()
+    })
+
+@app.route('/api/http_pool_stats', methods=['GET'])
+def get_http_pool_stats():
+    """
+    (新) 獲取上游 HTTP 連線池的使用統計 (可確認 keep-alive 是否生效)
+    """
+    return jsonify({
+        "status": "success",
+        "providers": HTTP_CLIENT.stats()
+    })
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """
+    (新) Prometheus 格式的效能指標：每個階段 / 來源的呼叫次數、錯誤次數與延遲直方圖
+    (stage: http / quotes / provider / fx / valuation / db / job)
+    """
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/profiles', methods=['GET'])
+def get_profiles():
+    """
+    (新) 列出最近的請求剖析結果 (僅限 admin)
+    """
+    if not is_admin():
+        return jsonify({"status": "error", "message": "Admin only"}), 403
+    with PROFILE_STORE_LOCK:
+        profiles = list(PROFILE_STORE.values())
+    return jsonify({
+        "status": "success",
+        "profiles": [
+            {key: profile[key] for key in ("id", "method", "path", "status", "created_at", "wall_ms", "cpu_ms")}
+            for profile in reversed(profiles)
+        ]
+    })
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """
+    (新) 獲取單一剖析結果：熱點函式 (依累計時間排序)、呼叫樹、wall / CPU 時間 (僅限 admin)
+    """
+    if not is_admin():
+        return jsonify({"status": "error", "message": "Admin only"}), 403
+    with PROFILE_STORE_LOCK:
+        profile = PROFILE_STORE.get(profile_id)
+    if profile is None:
+        return jsonify({"status": "error", "message": f"Profile '{profile_id}' not found"}), 404
+    return jsonify({"status": "success", "profile": profile})
+
 @app.route('/api/debug_messages', methods=['GET'])
 def get_debug_messages():
     """
     獲取最新的除錯訊息
+    (修改) since=<seq> 時只回傳流水號大於 seq 的訊息
+    (修改) 多 worker 時讀取共用狀態，流水號在所有 worker 之間連續
     """
-    # Convert deque to list for JSON serialization
-    messages = list(DEBUG_MESSAGES)
+    since = request.args.get('since', default=0, type=int)
+    if SHARED_STATE.enabled:
+        entries, last_seq, truncated = SHARED_STATE.messages_since(since)
+    else:
+        entries, last_seq, truncated = DEBUG_MESSAGES.since(since)
     return jsonify({
         "status": "success",
-        "messages": messages
+        "messages": [text for _, text in entries],
+        "last_seq": last_seq,
+        "truncated": truncated
     })
 
 if __name__ == '__main__':
@@ -0,0 +1,312 @@
+"""
+本地替身上游伺服器 (MIS、Sina、Yahoo、匯率)，供壓力測試使用。
+
+每個替身都是獨立的 HTTP 伺服器，可設定延遲 (含隨機抖動) 與錯誤率，
+回應格式與真實 API 相同，因此 app.py 的解析程式會被完整執行。
+價格由 ticker 決定基準價，再加上小幅隨機波動。
+
+yfinance 無法設定 API 端點，所以另外提供 FakeYFinance：
+介面與 app.py 用到的 yfinance 函式相同 (download / Ticker / Tickers)，
+但改為向替身 Yahoo 伺服器發出 HTTP 請求。
+"""
+
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import requests
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+FAKE_FX_RATES = {"TWD": 1.0, "CNY": 0.2273, "USD": 0.03125, "HKD": 0.2439, "JPY": 4.76}
+
+INTRADAY_MINUTES = {"5m": 5, "15m": 15, "30m": 30, "60m": 60, "1h": 60}
+PERIOD_DAYS = {"1d": 1, "5d": 5, "7d": 7, "1mo": 31, "3mo": 92, "6mo": 183, "1y": 366, "2y": 731, "5y": 1827, "max": 3650}
+
+
+def base_price(symbol):
+    """每個 ticker 固定的基準價 (10 ~ 1000)"""
+    return 10 + zlib.crc32(symbol.encode()) % 99000 / 100
+
+
+def live_price(symbol):
+    return round(base_price(symbol) * (1 + random.uniform(-0.02, 0.02)), 2)
+
+
+class FakeUpstreamServer(ThreadingHTTPServer):
+    """
+    單一替身上游。render(url) 回傳 (content_type, body 字串)。
+    latency_ms / jitter_ms 為每個請求的延遲，error_rate 為回傳 503 的機率。
+    """
+    daemon_threads = True
+
+    def __init__(self, name, render, latency_ms=0, jitter_ms=0, error_rate=0.0, host='127.0.0.1', port=0):
+        super().__init__((host, port), FakeUpstreamHandler)
+        self.name = name
+        self.render = render
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.stats = {"requests": 0, "errors": 0}
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=f"fake-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, error):
+        with self._stats_lock:
+            self.stats["requests"] += 1
+            if error:
+                self.stats["errors"] += 1
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        delay = server.latency_ms + random.uniform(-server.jitter_ms, server.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        error = random.random() < server.error_rate
+        server.count(error)
+        if error:
+            status, content_type, body = 503, 'text/plain', 'Service Unavailable'
+        else:
+            try:
+                content_type, body = server.render(urlparse(self.path))
+                status = 200
+            except Exception as e:
+                status, content_type, body = 400, 'text/plain', str(e)
+
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', f"{content_type}; charset=utf-8")
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# --- MIS ---
+def _load_mis_template():
+    with open(os.path.join(FIXTURES_DIR, 'mis_getStockInfo.json'), 'r', encoding='utf-8') as f:
+        recorded = json.load(f)
+    return recorded, recorded["msgArray"][0]
+
+
+def make_mis_renderer():
+    recorded, template = _load_mis_template()
+
+    def render(url):
+        query = parse_qs(url.query).get('ex_ch', [''])[0]
+        messages = []
+        for part in filter(None, query.split('|')):
+            exchange, channel = part.split('_', 1)
+            code = channel.rsplit('.', 1)[0]
+            price = live_price(code)
+            prev_close = round(base_price(code), 2)
+            messages.append(dict(
+                template, c=code, ch=channel, ex=exchange, n=code, nf=code,
+                z=f"{price:.4f}", y=f"{prev_close:.4f}", o=f"{prev_close:.4f}",
+                a=f"{price + 0.05:.4f}_", b=f"{price - 0.05:.4f}_"
+            ))
+        return 'application/json', json.dumps(dict(recorded, msgArray=messages), ensure_ascii=False)
+    return render
+
+
+# --- Sina ---
+def make_sina_renderer():
+    with open(os.path.join(FIXTURES_DIR, 'sina_hq.txt'), 'r', encoding='utf-8') as f:
+        template = f.readline()
+    fields = template[template.index('="') + 2:template.rindex('"')].split(',')
+
+    def render(url):
+        symbols = url.path.split('list=', 1)[-1].split(',')
+        lines = []
+        for symbol in filter(None, symbols):
+            parts = list(fields)
+            parts[0] = symbol
+            parts[2] = f"{base_price(symbol):.3f}"
+            parts[3] = f"{live_price(symbol):.3f}"
+            lines.append(f'var hq_str_{symbol}="{",".join(parts)}";')
+        return 'application/javascript', '\n'.join(lines) + '\n'
+    return render
+
+
+# --- 匯率 ---
+def make_fx_renderer():
+    def render(url):
+        return 'application/json', json.dumps({"result": "success", "base_code": "TWD", "rates": FAKE_FX_RATES})
+    return render
+
+
+# --- Yahoo ---
+def _chart_points(symbol, start, end, interval):
+    """start ~ end 之間每個工作日 (或盤中每 interval 分鐘) 一筆 OHLCV"""
+    points = []
+    if interval in INTRADAY_MINUTES:
+        step = timedelta(minutes=INTRADAY_MINUTES[interval])
+        current = start.replace(hour=9, minute=0, second=0, microsecond=0)
+        while current < end:
+            if current.weekday() < 5 and 9 <= current.hour < 14:
+                points.append(current)
+            current += step
+    else:
+        current = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        while current < end:
+            if current.weekday() < 5:
+                points.append(current)
+            current += timedelta(days=1)
+
+    base = base_price(symbol)
+    rng = random.Random(symbol)
+    closes = []
+    for _ in points:
+        base *= 1 + rng.uniform(-0.015, 0.015)
+        closes.append(round(base, 2))
+    return points, closes
+
+
+def make_yahoo_renderer():
+    def render(url):
+        query = parse_qs(url.query)
+        if url.path.startswith('/v8/finance/chart/'):
+            symbol = url.path.rsplit('/', 1)[-1]
+            start = datetime.fromtimestamp(int(query['period1'][0]))
+            end = datetime.fromtimestamp(int(query['period2'][0]))
+            interval = query.get('interval', ['1d'])[0]
+            points, closes = _chart_points(symbol, start, end, interval)
+            result = {
+                "meta": {"symbol": symbol, "currency": "USD"},
+                "timestamp": [int(point.timestamp()) for point in points],
+                "indicators": {"quote": [{
+                    "open": closes, "high": [round(c * 1.01, 2) for c in closes],
+                    "low": [round(c * 0.99, 2) for c in closes], "close": closes,
+                    "volume": [1000 + i for i in range(len(closes))]
+                }]}
+            }
+            return 'application/json', json.dumps({"chart": {"result": [result], "error": None}})
+        if url.path == '/v7/finance/quote':
+            symbols = query.get('symbols', [''])[0].split(',')
+            return 'application/json', json.dumps({"quoteResponse": {"result": [
+                {
+                    "symbol": symbol, "shortName": f"Fake {symbol}", "exchange": "NMS", "currency": "USD",
+                    "sector": "Technology", "regularMarketPrice": live_price(symbol),
+                    "regularMarketPreviousClose": round(base_price(symbol), 2)
+                }
+                for symbol in filter(None, symbols)
+            ]}})
+        raise ValueError(f"Unknown Yahoo path: {url.path}")
+    return render
+
+
+class FakeYFinance:
+    """
+    取代 app.yf 的 yfinance 替身，只實作 app.py 用到的部分，
+    所有資料都向替身 Yahoo 伺服器請求 (因此延遲與錯誤率同樣生效)。
+    """
+    def __init__(self, base_url, timeout=10):
+        self.base_url = base_url
+        self.timeout = timeout
+        self._session = requests.Session()
+
+    def _get(self, path, params):
+        response = self._session.get(f"{self.base_url}{path}", params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def chart(self, symbol, start, end, interval='1d'):
+        data = self._get(f"/v8/finance/chart/{symbol}", {
+            "period1": int(start.timestamp()), "period2": int(end.timestamp()), "interval": interval
+        })["chart"]["result"][0]
+        quote = data["indicators"]["quote"][0]
+        index = pd.DatetimeIndex([datetime.fromtimestamp(ts) for ts in data["timestamp"]], name='Date')
+        return pd.DataFrame({
+            "Open": quote["open"], "High": quote["high"], "Low": quote["low"],
+            "Close": quote["close"], "Volume": quote["volume"]
+        }, index=index)
+
+    def quote(self, symbol):
+        return self._get('/v7/finance/quote', {"symbols": symbol})["quoteResponse"]["result"][0]
+
+    def download(self, tickers, start=None, end=None, interval='1d', group_by='column', progress=False, **kwargs):
+        symbols = tickers.split() if isinstance(tickers, str) else list(tickers)
+        start = datetime.combine(start, datetime.min.time()) if start else datetime.now() - timedelta(days=31)
+        end = datetime.combine(end, datetime.min.time()) if end else datetime.now()
+        frames = {symbol: self.chart(symbol, start, end, interval) for symbol in symbols}
+        if group_by == 'ticker':
+            return pd.concat(frames, axis=1)
+        return pd.concat(frames, axis=1).swaplevel(axis=1)
+
+    def Ticker(self, symbol):
+        return FakeTicker(self, symbol)
+
+    def Tickers(self, tickers):
+        return FakeTickers(self, tickers.split())
+
+
+class FakeTicker:
+    def __init__(self, client, symbol):
+        self._client = client
+        self.ticker = symbol
+
+    def history(self, period='1mo', interval='1d', **kwargs):
+        end = datetime.now()
+        start = end - timedelta(days=PERIOD_DAYS.get(period, 31))
+        return self._client.chart(self.ticker, start, end, interval)
+
+    @property
+    def fast_info(self):
+        quote = self._client.quote(self.ticker)
+        return {"last_price": quote["regularMarketPrice"], "previousClose": quote["regularMarketPreviousClose"]}
+
+    @property
+    def info(self):
+        return self._client.quote(self.ticker)
+
+
+class FakeTickers:
+    def __init__(self, client, symbols):
+        self.tickers = {symbol: FakeTicker(client, symbol) for symbol in symbols}
+
+
+RENDERERS = {
+    "mis": make_mis_renderer,
+    "sina": make_sina_renderer,
+    "yahoo": make_yahoo_renderer,
+    "fx": make_fx_renderer
+}
+
+
+def start_fake_upstreams(behaviors):
+    """
+    behaviors: {"mis": {"latency_ms": 100, "jitter_ms": 20, "error_rate": 0.01}, ...}
+    回傳 {provider: FakeUpstreamServer}
+    """
+    return {
+        name: FakeUpstreamServer(name, RENDERERS[name](), **behaviors.get(name, {})).start()
+        for name in RENDERERS
+    }
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+端對端壓力測試。
+
+啟動本地替身 MIS / Sina / Yahoo / 匯率伺服器 (可設定延遲與錯誤率)，
+把 app 指向它們，再以多個並行客戶端持續呼叫
+/api/portfolio、/api/history_summary 與 /api/stock_history，
+最後回報每個端點的吞吐量與 p50 / p95 / p99 延遲。
+
+用法:
+    python benchmarks/loadtest.py --clients 50 --duration 30
+    python benchmarks/loadtest.py --latency-ms 300 --error-rate 0.05 --override mis:800:0.2
+    python benchmarks/loadtest.py --output benchmarks/results/loadtest.json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+import requests
+from werkzeug.serving import make_server
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import app
+from fake_upstreams import FakeYFinance, start_fake_upstreams
+from run_benchmarks import build_portfolio, fill_history
+
+ENDPOINTS = ("portfolio", "history_summary", "stock_history")
+STOCK_HISTORY_QUERIES = [("30d", "1d"), ("3mo", "1d"), ("1y", "1wk"), ("5d", "60m")]
+UNLIMITED_RATE = (1e9, 1e9)
+
+
+def out(message=""):
+    # app.py 會接管 print，報告直接寫到 stdout
+    sys.stdout.write(message + "\n")
+    sys.stdout.flush()
+
+
+def parse_mix(text):
+    """'portfolio=6,history_summary=2,stock_history=2' -> {endpoint: 權重}"""
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"Unknown endpoint in mix: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+def parse_override(text):
+    """'mis:800:0.2' -> ('mis', {"latency_ms": 800, "error_rate": 0.2})"""
+    name, latency_ms, error_rate = text.split(':')
+    return name, {"latency_ms": float(latency_ms), "error_rate": float(error_rate)}
+
+
+def summarize(samples, elapsed):
+    latencies = np.array([latency for latency, ok in samples], dtype=float) * 1000
+    errors = sum(1 for latency, ok in samples if not ok)
+    if not len(latencies):
+        return {"requests": 0, "errors": 0, "throughput_rps": 0.0}
+    return {
+        "requests": int(len(latencies)),
+        "errors": errors,
+        "error_rate": round(errors / len(latencies), 4),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "latency_ms": {
+            "p50": round(float(np.percentile(latencies, 50)), 2),
+            "p95": round(float(np.percentile(latencies, 95)), 2),
+            "p99": round(float(np.percentile(latencies, 99)), 2),
+            "max": round(float(latencies.max()), 2)
+        }
+    }
+
+
+def run_client(base_url, tickers, mix, start_at, stop_at, results, lock):
+    session = requests.Session()
+    rng = random.Random()
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    local = {name: [] for name in names}
+
+    while perf_counter() < stop_at:
+        endpoint = rng.choices(names, weights)[0]
+        if endpoint == "portfolio":
+            url = f"{base_url}/api/portfolio"
+        elif endpoint == "history_summary":
+            url = f"{base_url}/api/history_summary"
+        else:
+            period, interval = rng.choice(STOCK_HISTORY_QUERIES)
+            url = f"{base_url}/api/stock_history/{rng.choice(tickers)}?period={period}&interval={interval}"
+
+        t0 = perf_counter()
+        try:
+            response = session.get(url, timeout=60)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        finished = perf_counter()
+        if t0 >= start_at:  # 暖機期間的結果不列入統計
+            local[endpoint].append((finished - t0, ok))
+
+    with lock:
+        for name, samples in local.items():
+            results[name].extend(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端對端壓力測試 (本地替身上游)")
+    parser.add_argument('--clients', type=int, default=20, help="並行客戶端數量")
+    parser.add_argument('--duration', type=float, default=30, help="量測秒數 (不含暖機)")
+    parser.add_argument('--warmup', type=float, default=5, help="暖機秒數")
+    parser.add_argument('--portfolio-size', type=int, default=50, help="持股數量 (70%% 台股 / 20%% 陸股 / 10%% 美股)")
+    parser.add_argument('--history-rows', type=int, default=1000, help="daily_history 筆數")
+    parser.add_argument('--latency-ms', type=float, default=80, help="所有替身上游的平均延遲")
+    parser.add_argument('--jitter-ms', type=float, default=20, help="延遲的隨機抖動")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="所有替身上游回傳 503 的機率")
+    parser.add_argument('--override', type=parse_override, action='append', default=[],
+                        help="個別上游的設定，格式 provider:latency_ms:error_rate (provider: mis/sina/yahoo/fx)")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix("portfolio=6,history_summary=2,stock_history=2"),
+                        help="端點權重，例如 portfolio=6,history_summary=2,stock_history=2")
+    parser.add_argument('--no-rate-limit', action='store_true', help="關閉 app 對上游的限流")
+    parser.add_argument('--verbose', action='store_true', help="顯示 app 的 print 輸出")
+    parser.add_argument('--output', help="結果 JSON 路徑")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        app.original_print = lambda *a, **k: None
+
+    behaviors = {
+        name: {"latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "error_rate": args.error_rate}
+        for name in ("mis", "sina", "yahoo", "fx")
+    }
+    for name, behavior in args.override:
+        behaviors[name].update(behavior)
+    upstreams = start_fake_upstreams(behaviors)
+
+    workdir = tempfile.mkdtemp(prefix='tw-stock-loadtest-')
+    app.app.config.update(
+        HISTORY_DB=os.path.join(workdir, 'history.db'),
+        PORTFOLIO_FILE=os.path.join(workdir, 'portfolio.json'),
+        PORTFOLIOS_DIR=os.path.join(workdir, 'portfolios'),
+        UPSTREAM_URLS={
+            "mis": f"{upstreams['mis'].url}/stock/api/getStockInfo.jsp",
+            "sina": f"{upstreams['sina'].url}/list=",
+            "fx": f"{upstreams['fx'].url}/v6/latest/TWD"
+        }
+    )
+    app.yf = FakeYFinance(upstreams['yahoo'].url)
+    if args.no_rate_limit:
+        for provider in app.RATE_LIMITS:
+            app.RATE_LIMITER.configure(provider, *UNLIMITED_RATE)
+
+    portfolio, _ = build_portfolio(args.portfolio_size)
+    tickers = [stock["ticker"] for stock in portfolio]
+    with app.app.app_context():
+        app.PORTFOLIO_STORE.save(portfolio)
+        fill_history(args.history_rows)
+
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    out(f"app: {base_url}  clients: {args.clients}  warmup: {args.warmup}s  duration: {args.duration}s")
+    out("upstreams: " + ", ".join(
+        f"{name}={behavior['latency_ms']:.0f}ms/{behavior['error_rate']:.0%}" for name, behavior in behaviors.items()
+    ))
+
+    results = {name: [] for name in args.mix}
+    lock = threading.Lock()
+    start_at = perf_counter() + args.warmup
+    stop_at = start_at + args.duration
+    clients = [
+        threading.Thread(target=run_client, args=(base_url, tickers, args.mix, start_at, stop_at, results, lock))
+        for _ in range(args.clients)
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    server.shutdown()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "clients": args.clients,
+            "duration_s": args.duration,
+            "portfolio_size": args.portfolio_size,
+            "history_rows": args.history_rows,
+            "rate_limited": not args.no_rate_limit,
+            "upstreams": behaviors
+        },
+        "endpoints": {name: summarize(samples, args.duration) for name, samples in results.items()},
+        "overall": summarize([sample for samples in results.values() for sample in samples], args.duration),
+        "upstream_requests": {name: dict(server.stats) for name, server in upstreams.items()},
+        "quote_cache": app.QUOTE_CACHE.snapshot_stats()
+    }
+
+    out()
+    out(f"{'endpoint':<18}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in list(report["endpoints"].items()) + [("overall", report["overall"])]:
+        latency = stats.get("latency_ms", {})
+        out(f"{name:<18}{stats['requests']:>10}{stats['errors']:>8}{stats['throughput_rps']:>10.1f}"
+            f"{latency.get('p50', 0):>10.1f}{latency.get('p95', 0):>10.1f}{latency.get('p99', 0):>10.1f}")
+    out()
+    out("upstream requests: " + ", ".join(
+        f"{name}={stats['requests']} ({stats['errors']} errors)" for name, stats in report["upstream_requests"].items()
+    ))
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        out(f"結果已寫入 {args.output}")
+
+    for server_ in upstreams.values():
+        server_.stop()
+
+
+if __name__ == "__main__":
+    main()
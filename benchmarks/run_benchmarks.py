@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+離線效能基準測試 (不需要網路)。
+
+以 benchmarks/fixtures/ 裡錄下的 MIS / Sina 回應為樣本，放大成指定數量的股票後，
+量測以下幾段程式的耗時 (匯率表由本地替身伺服器提供，不會連到 open.er-api.com)：
+- get_mis_tw_prices 的 JSON 解析 (含 z 無效時的 a/b/o 備援)
+- get_sina_current_prices 的文字解析
+- /api/portfolio 的估值 (build_portfolio_payload 與向量化估值核心)
+- /api/history_summary 的 SQL (全部資料與 since 增量查詢)
+
+每個案例在量測前先核對一次結果 (解析出的價格等於錄下的值、估值等於逐筆計算的參考值、
+MTD / YTD 等於直接以 SQL 算出的值)，結果不對時直接失敗，不會留下看似正常的數字。
+結果輸出成 JSON，可用 --compare 與之前的結果比較是否退步。
+
+用法:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --quick --filter mis
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/baseline.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+from time import perf_counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+# 將 app.py 所在目錄加入 Python 路徑，以便 import
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import numpy as np
+import pandas as pd
+
+import app
+from fake_upstreams import FAKE_FX_RATES, FakeUpstreamServer, make_fx_renderer
+
+TICKER_SIZES = [10, 1000, 10000]
+HISTORY_SIZES = [1000, 100000]
+MIN_REPEAT = 3
+MAX_REPEAT = 50
+TARGET_SECONDS = 0.5  # 每個案例至少量測這麼久 (受 MIN_REPEAT / MAX_REPEAT 限制)
+DEFAULT_THRESHOLD = 1.25  # --compare 時，中位數變慢超過這個倍數就視為退步
+
+# 錄下的 MIS 回應每支股票應解析出的 (price, previous_close)
+MIS_EXPECTED = {
+    "2330": (1085.0, 1075.0),   # z 有成交價
+    "2317": (212.5, 211.5),     # z 為 '-'，取 a 的第一檔
+    "00679B": (45.2, 45.15),    # a 的第一檔為 0，改取 b
+    "0056": (36.85, 36.85),     # a 為 '-'，取 b
+    "6488": (412.5, 412.0),     # a / b 都是 '-'，取開盤價 o
+    "1101": (23.55, 23.55)      # b 為 0 且 o 為 '-'，取昨收 y
+}
+# 錄下的 Sina 回應每支股票應解析出的 (price, previous_close)
+SINA_EXPECTED = {
+    "600000": (8.30, 8.23),
+    "601138": (53.05, 51.88),
+    "000858": (122.98, 120.86),
+    "300750": (268.5, 268.5)    # 目前價為 0 (停牌)，改用昨收
+}
+
+
+class FixtureResponse:
+    """模擬 requests.Response，回傳錄下的內容"""
+    def __init__(self, text):
+        self.text = text
+        self.status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def load_fixture(filename):
+    with open(os.path.join(FIXTURES_DIR, filename), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def build_mis_payload(count):
+    """
+    把錄下的 MIS msgArray 循環複製成 count 支股票，
+    回傳 (tickers, JSON 字串, {ticker: 應解析出的 (price, previous_close)})
+    """
+    recorded = json.loads(load_fixture('mis_getStockInfo.json'))
+    templates = recorded["msgArray"]
+    tickers = []
+    messages = []
+    expected = {}
+    for i in range(count):
+        stock = dict(templates[i % len(templates)])
+        code = str(100000 + i)
+        suffix = '.TWO' if stock["ex"] == 'otc' else '.TW'
+        expected[code + suffix] = MIS_EXPECTED[stock["c"]]
+        stock["c"] = code
+        stock["ch"] = f"{code}.tw"
+        tickers.append(code + suffix)
+        messages.append(stock)
+    return tickers, json.dumps(dict(recorded, msgArray=messages), ensure_ascii=False), expected
+
+
+def build_sina_payload(count):
+    """
+    把錄下的 Sina 回應循環複製成 count 支股票，
+    回傳 (tickers, 回應文字, {ticker: 應解析出的 (price, previous_close)})
+    """
+    recorded = [line for line in load_fixture('sina_hq.txt').splitlines() if line]
+    tickers = []
+    lines = []
+    expected = {}
+    for i in range(count):
+        template = recorded[i % len(recorded)]
+        data = template[template.index('="'):]
+        code = str(600000 + i)
+        tickers.append(f"{code}.SS")
+        lines.append(f"var hq_str_sh{code}{data}")
+        expected[f"{code}.SS"] = SINA_EXPECTED[template[len('var hq_str_sh'):template.index('="')]]
+    return tickers, '\n'.join(lines) + '\n', expected
+
+
+def build_portfolio(count):
+    """70% 台股、20% 陸股、10% 美股的投資組合與對應報價"""
+    portfolio = []
+    prices = {}
+    for i in range(count):
+        bucket = i % 10
+        if bucket < 7:
+            ticker, currency = f"{100000 + i}.TW", "TWD"
+        elif bucket < 9:
+            ticker, currency = f"{600000 + i}.SS", "CNY"
+        else:
+            ticker, currency = f"US{i}", "USD"
+        portfolio.append({
+            "ticker": ticker, "name": ticker, "currency": currency,
+            "shares": float(100 + i % 900), "avg_cost": 10.0 + i % 500
+        })
+        prices[ticker] = {"price": 11.0 + i % 480, "previous_close": 10.5 + i % 490, "source": "MIS"}
+    return portfolio, prices
+
+
+def start_fake_fx():
+    """
+    以替身伺服器提供固定的匯率表 (FAKE_FX_RATES) 並先更新一次 FX_SERVICE，
+    量測期間匯率表是新的，不會觸發背景更新，也不會連到真正的匯率 API
+    """
+    server = FakeUpstreamServer('fx', make_fx_renderer()).start()
+    app.app.config['UPSTREAM_URLS'] = {"fx": f"{server.url}/v6/latest/TWD"}
+    app.FX_SERVICE.refresh_now()
+    fx_rates = app.FX_SERVICE.rates_to_twd()
+    expected = {currency: 1.0 / rate for currency, rate in FAKE_FX_RATES.items()}
+    assert all(np.isclose(fx_rates[currency], rate) for currency, rate in expected.items()), \
+        "FX_SERVICE did not load the fake exchange rate table"
+    return server
+
+
+def expected_totals(portfolio, prices, fx_rates):
+    """逐筆計算的參考值 (台幣總市值 / 台股市值 / 陸股市值)，用來核對向量化估值"""
+    totals = {"market_value": 0.0, "tw_value": 0.0, "cn_value": 0.0}
+    for stock in portfolio:
+        value = prices[stock["ticker"]]["price"] * stock["shares"] * fx_rates[stock["currency"]]
+        totals["market_value"] += value
+        if stock["currency"] == "TWD":
+            totals["tw_value"] += value
+        elif stock["currency"] == "CNY":
+            totals["cn_value"] += value
+    return totals
+
+
+def check_totals(actual, expected):
+    for key, value in expected.items():
+        assert np.isclose(float(actual[key]), value, rtol=1e-9), f"{key}: {float(actual[key])} != {value}"
+
+
+def check_prices(result, expected, source):
+    assert len(result) == len(expected), f"{source} parsed {len(result)} of {len(expected)}"
+    for ticker, (price, previous_close) in expected.items():
+        data = result[ticker]
+        assert (data["price"], data["previous_close"]) == (price, previous_close), \
+            f"{source} {ticker}: got {data['price']}/{data['previous_close']}, expected {price}/{previous_close}"
+
+
+def fill_history(rows):
+    """寫入 rows 筆連續日期的 daily_history 並重建彙總表"""
+    start = date.today() - timedelta(days=rows - 1)
+    rng = np.random.default_rng(0)
+    totals = 1e6 * np.cumprod(1 + rng.normal(0, 0.01, rows))
+    data = [
+        ((start + timedelta(days=i)).isoformat(), round(float(total), 4), round(float(total) * 0.7, 4), round(float(total) * 0.3, 4))
+        for i, total in enumerate(totals)
+    ]
+    conn = app.get_db_conn()
+    conn.execute("DELETE FROM daily_history")
+    conn.executemany("INSERT INTO daily_history (date, total, tw_value, cn_value) VALUES (?, ?, ?, ?)", data)
+    app.rebuild_history_aggregates(conn)
+    conn.commit()
+    conn.close()
+
+
+def measure(func):
+    """重複執行 func，回傳每次耗時 (秒) 的統計"""
+    func()  # 暖機 (建立連線、填快取等)
+    samples = []
+    started = perf_counter()
+    while len(samples) < MIN_REPEAT or (len(samples) < MAX_REPEAT and perf_counter() - started < TARGET_SECONDS):
+        t0 = perf_counter()
+        func()
+        samples.append(perf_counter() - t0)
+    return {
+        "iterations": len(samples),
+        "min_s": min(samples),
+        "median_s": statistics.median(samples),
+        "mean_s": statistics.fmean(samples),
+        "p95_s": float(np.percentile(samples, 95)),
+        "stdev_s": statistics.stdev(samples) if len(samples) > 1 else 0.0
+    }
+
+
+def bench_mis_parse(count):
+    tickers, payload, expected = build_mis_payload(count)
+    app.HTTP_CLIENT.get = lambda provider, url, **kwargs: FixtureResponse(payload)
+    check_prices(app.get_mis_tw_prices(tickers), expected, "MIS")
+
+    def run():
+        result = app.get_mis_tw_prices(tickers)
+        assert len(result) == count, f"MIS parsed {len(result)} of {count}"
+    return run
+
+
+def bench_sina_parse(count):
+    tickers, payload, expected = build_sina_payload(count)
+    app.HTTP_CLIENT.get = lambda provider, url, **kwargs: FixtureResponse(payload)
+    check_prices(app.get_sina_current_prices(tickers), expected, "Sina")
+
+    def run():
+        result = app.get_sina_current_prices(tickers)
+        assert len(result) == count, f"Sina parsed {len(result)} of {count}"
+    return run
+
+
+def bench_portfolio_payload(count):
+    portfolio, prices = build_portfolio(count)
+    app.PORTFOLIO_STORE.save(portfolio)
+    app.get_current_prices = lambda tickers: {ticker: prices[ticker] for ticker in tickers}
+    check_totals(app.build_portfolio_payload()["totals"],
+                 expected_totals(portfolio, prices, app.FX_SERVICE.rates_to_twd()))
+
+    def run():
+        payload = app.build_portfolio_payload()
+        assert len(payload["stocks"]) == count
+    return run
+
+
+def bench_valuation_kernel(count):
+    portfolio, prices = build_portfolio(count)
+    fx_rates = app.FX_SERVICE.rates_to_twd()
+
+    def run():
+        holdings = app.Holdings(portfolio)
+        return app.value_holdings(
+            holdings,
+            holdings.price_vector(prices, 'price'),
+            holdings.price_vector(prices, 'previous_close'),
+            fx_rates
+        )
+    check_totals(run()["totals"], expected_totals(portfolio, prices, fx_rates))
+    return run
+
+
+def expected_period(period):
+    """直接以 SQL 算出某個月 (YYYY-MM) 或某年 (YYYY) 第一天與最後一天的 total"""
+    conn = app.get_db_conn()
+    try:
+        first, last = conn.execute(
+            "SELECT (SELECT total FROM daily_history WHERE date LIKE ? ORDER BY date ASC LIMIT 1),"
+            " (SELECT total FROM daily_history WHERE date LIKE ? ORDER BY date DESC LIMIT 1)",
+            (period + '%', period + '%')
+        ).fetchone()
+    finally:
+        conn.close()
+    return first or 0, last or 0
+
+
+def bench_history_summary(rows, since_days=None):
+    fill_history(rows)
+    client = app.app.test_client()
+    url = '/api/history_summary'
+    expected_days = rows
+    if since_days is not None:
+        url += f"?since={(date.today() - timedelta(days=since_days)).isoformat()}"
+        expected_days = min(rows, since_days + 1)
+
+    summary = client.get(url).get_json()
+    today = date.today().isoformat()
+    assert len(summary["daily"]) == expected_days, f"daily has {len(summary['daily'])} rows, expected {expected_days}"
+    for key, period in (("monthly", today[:7]), ("yearly", today[:4])):
+        first, last = expected_period(period)
+        assert np.isclose(summary[key]["start_value"], first) and np.isclose(summary[key]["end_value"], last), \
+            f"{key}: got {summary[key]['start_value']}/{summary[key]['end_value']}, expected {first}/{last}"
+
+    def run():
+        response = client.get(url)
+        assert response.status_code == 200
+    return run
+
+
+def build_cases(quick):
+    ticker_sizes = TICKER_SIZES[:1] if quick else TICKER_SIZES
+    history_sizes = HISTORY_SIZES[:1] if quick else HISTORY_SIZES
+    cases = []
+    for count in ticker_sizes:
+        cases.append(("mis_parse", {"tickers": count}, lambda count=count: bench_mis_parse(count)))
+        cases.append(("sina_parse", {"tickers": count}, lambda count=count: bench_sina_parse(count)))
+        cases.append(("valuation_kernel", {"tickers": count}, lambda count=count: bench_valuation_kernel(count)))
+        cases.append(("portfolio_payload", {"tickers": count}, lambda count=count: bench_portfolio_payload(count)))
+    for rows in history_sizes:
+        cases.append(("history_summary", {"rows": rows}, lambda rows=rows: bench_history_summary(rows)))
+        cases.append(("history_summary_since_30d", {"rows": rows}, lambda rows=rows: bench_history_summary(rows, 30)))
+    return cases
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+            capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def case_key(result):
+    return result["name"] + json.dumps(result["params"], sort_keys=True)
+
+
+def compare_results(results, baseline_path, threshold):
+    """印出與 baseline 的比較，回傳退步的案例數"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {case_key(result): result for result in json.load(f)["results"]}
+    regressions = 0
+    print(f"\n與 {baseline_path} 比較 (中位數，退步門檻 {threshold}x):")
+    for result in results:
+        base = baseline.get(case_key(result))
+        if base is None:
+            print(f"  {result['name']:<28} {json.dumps(result['params']):<20} (baseline 無此案例)")
+            continue
+        ratio = result["median_s"] / base["median_s"] if base["median_s"] else float('inf')
+        flag = ""
+        if ratio > threshold:
+            flag = "  <-- 退步"
+            regressions += 1
+        print(f"  {result['name']:<28} {json.dumps(result['params']):<20} {ratio:6.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="離線效能基準測試")
+    parser.add_argument('--output', help="結果 JSON 路徑 (預設 benchmarks/results/benchmark-<時間>.json)")
+    parser.add_argument('--compare', help="與之前的結果 JSON 比較")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="視為退步的倍數")
+    parser.add_argument('--filter', help="只執行名稱包含這個字串的案例")
+    parser.add_argument('--quick', action='store_true', help="只跑最小的規模")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='tw-stock-bench-')
+    app.app.config.update(
+        HISTORY_DB=os.path.join(workdir, 'history.db'),
+        PORTFOLIO_FILE=os.path.join(workdir, 'portfolio.json'),
+        PORTFOLIOS_DIR=os.path.join(workdir, 'portfolios')
+    )
+
+    fx_server = start_fake_fx()
+    results = []
+    with app.app.app_context():
+        for name, params, setup in build_cases(args.quick):
+            if args.filter and args.filter not in name:
+                continue
+            # 程式內的 print 會大量輸出，量測期間丟棄
+            with contextlib.redirect_stdout(io.StringIO()):
+                stats = measure(setup())
+            results.append(dict(name=name, params=params, **stats))
+            print(f"{name:<28} {json.dumps(params):<20} median {stats['median_s'] * 1000:10.3f} ms"
+                  f"  p95 {stats['p95_s'] * 1000:10.3f} ms  ({stats['iterations']} runs)")
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "quick": args.quick
+        },
+        "results": results
+    }
+    fx_server.stop()
+    output = args.output or os.path.join(RESULTS_DIR, f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\n結果已寫入 {output}")
+
+    if args.compare:
+        regressions = compare_results(results, args.compare, args.threshold)
+        if regressions:
+            print(f"{regressions} 個案例退步")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
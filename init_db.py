@@ -23,10 +23,60 @@ def create_database():
         )
         ''')
         
+        # (新) 建立 price_history 資料表 (本地每日價格庫)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS price_history (
+            ticker TEXT NOT NULL,
+            date TEXT NOT NULL,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL,
+            volume INTEGER,
+            PRIMARY KEY (ticker, date)
+        )
+        ''')
+        
+        # (新) 建立 price_sync_log 資料表 (記錄每支股票已同步的日期區間)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS price_sync_log (
+            ticker TEXT PRIMARY KEY,
+            synced_start TEXT NOT NULL,
+            synced_end TEXT NOT NULL
+        )
+        ''')
+        
+        # (新) 建立 history_aggregates 資料表 (月/年彙總)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS history_aggregates (
+            period TEXT PRIMARY KEY,
+            period_type TEXT NOT NULL,
+            first_date TEXT NOT NULL,
+            first_total REAL NOT NULL,
+            last_date TEXT NOT NULL,
+            last_total REAL NOT NULL,
+            min_total REAL NOT NULL,
+            max_total REAL NOT NULL,
+            days INTEGER NOT NULL
+        )
+        ''')
+        
+        # (新) 建立 ticker_metadata 資料表 (股票基本資料快取)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ticker_metadata (
+            ticker TEXT PRIMARY KEY,
+            name TEXT,
+            exchange TEXT,
+            currency TEXT,
+            sector TEXT,
+            updated_at TEXT NOT NULL
+        )
+        ''')
+        
         conn.commit()
         conn.close()
         print(f"資料庫 '{DB_FILE}' 已成功建立。")
-        print("資料表 'daily_history' 已成功建立。")
+        print("資料表 'daily_history'、'price_history'、'price_sync_log'、'history_aggregates'、'ticker_metadata' 已成功建立。")
         
     except Exception as e:
         print(f"建立資料庫時發生錯誤: {e}")
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+正式環境的多 worker 啟動腳本 (需要 fork，適用 Linux / macOS)。
+
+主行程先建立監聽 socket，再 fork 出多個 worker 共用同一個 socket，
+每個 worker 以 waitress (正式環境用的 WSGI server，固定大小的執行緒池) 處理請求；
+worker 意外結束時自動重新啟動。
+沒有安裝 waitress 時會退回 werkzeug 的開發伺服器並印出警告：它每個請求開一條新執行緒，
+沒有請求逾時與連線數上限，只適合本機測試。
+
+SSE 串流 (/api/portfolio/stream、/api/ask_ai/stream) 在連線期間會一直佔住一條執行緒，
+因此每個 worker 的串流數上限 (--max-streams，預設 --threads 的一半) 必須小於 --threads，
+剩下的執行緒保留給一般請求；超過上限的串流回 503，前端改用輪詢。
+worker 在 fork 之後才 import app，背景執行緒、連線池與 SQLite 連線不會跨行程共用。
+
+報價快取、匯率表、回補狀態、除錯訊息、歷史資料版本與投資組合回應版本存在共用的 SQLite 檔案
+(預設 shared_state.db，每次啟動時清空)，因此不論哪個 worker 處理請求，看到的狀態都一致。
+上游限流額度會依 worker 數平分。
+
+用法:
+    pip install waitress
+    python serve.py --workers 4 --threads 8 --port 5000
+"""
+
+import argparse
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SHARED_STATE_DB = os.path.join(BASE_DIR, 'shared_state.db')
+# 與 app.py 的 SHARED_STATE_DB_ENV / WORKER_COUNT_ENV 相同 (主行程不 import app)
+SHARED_STATE_DB_ENV = 'TW_STOCK_SHARED_STATE_DB'
+WORKER_COUNT_ENV = 'TW_STOCK_WORKERS'
+RESPAWN_DELAY_SECONDS = 1
+LISTEN_BACKLOG = 128
+DEFAULT_THREADS = 8  # 每個 worker 的 waitress 執行緒數
+# 與 app.py 的 MAX_STREAMS_ENV 相同
+MAX_STREAMS_ENV = 'TW_STOCK_MAX_STREAMS'
+
+
+def reset_shared_state(db_path):
+    """共用狀態只在這次執行期間有效 (例如上次中斷的回補狀態不應保留)"""
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.remove(db_path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def run_worker(sock, host, port, index, threads):
+    """在 fork 出來的子行程內執行，不會返回"""
+    sys.path.insert(0, BASE_DIR)
+    try:
+        import waitress
+    except ImportError:
+        waitress = None
+    import app
+
+    if waitress is not None:
+        print(f"[Worker {index}] pid {os.getpid()} serving on http://{host}:{port} (waitress, {threads} threads)", flush=True)
+        waitress.serve(app.app, sockets=[sock], threads=threads, ident='tw_stock')
+        return
+
+    from werkzeug.serving import make_server
+    print(f"[Worker {index}] WARNING: waitress is not installed; using the werkzeug development server. "
+          f"Run `pip install waitress` for production.", flush=True)
+    server = make_server(host, port, app.app, threaded=True, fd=sock.fileno())
+    print(f"[Worker {index}] pid {os.getpid()} serving on http://{host}:{port} (werkzeug)", flush=True)
+    server.serve_forever()
+
+
+def spawn_worker(sock, host, port, index, threads):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            run_worker(sock, host, port, index, threads)
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多 worker 的正式環境啟動腳本")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1), help="worker 行程數")
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS, help="每個 worker 的執行緒數 (waitress)")
+    parser.add_argument('--max-streams', type=int, default=None,
+                        help="每個 worker 同時開著的 SSE 串流上限 (預設 --threads 的一半，必須小於 --threads)")
+    parser.add_argument('--shared-state-db', default=os.environ.get(SHARED_STATE_DB_ENV, DEFAULT_SHARED_STATE_DB),
+                        help="共用狀態的 SQLite 檔案 (啟動時清空)")
+    args = parser.parse_args()
+
+    if not hasattr(os, 'fork'):
+        sys.exit("serve.py 需要 os.fork (Linux / macOS)；Windows 請使用 python app.py")
+    if args.threads < 2:
+        sys.exit("--threads 至少要 2 (串流之外要留執行緒給一般請求)")
+    max_streams = args.threads // 2 if args.max_streams is None else args.max_streams
+    if not 0 <= max_streams < args.threads:
+        sys.exit("--max-streams 必須介於 0 與 --threads - 1 之間，否則串流會佔滿所有執行緒")
+
+    reset_shared_state(args.shared_state_db)
+    os.environ[SHARED_STATE_DB_ENV] = args.shared_state_db
+    os.environ[WORKER_COUNT_ENV] = str(args.workers)
+    os.environ[MAX_STREAMS_ENV] = str(max_streams)
+
+    sock = socket.create_server((args.host, args.port), backlog=LISTEN_BACKLOG)
+    print(f"Starting {args.workers} workers on http://{args.host}:{args.port} "
+          f"({args.threads} threads, max {max_streams} streams each; shared state: {args.shared_state_db})", flush=True)
+
+    workers = {}  # pid -> worker 編號
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for index in range(args.workers):
+        workers[spawn_worker(sock, args.host, args.port, index, args.threads)] = index
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = workers.pop(pid, None)
+        if index is None or stopping:
+            continue
+        print(f"[Worker {index}] pid {pid} exited (status {status}). Restarting...", flush=True)
+        time.sleep(RESPAWN_DELAY_SECONDS)
+        if not stopping:
+            workers[spawn_worker(sock, args.host, args.port, index, args.threads)] = index
+
+    sock.close()
+    print("All workers stopped.")
+
+
+if __name__ == '__main__':
+    main()
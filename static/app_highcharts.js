@@ -1,6 +1,10 @@
 // (全域變數)
 let fetchInterval;
 const UPDATE_INTERVAL = 5000;
+let pollingInterval = UPDATE_INTERVAL; // (新) 輪詢備援的間隔
+let portfolioStream = null; // (新) SSE 連線
+let portfolioVersion = null; // (新) 上一次拿到的投資組合版本 (delta 模式)
+let portfolioSnapshot = null; // (新) 上一次的完整投資組合資料
 let isFetching = false;
 let backfillPollInterval = null;
 const loadingSpinner = document.getElementById('loading-spinner');
@@ -10,6 +14,7 @@ let historyChart = null;
 let previousStockData = {};
 let previousTotals = {};
 let historicalDailyData = {};
+let historyLastDate = null; // (新) 已快取 daily 資料的最後一天
 let currentSortKey = 'market_value';
 let currentSortDirection = 'desc';
 let currentRange = 'MTD';
@@ -17,6 +22,15 @@ let currentPerformanceType = 'total'; // 新增：績效類型 (total, tw, cn)
 let currentCnyRate = 1.0;
 let columnVisibility = {};
 let stockCharts = {}; // 儲存個股圖表實例
+// (新) 目前頁面的投資組合 (網址 ?portfolio=<name>，未指定時為 default)
+const currentPortfolioName = new URLSearchParams(window.location.search).get('portfolio');
+
+// (新) 在 API 網址後附加目前的投資組合名稱
+function withPortfolio(url) {
+    if (!currentPortfolioName || !url.startsWith('/api/')) return url;
+    const separator = url.includes('?') ? '&' : '?';
+    return `${url}${separator}portfolio=${encodeURIComponent(currentPortfolioName)}`;
+}
 
 // (格式化工具)
 const currencyFormatter = new Intl.NumberFormat('zh-TW', {
@@ -137,7 +151,7 @@ async function fetchWithRetry(url, options = {}, attempt = 0) {
     const timeoutId = setTimeout(() => controller.abort(), FETCH_TIMEOUT);
 
     try {
-        const response = await fetch(url, { ...options, signal: controller.signal });
+        const response = await fetch(withPortfolio(url), { ...options, signal: controller.signal });
         clearTimeout(timeoutId); // 清除超時
 
         if (!response.ok) {
@@ -238,10 +252,18 @@ async function fetchPortfolio() {
     if (loadingSpinner) loadingSpinner.style.display = 'block';
 
     try {
-        const response = await fetchWithRetry('/api/portfolio');
+        // (新) 帶上一次的版本號，伺服器只回傳有變動的部分
+        const url = portfolioVersion
+            ? `/api/portfolio?since_version=${encodeURIComponent(portfolioVersion)}`
+            : '/api/portfolio';
+        const response = await fetchWithRetry(url);
         const data = await response.json();
-        updateTotals(data.totals);
-        updateTable(data.stocks);
+        const fullData = data.delta ? applyPortfolioDelta(data) : data;
+        portfolioVersion = data.delta
+            ? data.version
+            : (response.headers.get('ETag') || '').replace(/"/g, '') || null;
+        portfolioSnapshot = fullData;
+        renderPortfolio(fullData);
     } catch (error) {
         console.error('Error fetching portfolio:', error);
         stopFetching();
@@ -257,6 +279,29 @@ async function fetchPortfolio() {
     }
 }
 
+// (新) 把 delta 回應套用到上一次的完整資料
+function applyPortfolioDelta(delta) {
+    const removed = new Set(delta.removed);
+    const changed = new Map(delta.stocks.map(stock => [stock.ticker, stock]));
+    const stocks = portfolioSnapshot.stocks
+        .filter(stock => !removed.has(stock.ticker))
+        .map(stock => changed.get(stock.ticker) || stock);
+    const known = new Set(stocks.map(stock => stock.ticker));
+    delta.stocks.forEach(stock => {
+        if (!known.has(stock.ticker)) stocks.push(stock);
+    });
+
+    const totals = { ...portfolioSnapshot.totals, ...delta.totals };
+    delta.removed_totals.forEach(key => delete totals[key]);
+    return { stocks, totals };
+}
+
+// (新) 更新畫面 (輪詢與 SSE 推播共用)
+function renderPortfolio(data) {
+    updateTotals(data.totals);
+    updateTable(data.stocks);
+}
+
 // (updateTotals - 包含 "新卡片" 的邏輯)
 function updateTotals(totals) {
     currentCnyRate = totals.cny_rate || 1.0;
@@ -918,15 +963,32 @@ function updateCell(row, key, newContent, classes = []) {
     }
 }
 
+// (新) 增量讀取歷史摘要：帶 since 只抓快取最後一天 (含) 之後的 daily 資料再合併，
+// 回補或刪除歷史後以 reset=true 重新抓取完整資料
+async function loadHistorySummary(reset = false) {
+    if (reset) {
+        historicalDailyData = {};
+        historyLastDate = null;
+    }
+    const url = historyLastDate
+        ? `/api/history_summary?since=${encodeURIComponent(historyLastDate)}`
+        : '/api/history_summary';
+    const response = await fetchWithRetry(url);
+    const data = await response.json();
+    const daily = data.daily || {};
+    historicalDailyData = historyLastDate ? { ...historicalDailyData, ...daily } : daily;
+    const dates = Object.keys(historicalDailyData).sort();
+    historyLastDate = dates.length > 0 ? dates[dates.length - 1] : null;
+    return data;
+}
+
 // (fetchHistorySummary - 讀取 .total)
-async function fetchHistorySummary() {
+async function fetchHistorySummary(reset = false) {
     try {
-        const response = await fetchWithRetry('/api/history_summary');
-        const data = await response.json();
+        await loadHistorySummary(reset);
 
-        if (data.daily && Object.keys(data.daily).length > 0) {
-            historicalDailyData = data.daily;
-            renderHistoryChart(data.daily);
+        if (Object.keys(historicalDailyData).length > 0) {
+            renderHistoryChart(historicalDailyData);
             calculateAndDisplayRange();
         }
 
@@ -1139,10 +1201,50 @@ function renderHistoryChart(dailyData) {
 // (startFetching, stopFetching, CRUD 函式 ... 保持不變)
 function startFetching() {
     fetchPortfolio();
-    fetchInterval = setInterval(fetchPortfolio, UPDATE_INTERVAL);
+    // (新) 優先使用 SSE 推播，不支援時才退回輪詢
+    if (window.EventSource) {
+        startPortfolioStream();
+    } else {
+        startPolling();
+    }
+}
+function startPolling() {
+    clearInterval(fetchInterval);
+    if (pollingInterval > 0) {
+        fetchInterval = setInterval(fetchPortfolio, pollingInterval);
+    }
 }
 function stopFetching() {
     clearInterval(fetchInterval);
+    if (portfolioStream) {
+        portfolioStream.close();
+        portfolioStream = null;
+    }
+}
+
+// (新) 訂閱伺服器推播的投資組合資料
+function startPortfolioStream() {
+    portfolioStream = new EventSource(withPortfolio('/api/portfolio/stream'));
+    portfolioStream.onopen = () => {
+        // 串流已建立，不需要再輪詢
+        clearInterval(fetchInterval);
+    };
+    portfolioStream.addEventListener('portfolio', (event) => {
+        const data = JSON.parse(event.data);
+        // 推播的是完整資料，下一次輪詢改拿完整回應
+        portfolioSnapshot = data;
+        portfolioVersion = null;
+        renderPortfolio(data);
+        const lastUpdatedEl = document.getElementById('last-updated');
+        lastUpdatedEl.textContent = `最後更新: ${new Date().toLocaleTimeString('zh-TW')}`;
+        lastUpdatedEl.style.display = 'inline';
+    });
+    portfolioStream.onerror = () => {
+        console.warn('Portfolio stream disconnected. Falling back to polling.');
+        portfolioStream.close();
+        portfolioStream = null;
+        startPolling();
+    };
 }
 function openModalForAdd() {
     document.getElementById('stock-form').reset();
@@ -1278,12 +1380,9 @@ async function showHistoricalDataRange() {
 
     try {
         // 獲取最新的歷史數據（帶重試機制）
-        const response = await fetchWithRetry('/api/history_summary');
-        const data = await response.json();
+        await loadHistorySummary();
 
-        if (data.daily && Object.keys(data.daily).length > 0) {
-            historicalDailyData = data.daily;
-        } else {
+        if (Object.keys(historicalDailyData).length === 0) {
             throw new Error('歷史資料為空');
         }
 
@@ -1420,12 +1519,9 @@ async function showHistoricalData(event) {
 
     try {
         // 獲取最新的歷史數據（帶重試機制）
-        const response = await fetchWithRetry('/api/history_summary');
-        const data = await response.json();
+        await loadHistorySummary();
 
-        if (data.daily && Object.keys(data.daily).length > 0) {
-            historicalDailyData = data.daily;
-        } else {
+        if (Object.keys(historicalDailyData).length === 0) {
             throw new Error('歷史資料為空');
         }
 
@@ -2017,8 +2113,8 @@ async function pollBackfillStatus(gracePeriod = 0) {
                     debugResult.className = 'alert alert-danger';
                 } else {
                     debugResult.className = 'alert alert-success';
-                    // 成功完成，自動重新整理歷史圖表
-                    fetchHistorySummary();
+                    // 成功完成，自動重新整理歷史圖表 (回補會改寫舊日期，重新抓取完整資料)
+                    fetchHistorySummary(true);
                 }
 
                 // 讓按鈕可以再次點擊
@@ -2147,8 +2243,8 @@ async function handleDeleteHistory() {
         debugResult.className = 'alert alert-danger';
     } finally {
         debugResult.style.display = 'block';
-        // 重新加載歷史數據以更新圖表
-        fetchHistorySummary();
+        // 重新加載歷史數據以更新圖表 (刪除會移除舊日期，重新抓取完整資料)
+        fetchHistorySummary(true);
     }
 }
 
@@ -2179,8 +2275,8 @@ async function sendAiChatMessage() {
     messagesContainer.scrollTop = messagesContainer.scrollHeight;
 
     try {
-        // 3. 發送請求到後端
-        const response = await fetchWithRetry('/api/ask_ai', { // (使用 fetchWithRetry)
+        // 3. (修改) 發送請求到後端串流端點，逐段顯示 AI 回覆
+        const response = await fetch(withPortfolio('/api/ask_ai/stream'), {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -2188,19 +2284,43 @@ async function sendAiChatMessage() {
             body: JSON.stringify({ question: question })
         });
 
+        // (新) 伺服器的串流名額已滿時改用非串流的 /api/ask_ai
+        if (response.status === 503) {
+            const fallback = await fetch(withPortfolio('/api/ask_ai'), {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({ question: question })
+            });
+            const fallbackData = await fallback.json();
+            if (!fallback.ok) {
+                throw new Error(fallbackData.error || 'API 請求失敗');
+            }
+            aiTypingEl.innerHTML = DOMPurify.sanitize(marked.parse(fallbackData.response || '(AI 沒有回覆任何內容)'));
+            return;
+        }
+
         if (!response.ok) {
             const errorData = await response.json();
             throw new Error(errorData.error || 'API 請求失敗');
         }
 
-        const data = await response.json();
+        let answer = '';
+        await readEventStream(response, (event, data) => {
+            if (event === 'token') {
+                answer += data.content;
+                // 4. 更新為 AI 回覆 (DOMPurify.sanitize() 會清除掉危險的標籤，例如 <script>)
+                aiTypingEl.innerHTML = DOMPurify.sanitize(marked.parse(answer));
+                messagesContainer.scrollTop = messagesContainer.scrollHeight;
+            } else if (event === 'error') {
+                throw new Error(data.error || 'AI 服務連線失敗');
+            }
+        });
 
-        // 4. 更新為 AI 回覆 (使用 textContent 避免 XSS)
-        const unsafeHtml = marked.parse(data.response);
-        // DOMPurify.sanitize() 會清除掉危險的標籤 (例如 <script>)
-        const safeHtml = DOMPurify.sanitize(unsafeHtml);
-        // 最後才安全地使用 innerHTML 
-        aiTypingEl.innerHTML = safeHtml;
+        if (!answer) {
+            aiTypingEl.textContent = '(AI 沒有回覆任何內容)';
+        }
 
     } catch (error) {
         console.error('Error asking AI:', error);
@@ -2212,6 +2332,35 @@ async function sendAiChatMessage() {
     }
 }
 
+// (新) 讀取 POST 回應中的 Server-Sent Events (EventSource 只支援 GET)
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const block = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let event = 'message';
+            const dataLines = [];
+            block.split('\n').forEach(line => {
+                if (line.startsWith('event:')) event = line.slice(6).trim();
+                else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+            });
+            if (dataLines.length === 0) continue; // 註解行 (例如 ": connected")
+            onEvent(event, JSON.parse(dataLines.join('\n')));
+            if (event === 'done') return;
+        }
+    }
+}
+
 // (新增) 清除日期範圍輸入
 function clearDateRange() {
     document.getElementById('date-range-start').value = '';
@@ -2276,10 +2425,11 @@ function saveSettings(settings) {
 // 應用設定
 function applySettings(settings) {
     // 更新資料獲取間隔
-    if (settings.updateInterval !== UPDATE_INTERVAL) {
-        stopFetching();
-        if (settings.updateInterval > 0) {
-            fetchInterval = setInterval(fetchPortfolio, settings.updateInterval);
+    // (修改) SSE 連線中時由伺服器推播，只更新輪詢備援的間隔
+    if (settings.updateInterval !== pollingInterval) {
+        pollingInterval = settings.updateInterval;
+        if (!portfolioStream) {
+            startPolling();
         }
     }
 
@@ -2486,6 +2636,8 @@ function initSettings() {
 
 // --- 除錯訊息功能 ---
 let debugMessagesInterval = null;
+let debugLastSeq = 0; // (新) 已顯示的最後一筆訊息流水號
+const DEBUG_CONSOLE_MAX_LINES = 500; // (新) 控制台最多保留的行數
 
 // 開始輪詢除錯訊息
 function startDebugMessagesPolling() {
@@ -2507,11 +2659,15 @@ function stopDebugMessagesPolling() {
 // 獲取除錯訊息
 async function fetchDebugMessages() {
     try {
-        const response = await fetch('/api/debug_messages');
+        // (修改) 只抓取上次之後的新訊息
+        const response = await fetch(`/api/debug_messages?since=${debugLastSeq}`);
         const data = await response.json();
 
         if (data.status === 'success') {
-            updateDebugConsole(data.messages);
+            // 伺服器重啟或訊息已被覆蓋時，重新整理整個控制台
+            const reset = data.truncated || data.last_seq < debugLastSeq;
+            updateDebugConsole(data.messages, reset);
+            debugLastSeq = data.last_seq;
         }
     } catch (error) {
         console.error('Error fetching debug messages:', error);
@@ -2519,20 +2675,30 @@ async function fetchDebugMessages() {
 }
 
 // 更新除錯控制台
-function updateDebugConsole(messages) {
+function updateDebugConsole(messages, reset = false) {
     const debugConsole = document.getElementById('debug-console');
     if (!debugConsole) return;
+    if (!reset && messages.length === 0) return;
 
-    // 清空控制台
-    debugConsole.innerHTML = '';
+    // (修改) 只在需要時清空控制台，平常只附加新訊息
+    if (reset) {
+        debugConsole.innerHTML = '';
+    }
 
     // 添加每條訊息
+    const fragment = document.createDocumentFragment();
     messages.forEach(message => {
         const messageElement = document.createElement('div');
         messageElement.className = 'debug-message';
         messageElement.textContent = message;
-        debugConsole.appendChild(messageElement);
+        fragment.appendChild(messageElement);
     });
+    debugConsole.appendChild(fragment);
+
+    // 移除超過上限的舊訊息
+    while (debugConsole.childElementCount > DEBUG_CONSOLE_MAX_LINES) {
+        debugConsole.removeChild(debugConsole.firstElementChild);
+    }
 
     // 滾動到底部
     debugConsole.scrollTop = debugConsole.scrollHeight;
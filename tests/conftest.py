@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+# 將 app.py 所在目錄加入 Python 路徑，以便 import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as tw_app
+
+
+class FakeClock:
+    """取代 app.timestamp 的可控時鐘，測試 TTL / 冷卻時間不必真的等待"""
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(tw_app, 'timestamp', fake)
+    return fake
+
+
+@pytest.fixture
+def app_env(tmp_path, monkeypatch):
+    """每個測試各自的投資組合檔案、具名投資組合目錄與歷史資料庫"""
+    portfolios_dir = tmp_path / 'portfolios'
+    portfolios_dir.mkdir()
+    monkeypatch.setitem(tw_app.app.config, 'PORTFOLIO_FILE', str(tmp_path / 'portfolio.json'))
+    monkeypatch.setitem(tw_app.app.config, 'HISTORY_DB', str(tmp_path / 'history.db'))
+    monkeypatch.setitem(tw_app.app.config, 'PORTFOLIOS_DIR', str(portfolios_dir))
+    return tmp_path
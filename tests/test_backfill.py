@@ -0,0 +1,110 @@
+import json
+import sqlite3
+from datetime import date
+
+import pandas as pd
+import pytest
+
+import app as tw_app
+
+START = date(2025, 1, 6)
+END = date(2025, 1, 17)
+SEED_DATE = date(2025, 1, 3)
+FX_RATES = {"TWD": 1.0, "CNY": 4.4, "USD": 32.0}
+
+HOLDINGS = [
+    {"ticker": "2330.TW", "name": "台積電", "shares": 100, "avg_cost": 500.0, "currency": "TWD"},
+    {"ticker": "0050.TW", "name": "元大台灣50", "shares": 50, "avg_cost": 100.0, "currency": "TWD"},
+    {"ticker": "600000.SS", "name": "浦發銀行", "shares": 300, "avg_cost": 7.0, "currency": "CNY"},
+    {"ticker": "AAPL", "name": "Apple", "shares": 10, "avg_cost": 150.0, "currency": "USD"},
+]
+
+# 各市場的休市日 (價格為 0)，包含台股/陸股/美股各自休市與全部休市
+CLOSED = {
+    "2330.TW": {date(2025, 1, 8), date(2025, 1, 15)},
+    "0050.TW": {date(2025, 1, 8), date(2025, 1, 15)},
+    "600000.SS": {date(2025, 1, 9), date(2025, 1, 10), date(2025, 1, 15)},
+    "AAPL": {date(2025, 1, 6), date(2025, 1, 13), date(2025, 1, 15)},
+}
+
+
+def close_prices():
+    days = [d.date() for d in pd.bdate_range(START, END)]
+    base = {"2330.TW": 1000.0, "0050.TW": 180.0, "600000.SS": 8.3, "AAPL": 230.0}
+    return pd.DataFrame({
+        ticker: [0.0 if day in CLOSED[ticker] else round(price * (1 + 0.01 * index), 4)
+                 for index, day in enumerate(days)]
+        for ticker, price in base.items()
+    }, index=days)
+
+
+@pytest.fixture
+def offline_prices(monkeypatch):
+    """以固定的收盤價矩陣取代價格庫與 yfinance，兩種回補都從同一份價格計算"""
+    prices = close_prices()
+
+    def fake_price_matrix(tickers, start_date, end_date):
+        days = [d.date() for d in pd.bdate_range(start_date, end_date)]
+        return prices.reindex(index=days, columns=tickers).fillna(0.0)
+
+    monkeypatch.setattr(tw_app, 'get_price_matrix_yahoo_only', fake_price_matrix)
+    monkeypatch.setattr(tw_app.FX_SERVICE, 'rates_for_persistence', lambda *args, **kwargs: dict(FX_RATES))
+
+
+def use_history_db(monkeypatch, path):
+    monkeypatch.setitem(tw_app.app.config, 'HISTORY_DB', str(path))
+
+
+def read_history(path):
+    conn = sqlite3.connect(str(path))
+    rows = conn.execute("SELECT date, total, tw_value, cn_value FROM daily_history ORDER BY date").fetchall()
+    conn.close()
+    return rows
+
+
+def run_both(app_env, monkeypatch, holdings, seed):
+    with open(tw_app.get_portfolio_file(), 'w', encoding='utf-8') as f:
+        json.dump(holdings, f)
+
+    range_db, single_db = app_env / 'range.db', app_env / 'single.db'
+    for path in (range_db, single_db):
+        use_history_db(monkeypatch, path)
+        if seed:
+            tw_app.update_history_log(seed, SEED_DATE)
+
+    use_history_db(monkeypatch, range_db)
+    tw_app._run_range_backfill(START, END)
+
+    use_history_db(monkeypatch, single_db)
+    for day in pd.bdate_range(START, END):
+        tw_app._run_backfill_for_single_date(day.date())
+
+    return read_history(range_db), read_history(single_db)
+
+
+def assert_same_history(range_rows, single_rows):
+    assert [row[0] for row in range_rows] == [row[0] for row in single_rows]
+    for range_row, single_row in zip(range_rows, single_rows):
+        assert range_row[1:] == pytest.approx(single_row[1:], abs=1e-3), range_row[0]
+
+
+@pytest.mark.parametrize("seed", [
+    {"total": 140000.0, "tw_value": 100000.0, "cn_value": 10000.0},
+    None
+], ids=["seeded", "first-days"])
+def test_range_backfill_matches_single_date_backfill(app_env, monkeypatch, offline_prices, seed):
+    range_rows, single_rows = run_both(app_env, monkeypatch, HOLDINGS, seed)
+
+    assert len(range_rows) == 10 + (1 if seed else 0)
+    assert_same_history(range_rows, single_rows)
+
+
+def test_parity_without_other_currency_holdings(app_env, monkeypatch, offline_prices):
+    holdings = [stock for stock in HOLDINGS if stock["currency"] != "USD"]
+    # 更早的資料含有其他幣別市值 (total > tw + cn)，目前已沒有這類持股，不應沿用
+    seed = {"total": 140000.0, "tw_value": 100000.0, "cn_value": 10000.0}
+    range_rows, single_rows = run_both(app_env, monkeypatch, holdings, seed)
+
+    assert_same_history(range_rows, single_rows)
+    for _, total, tw_value, cn_value in range_rows[1:]:
+        assert total == pytest.approx(tw_value + cn_value)
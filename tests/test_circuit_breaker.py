@@ -0,0 +1,119 @@
+import pytest
+
+import app as tw_app
+
+CircuitBreaker = tw_app.CircuitBreaker
+
+
+def open_breaker(breaker):
+    for _ in range(tw_app.CIRCUIT_FAILURE_THRESHOLD):
+        assert breaker.allow_request()
+        breaker.record(False, 0.1)
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("MIS")
+
+    for _ in range(tw_app.CIRCUIT_FAILURE_THRESHOLD - 1):
+        breaker.record(False, 0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.record(False, 0.1)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    assert breaker.total_skipped == 1
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker("MIS")
+
+    for _ in range(tw_app.CIRCUIT_FAILURE_THRESHOLD - 1):
+        breaker.record(False, 0.1)
+    breaker.record(True, 0.1)
+    breaker.record(False, 0.1)
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.consecutive_failures == 1
+
+
+def test_half_open_allows_a_single_trial(clock):
+    breaker = CircuitBreaker("MIS")
+    open_breaker(breaker)
+
+    clock.advance(tw_app.CIRCUIT_COOLDOWN_SECONDS)
+    assert breaker.health()["state"] == CircuitBreaker.HALF_OPEN
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow_request()
+
+    breaker.record(True, 0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+
+
+def test_failed_trial_reopens_breaker(clock):
+    breaker = CircuitBreaker("MIS")
+    open_breaker(breaker)
+
+    clock.advance(tw_app.CIRCUIT_COOLDOWN_SECONDS)
+    assert breaker.allow_request()
+    breaker.record(False, 0.1)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    clock.advance(tw_app.CIRCUIT_COOLDOWN_SECONDS)
+    assert breaker.allow_request()
+
+
+@pytest.fixture
+def mis_breaker(monkeypatch):
+    breaker = CircuitBreaker("MIS")
+    monkeypatch.setitem(tw_app.CIRCUIT_BREAKERS, "MIS", breaker)
+    return breaker
+
+
+def rate_limited(tickers):
+    raise tw_app.RateLimitExceeded("mis rate limit exceeded")
+
+
+def failing(tickers):
+    raise RuntimeError("upstream down")
+
+
+def test_provider_failures_open_the_breaker(clock, mis_breaker):
+    for _ in range(tw_app.CIRCUIT_FAILURE_THRESHOLD):
+        assert tw_app.call_quote_provider("MIS", failing, ['2330.TW']) == {}
+
+    assert mis_breaker.state == CircuitBreaker.OPEN
+    calls = []
+    tw_app.call_quote_provider("MIS", lambda tickers: calls.append(tickers), ['2330.TW'])
+    assert calls == []
+
+
+def test_zero_prices_count_as_failure(clock, mis_breaker):
+    zero = lambda tickers: {ticker: {"price": 0} for ticker in tickers}
+    for _ in range(tw_app.CIRCUIT_FAILURE_THRESHOLD):
+        tw_app.call_quote_provider("MIS", zero, ['2330.TW'])
+
+    assert mis_breaker.state == CircuitBreaker.OPEN
+
+
+def test_rate_limit_does_not_count_as_provider_failure(clock, mis_breaker):
+    for _ in range(tw_app.CIRCUIT_FAILURE_THRESHOLD * 2):
+        assert tw_app.call_quote_provider("MIS", rate_limited, ['2330.TW']) == {}
+
+    assert mis_breaker.state == CircuitBreaker.CLOSED
+    assert mis_breaker.consecutive_failures == 0
+    assert mis_breaker.total_calls == 0
+
+
+def test_rate_limit_releases_half_open_trial(clock, mis_breaker):
+    open_breaker(mis_breaker)
+    clock.advance(tw_app.CIRCUIT_COOLDOWN_SECONDS)
+
+    assert tw_app.call_quote_provider("MIS", rate_limited, ['2330.TW']) == {}
+    assert mis_breaker.state == CircuitBreaker.HALF_OPEN
+
+    ok = lambda tickers: {ticker: {"price": 1000.0} for ticker in tickers}
+    assert tw_app.call_quote_provider("MIS", ok, ['2330.TW']) == {'2330.TW': {"price": 1000.0}}
+    assert mis_breaker.state == CircuitBreaker.CLOSED
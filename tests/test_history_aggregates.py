@@ -0,0 +1,127 @@
+import sqlite3
+from datetime import date, timedelta
+
+import pytest
+
+import app as tw_app
+
+
+def snapshot(total):
+    return {"total": total, "tw_value": round(total * 0.7, 4), "cn_value": round(total * 0.3, 4)}
+
+
+def expected_period(db_path, period):
+    """直接以 SQL 掃 daily_history 算出某個月 ('YYYY-MM') 或某年 ('YYYY') 的彙總"""
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute(
+        "SELECT date, total FROM daily_history WHERE substr(date, 1, ?) = ? ORDER BY date ASC",
+        (len(period), period)
+    ).fetchall()
+    conn.close()
+    if not rows:
+        return None
+    totals = [total for _, total in rows]
+    return {
+        "first_date": rows[0][0], "first_total": rows[0][1],
+        "last_date": rows[-1][0], "last_total": rows[-1][1],
+        "min_total": min(totals), "max_total": max(totals), "days": len(rows)
+    }
+
+
+def assert_aggregates_match_daily_history(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    stored = {row['period']: dict(row) for row in conn.execute("SELECT * FROM history_aggregates")}
+    periods = set()
+    for (day,) in conn.execute("SELECT date FROM daily_history"):
+        periods.update((day[:7], day[:4]))
+    conn.close()
+
+    assert set(stored) == periods
+    for period in periods:
+        row = stored[period]
+        assert row['period_type'] == ('month' if len(period) == 7 else 'year')
+        assert {key: row[key] for key in expected_period(db_path, period)} == expected_period(db_path, period)
+
+
+@pytest.fixture
+def history(app_env):
+    """今天往前約 14 個月的每日資料 (跨年、跨月)"""
+    today = date.today()
+    days = [today - timedelta(days=offset) for offset in range(420, -1, -1)]
+    tw_app.update_history_log_bulk(
+        [(day, snapshot(1000 + (index * 37) % 211)) for index, day in enumerate(days)]
+    )
+    return str(app_env / 'history.db')
+
+
+def test_bulk_write_builds_month_and_year_aggregates(history):
+    assert_aggregates_match_daily_history(history)
+
+
+def test_single_writes_and_overwrites_keep_aggregates_in_sync(history):
+    today = date.today()
+    tw_app.update_history_log(snapshot(5000), today)
+    tw_app.update_history_log(snapshot(1), today - timedelta(days=200))
+    tw_app.update_history_log(snapshot(9999), today - timedelta(days=400))
+    tw_app.update_history_log(snapshot(1234), today + timedelta(days=40))
+
+    assert_aggregates_match_daily_history(history)
+
+
+def test_delete_updates_aggregates(history):
+    client = tw_app.app.test_client()
+    month_start = date.today().replace(day=1)
+
+    response = client.post('/api/delete_history', json={'date': month_start.strftime('%Y-%m-%d')})
+    assert response.status_code == 200
+
+    assert_aggregates_match_daily_history(history)
+
+
+def test_deleting_a_whole_month_removes_its_aggregate(history):
+    conn = tw_app.get_db_conn()
+    first_month = conn.execute("SELECT MIN(substr(date, 1, 7)) FROM daily_history").fetchone()[0]
+    start, end = tw_app._month_bounds(first_month)
+    conn.execute("DELETE FROM daily_history WHERE date >= ? AND date < ?", (start, end))
+    tw_app.refresh_history_aggregates(conn, [start])
+    conn.commit()
+    conn.close()
+
+    assert_aggregates_match_daily_history(history)
+
+
+def test_rebuild_matches_incremental_maintenance(history):
+    conn = tw_app.get_db_conn()
+    incremental = [tuple(row) for row in conn.execute("SELECT * FROM history_aggregates ORDER BY period")]
+    tw_app.rebuild_history_aggregates(conn)
+    conn.commit()
+    rebuilt = [tuple(row) for row in conn.execute("SELECT * FROM history_aggregates ORDER BY period")]
+    conn.close()
+
+    assert rebuilt == incremental
+
+
+def test_history_summary_mtd_ytd_match_direct_sql(history):
+    today = date.today().strftime('%Y-%m-%d')
+    data = tw_app.app.test_client().get('/api/history_summary').get_json()
+
+    month = expected_period(history, today[:7])
+    year = expected_period(history, today[:4])
+    assert data["monthly"]["start_value"] == month["first_total"]
+    assert data["monthly"]["end_value"] == month["last_total"]
+    assert data["monthly"]["diff"] == pytest.approx(month["last_total"] - month["first_total"])
+    assert data["yearly"]["start_value"] == year["first_total"]
+    assert data["yearly"]["end_value"] == year["last_total"]
+    assert data["yearly"]["percent"] == pytest.approx((year["last_total"] - year["first_total"]) / year["first_total"] * 100)
+
+
+def test_history_summary_since_returns_only_newer_days(history):
+    client = tw_app.app.test_client()
+    full = client.get('/api/history_summary').get_json()
+    since = (date.today() - timedelta(days=5)).strftime('%Y-%m-%d')
+    partial = client.get(f'/api/history_summary?since={since}').get_json()
+
+    assert partial["daily"] == {day: values for day, values in full["daily"].items() if day >= since}
+    assert partial["monthly"] == full["monthly"]
+    assert partial["yearly"] == full["yearly"]
@@ -0,0 +1,117 @@
+import copy
+from collections import OrderedDict
+
+import pytest
+
+import app as tw_app
+
+
+def apply_delta(base, delta):
+    """與前端 applyPortfolioDelta 相同的合併邏輯"""
+    removed = set(delta["removed"])
+    changed = {stock['ticker']: stock for stock in delta["stocks"]}
+    stocks = [changed.get(stock['ticker'], stock) for stock in base["stocks"] if stock['ticker'] not in removed]
+    known = set(stock['ticker'] for stock in stocks)
+    stocks += [stock for stock in delta["stocks"] if stock['ticker'] not in known]
+    totals = dict(base["totals"], **delta["totals"])
+    for key in delta["removed_totals"]:
+        totals.pop(key, None)
+    return {"stocks": stocks, "totals": totals}
+
+
+def stock(ticker, price, shares=1000):
+    return {"ticker": ticker, "current_price": price, "shares": shares, "market_value": price * shares}
+
+
+BASE = {
+    "stocks": [stock('2330.TW', 1000.0), stock('2317.TW', 200.0), stock('600000.SS', 8.3)],
+    "totals": {"total_market_value": 1208300.0, "total_pl": 1000.0, "cn_market_value": 8300.0}
+}
+
+
+def changed_payload():
+    payload = copy.deepcopy(BASE)
+    payload["stocks"][0]["current_price"] = 1010.0
+    del payload["stocks"][2]
+    payload["stocks"].append(stock('AAPL', 230.0, shares=10))
+    payload["totals"]["total_market_value"] = 1212300.0
+    del payload["totals"]["cn_market_value"]
+    payload["totals"]["other_market_value"] = 2300.0
+    return payload
+
+
+@pytest.fixture
+def payloads(app_env, monkeypatch):
+    """以固定內容取代估值，測試只涵蓋版本與 delta 的邏輯"""
+    current = {tw_app.DEFAULT_PORTFOLIO: copy.deepcopy(BASE)}
+    monkeypatch.setattr(tw_app, 'build_portfolio_payload', lambda name=tw_app.DEFAULT_PORTFOLIO: copy.deepcopy(current[name]))
+    monkeypatch.setattr(tw_app, 'PORTFOLIO_VERSIONS', OrderedDict())
+    return current
+
+
+@pytest.fixture(params=['local', 'shared'])
+def version_store(request, tmp_path, monkeypatch):
+    """行程內的版本表與多 worker 共用的 SHARED_STATE 兩種模式都要測"""
+    if request.param == 'shared':
+        monkeypatch.setattr(tw_app, 'SHARED_STATE', tw_app.SharedStateStore(str(tmp_path / 'shared_state.db')))
+    return request.param
+
+
+def test_delta_applied_to_base_reproduces_full_payload():
+    payload = changed_payload()
+    delta = tw_app.build_portfolio_delta(BASE, payload, 'v1', 'v2')
+
+    assert apply_delta(BASE, delta) == payload
+    assert [s['ticker'] for s in delta["stocks"]] == ['2330.TW', 'AAPL']
+    assert delta["removed"] == ['600000.SS']
+    assert delta["removed_totals"] == ['cn_market_value']
+
+
+def test_identical_payloads_give_empty_delta():
+    delta = tw_app.build_portfolio_delta(BASE, copy.deepcopy(BASE), 'v1', 'v1')
+
+    assert delta["stocks"] == [] and delta["removed"] == []
+    assert delta["totals"] == {} and delta["removed_totals"] == []
+    assert apply_delta(BASE, delta) == BASE
+
+
+def test_since_version_round_trip(payloads, version_store):
+    client = tw_app.app.test_client()
+    first = client.get('/api/portfolio')
+    base_version = first.headers['ETag'].strip('"')
+
+    payloads[tw_app.DEFAULT_PORTFOLIO] = changed_payload()
+    delta = client.get(f'/api/portfolio?since_version={base_version}').get_json()
+
+    assert delta["delta"] is True
+    assert delta["base_version"] == base_version
+    assert apply_delta(first.get_json(), delta) == changed_payload()
+
+    full = client.get('/api/portfolio')
+    assert full.headers['ETag'].strip('"') == delta["version"]
+
+
+def test_unknown_version_returns_full_payload(payloads, version_store):
+    response = tw_app.app.test_client().get('/api/portfolio?since_version=unknown')
+
+    assert response.get_json() == BASE
+
+
+def test_versions_are_not_shared_between_portfolios(payloads, version_store):
+    tw_app.create_portfolio('beta')
+    payloads['beta'] = copy.deepcopy(BASE)
+    client = tw_app.app.test_client()
+    base_version = client.get('/api/portfolio').headers['ETag'].strip('"')
+
+    payloads['beta'] = changed_payload()
+    response = client.get(f'/api/portfolio?portfolio=beta&since_version={base_version}').get_json()
+
+    assert "delta" not in response
+    assert response == changed_payload()
+
+
+def test_unchanged_payload_returns_304(payloads, version_store):
+    client = tw_app.app.test_client()
+    etag = client.get('/api/portfolio').headers['ETag']
+
+    assert client.get('/api/portfolio', headers={'If-None-Match': etag}).status_code == 304
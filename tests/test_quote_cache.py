@@ -0,0 +1,153 @@
+import threading
+import time
+
+import app as tw_app
+
+
+def quote(price, source='MIS'):
+    return {"price": price, "previous_close": price, "source": source}
+
+
+class RecordingFetch:
+    def __init__(self, price=100.0):
+        self.price = price
+        self.calls = []
+
+    def __call__(self, tickers):
+        self.calls.append(list(tickers))
+        return {ticker: quote(self.price) for ticker in tickers}
+
+
+def test_entries_are_served_from_cache_until_ttl_expires(clock):
+    cache = tw_app.QuoteCache()
+    fetch = RecordingFetch()
+
+    assert cache.get_many(['2330.TW'], fetch, ttl=10) == {'2330.TW': quote(100.0)}
+    clock.advance(9)
+    fetch.price = 200.0
+    assert cache.get_many(['2330.TW'], fetch, ttl=10) == {'2330.TW': quote(100.0)}
+    assert fetch.calls == [['2330.TW']]
+
+    clock.advance(2)
+    assert cache.get_many(['2330.TW'], fetch, ttl=10) == {'2330.TW': quote(200.0)}
+    assert fetch.calls == [['2330.TW'], ['2330.TW']]
+    assert cache.stats["hits"] == 1
+    assert cache.stats["misses"] == 2
+
+
+def test_only_expired_tickers_are_refetched(clock):
+    cache = tw_app.QuoteCache()
+    fetch = RecordingFetch()
+
+    cache.get_many(['2330.TW'], fetch, ttl=10)
+    clock.advance(5)
+    cache.get_many(['2317.TW'], fetch, ttl=10)
+    clock.advance(6)
+    cache.get_many(['2330.TW', '2317.TW'], fetch, ttl=10)
+
+    assert fetch.calls == [['2330.TW'], ['2317.TW'], ['2330.TW']]
+
+
+def test_returned_quotes_are_copies(clock):
+    cache = tw_app.QuoteCache()
+    fetch = RecordingFetch()
+
+    cache.get_many(['2330.TW'], fetch, ttl=10)['2330.TW']['price'] = 0
+    assert cache.get_many(['2330.TW'], fetch, ttl=10)['2330.TW']['price'] == 100.0
+
+
+def test_concurrent_callers_share_one_fetch():
+    cache = tw_app.QuoteCache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_fetch(tickers):
+        calls.append(list(tickers))
+        started.set()
+        release.wait(5)
+        return {ticker: quote(100.0) for ticker in tickers}
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(cache.get_many(['2330.TW'], slow_fetch, ttl=10)))
+    first.start()
+    assert started.wait(5)
+
+    second = threading.Thread(target=lambda: results.append(cache.get_many(['2330.TW'], slow_fetch, ttl=10)))
+    second.start()
+    while cache.snapshot_stats()["waits"] == 0:
+        time.sleep(0.01)
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert calls == [['2330.TW']]
+    assert results == [{'2330.TW': quote(100.0)}] * 2
+    assert cache.stats["waits"] == 1
+
+
+def test_waiters_are_released_when_fetch_fails():
+    cache = tw_app.QuoteCache()
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing_fetch(tickers):
+        started.set()
+        release.wait(5)
+        raise RuntimeError("upstream down")
+
+    errors = []
+
+    def first_caller():
+        try:
+            cache.get_many(['2330.TW'], failing_fetch, ttl=10)
+        except RuntimeError as e:
+            errors.append(e)
+
+    results = []
+    first = threading.Thread(target=first_caller)
+    first.start()
+    assert started.wait(5)
+    second = threading.Thread(target=lambda: results.append(cache.get_many(['2330.TW'], failing_fetch, ttl=10)))
+    second.start()
+    while cache.snapshot_stats()["waits"] == 0:
+        time.sleep(0.01)
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert not second.is_alive()
+    assert len(errors) == 1
+    assert results == [{}]
+
+
+def test_failed_quotes_are_kept_only_for_negative_ttl(clock):
+    cache = tw_app.QuoteCache()
+    calls = []
+
+    def failing_fetch(tickers):
+        calls.append(list(tickers))
+        return {ticker: quote(0, source='N/A') for ticker in tickers}
+
+    cache.get_many(['2330.TW'], failing_fetch, ttl=10, negative_ttl=2)
+    clock.advance(1)
+    assert cache.get_many(['2330.TW'], failing_fetch, ttl=10, negative_ttl=2) == {'2330.TW': quote(0, source='N/A')}
+    assert cache.stats["negative_hits"] == 1
+    assert len(calls) == 1
+
+    clock.advance(2)
+    cache.get_many(['2330.TW'], failing_fetch, ttl=10, negative_ttl=2)
+    assert len(calls) == 2
+
+
+def test_failed_quotes_are_not_cached_without_negative_ttl(clock):
+    cache = tw_app.QuoteCache()
+    calls = []
+
+    def failing_fetch(tickers):
+        calls.append(list(tickers))
+        return {ticker: quote(0, source='N/A') for ticker in tickers}
+
+    cache.get_many(['2330.TW'], failing_fetch, ttl=10)
+    cache.get_many(['2330.TW'], failing_fetch, ttl=10)
+    assert len(calls) == 2
@@ -0,0 +1,81 @@
+import pytest
+
+import app as tw_app
+
+
+@pytest.fixture
+def sleeps(monkeypatch, clock):
+    """記錄 acquire 需要等待的秒數，並讓假時鐘前進同樣的時間"""
+    waited = []
+
+    def fake_sleep(seconds):
+        waited.append(seconds)
+        clock.advance(seconds)
+
+    monkeypatch.setattr(tw_app.time_module, 'sleep', fake_sleep)
+    return waited
+
+
+def test_burst_is_served_without_waiting(clock, sleeps):
+    bucket = tw_app.TokenBucket(rate=1.0, capacity=3)
+
+    assert [bucket.acquire(timeout=0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert sleeps == []
+
+
+def test_acquire_returns_none_when_wait_exceeds_timeout(clock, sleeps):
+    bucket = tw_app.TokenBucket(rate=0.5, capacity=1)
+    bucket.acquire(timeout=0)
+
+    assert bucket.acquire(timeout=1) is None
+    assert sleeps == []
+    # 被拒絕的預約會歸還 token，不會讓後面的請求多等
+    assert bucket.acquire(timeout=2) == pytest.approx(2.0)
+    assert sleeps == [pytest.approx(2.0)]
+
+
+def test_acquire_waits_within_timeout(clock, sleeps):
+    bucket = tw_app.TokenBucket(rate=2.0, capacity=1)
+    bucket.acquire()
+
+    assert bucket.acquire(timeout=1) == pytest.approx(0.5)
+    assert bucket.acquire(timeout=1) == pytest.approx(0.5)
+    assert sleeps == [pytest.approx(0.5), pytest.approx(0.5)]
+
+
+def test_tokens_refill_up_to_capacity(clock, sleeps):
+    bucket = tw_app.TokenBucket(rate=1.0, capacity=2)
+    bucket.acquire()
+    bucket.acquire()
+
+    clock.advance(60)
+    assert [bucket.acquire(timeout=0) for _ in range(2)] == [0.0, 0.0]
+    assert bucket.acquire(timeout=0) is None
+
+
+def test_rate_limiter_raises_and_counts_rejections(clock, sleeps):
+    limiter = tw_app.RateLimiter({"mis": (1.0, 1)})
+
+    limiter.acquire("mis", timeout=0)
+    with pytest.raises(tw_app.RateLimitExceeded):
+        limiter.acquire("mis", timeout=0)
+
+    stats = limiter.stats()["mis"]
+    assert stats["acquired"] == 1
+    assert stats["rejected"] == 1
+    assert stats["rate_per_second"] == 1.0
+    assert stats["burst"] == 1
+
+
+def test_rate_limiter_ignores_unknown_providers(clock, sleeps):
+    limiter = tw_app.RateLimiter({"mis": (1.0, 1)})
+
+    assert limiter.acquire("unknown", timeout=0) is None
+    assert "unknown" not in limiter.stats()
+
+
+def test_split_rate_limits_divides_budget_between_workers():
+    limits = tw_app.split_rate_limits({"mis": (0.6, 3), "fx": (0.2, 2)}, 4)
+
+    assert limits["mis"] == (pytest.approx(0.15), 1)
+    assert limits["fx"] == (pytest.approx(0.05), 1)